@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of snmp table response decoding.
+
+Walk of ARP-like table (ipNetToMediaTable, 4 columns) is generated once with fixed seed and decoded by string based
+decoding (as done before oid tuples were used) and by TableWalk. Both results are compared before timing. Speedup
+of TableWalk depends on the machine and interpreter build, runs with Python 2.7 and pysnmp 4.2 measured 3x to 3.9x.
+
+usage: PYTHONPATH=. python bench/table_walk.py [--rows 25000] [--repetitions 25] [--repeat 5]
+"""
+import argparse
+import random
+import time
+from pysnmp.proto import rfc1902
+from ctrdn.netpadd.probe.util.snmp import TableWalk
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+BASE_OID = "1.3.6.1.2.1.4.22.1"
+TABLE_CONFIG = {"BaseOid": BASE_OID, "ColumnNameMode": "manual-multi-level",
+                "Columns": {"ipNetToMediaIfIndex": 1, "ipNetToMediaPhysAddress": 2, "ipNetToMediaNetAddress": 3,
+                            "ipNetToMediaType": 4}}
+
+
+def generate_walk(row_count, repetitions):
+    # rows are indexed by interface index and ip address, as in ipNetToMediaTable
+    generator = random.Random(42)
+    rows = []
+    for row_number in range(0, row_count):
+        if_index = 1 + row_number // 1000
+        address = (10, (row_number >> 16) & 255, (row_number >> 8) & 255, row_number & 255)
+        mac = "".join(chr(generator.randint(0, 255)) for _ in range(0, 6))
+        rows.append(((if_index,) + address, [rfc1902.Integer32(if_index), rfc1902.OctetString(mac),
+                                             rfc1902.IpAddress(".".join(str(x) for x in address)),
+                                             rfc1902.Integer32(3)]))
+    rows.sort()
+
+    base = tuple(int(x) for x in BASE_OID.split("."))
+    walk_rows = []
+    for row_key, values in rows:
+        walk_rows.append([(rfc1902.ObjectName(base + (column,) + row_key), value)
+                          for column, value in zip((1, 2, 3, 4), values)])
+    # end of table, agent returns first oid after the table for every column
+    walk_rows.append([(rfc1902.ObjectName(base[:-1] + (base[-1] + 1, 1)), rfc1902.Integer32(0))] * 4)
+    return [walk_rows[x:x + repetitions] for x in range(0, len(walk_rows), repetitions)]
+
+
+def decode_strings(responses):
+    # string based decoding used by the probe before TableWalk worked with oid tuples
+    oid_column_map = dict((col_oid, col_name) for col_name, col_oid in TABLE_CONFIG["Columns"].iteritems())
+    table_data = []
+    snmpid_table_map = {}
+    for response in responses:
+        for var_bind_row in response:
+            for oid, value in var_bind_row:
+                oid_string = str(oid.prettyOut(oid))
+                value = value.prettyOut(value)
+                if not oid_string.startswith(BASE_OID + "."):
+                    continue
+                column_id = int(oid_string[len(BASE_OID) + 1:oid_string.find(".", len(BASE_OID) + 1)])
+                item_id = oid_string[oid_string.find(".", len(BASE_OID) + 1) + 1:]
+                if not column_id in oid_column_map:
+                    continue
+                if not item_id in snmpid_table_map:
+                    table_data.append({oid_column_map[column_id]: value, "RowIndex": item_id})
+                    snmpid_table_map[item_id] = len(table_data) - 1
+                else:
+                    table_data[snmpid_table_map[item_id]][oid_column_map[column_id]] = value
+    return table_data
+
+
+def decode_tuples(responses):
+    walk = TableWalk(TABLE_CONFIG)
+    for response in responses:
+        walk.feed(response)
+    return walk.table_data
+
+
+def measure(function, responses, repeat):
+    best = None
+    for _ in range(0, repeat):
+        start_time = time.time()
+        function(responses)
+        elapsed = time.time() - start_time
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="snmp table decoding benchmark")
+    parser.add_argument("--rows", type=int, default=25000, help="table rows, every row has 4 varbinds")
+    parser.add_argument("--repetitions", type=int, default=25, help="rows in one getbulk response")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, best run is reported")
+    args = parser.parse_args()
+
+    responses = generate_walk(args.rows, args.repetitions)
+    var_bind_count = sum(len(row) for response in responses for row in response)
+    assert decode_strings(responses) == decode_tuples(responses), "decoders returned different table data"
+
+    print("decoding %d varbinds in %d responses, best of %d runs" % (var_bind_count, len(responses), args.repeat))
+    baseline = None
+    for name, function in (("strings", decode_strings), ("tuples", decode_tuples)):
+        elapsed = measure(function, responses, args.repeat)
+        baseline = elapsed if baseline is None else baseline
+        print("%-8s %8.3f s %10.0f varbinds/s %6.2fx" % (name, elapsed, var_bind_count / elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
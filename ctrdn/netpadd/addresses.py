@@ -0,0 +1,62 @@
+import threading
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class AddressTracker(object):
+    """
+    Health of management addresses of multi-homed devices. Address which answered last is preferred, other addresses
+    are ordered by their health: answering ones by latency, then unknown ones, then failing ones.
+    """
+    _devices = None
+    _lock = None
+    _latency_weight = 0.3
+
+    def __init__(self):
+        # device id -> dict(Preferred=address, Addresses={address: dict(Latency=..., Failures=...)})
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def order(self, device_id, addresses):
+        with self._lock:
+            state = self._devices.get(device_id, {})
+            preferred = state.get("Preferred")
+            statistics = dict(state.get("Addresses", {}))
+
+        def _get_key(item):
+            index, address = item
+            address_statistics = statistics.get(address)
+            if address == preferred:
+                return 0, 0, 0, index
+            if address_statistics is None:
+                return 2, 0, 0, index
+            if address_statistics["Failures"] > 0:
+                return 3, address_statistics["Failures"], 0, index
+            return 1, 0, address_statistics["Latency"], index
+
+        return [address for index, address in sorted(enumerate(addresses), key=_get_key)]
+
+    def report_success(self, device_id, address, latency, prefer):
+        with self._lock:
+            state = self._devices.setdefault(device_id, dict(Preferred=None, Addresses={}))
+            address_statistics = state["Addresses"].get(address)
+            if address_statistics is None or address_statistics["Latency"] is None:
+                average_latency = latency
+            else:
+                average_latency = address_statistics["Latency"] + self._latency_weight * \
+                    (latency - address_statistics["Latency"])
+            state["Addresses"][address] = dict(Latency=average_latency, Failures=0)
+            if prefer:
+                state["Preferred"] = address
+
+    def report_failure(self, device_id, address):
+        with self._lock:
+            state = self._devices.setdefault(device_id, dict(Preferred=None, Addresses={}))
+            address_statistics = state["Addresses"].setdefault(address, dict(Latency=None, Failures=0))
+            address_statistics["Failures"] += 1
+            if state["Preferred"] == address:
+                state["Preferred"] = None
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
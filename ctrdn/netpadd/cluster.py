@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+def get_node_id(node_name=None):
+    # every planner process is a separate node, several nodes can run on one host
+    return "%s:%d" % (node_name or socket.gethostname(), os.getpid())
+
+
+class LeaseManager(threading.Thread):
+    """
+    Shares polling of devices between netpadd nodes using the same database. Before a device is enqueued the planner
+    claims its poll slot in np.monitor.planner with one atomic find_one_and_update, the claim succeeds only when the
+    device is due and its lease is free, expired or held by this node, and it extends the lease. Leases of devices
+    planned by this node are renewed by heartbeats, so devices stay on one node (rates and caches of probes are kept
+    in memory) until the node stops or dies, other nodes take over its devices after the lease expires.
+
+    Nodes holding more than their share of leases release the surplus, devices released by this node are not claimed
+    by it again for one lease time, so they move to the other nodes.
+    """
+    _logger = logging.getLogger("cluster")
+    _db = None
+    _node_id = None
+    _lease_time = None
+    _heartbeat_interval = None
+    _slot_tolerance = 0.9
+    _balance_slack = 1.1
+    _devices = None
+    _released = None
+    _lock = None
+
+    def __init__(self, db, node_id, lease_time, heartbeat_interval):
+        threading.Thread.__init__(self, name="cluster-lease-manager")
+        assert heartbeat_interval < lease_time, "heartbeat interval must be shorter than lease time"
+        self._db = db
+        """:type : Database"""
+        self._node_id = node_id
+        self._lease_time = lease_time
+        self._heartbeat_interval = heartbeat_interval
+        self._devices = set()
+        self._released = {}
+        self._lock = threading.Lock()
+
+    def get_node_id(self):
+        return self._node_id
+
+    def ensure_indexes(self):
+        # concurrent claims of device without planner record insert only one of them, without the unique index both
+        # claims would succeed, so node does not start when it can not be created (duplicate planner records)
+        try:
+            self._db.np.monitor.planner.create_index([("DeviceId", ASCENDING)], unique=True)
+        except OperationFailure as e:
+            self._logger.error("unable to create unique planner index, remove duplicate planner records: %s", e)
+            raise
+        self._db.np.monitor.planner.create_index([("LeaseNode", ASCENDING)])
+        self._db.np.cluster.node.create_index([("Expires", ASCENDING)], expireAfterSeconds=0)
+
+    def claim(self, device_id, poll_interval):
+        """
+        Claim the current poll slot of device, return True when the device is to be polled by this node.
+        """
+        with self._lock:
+            released_until = self._released.get(device_id)
+            if released_until is not None:
+                if time.time() < released_until:
+                    return False
+                del self._released[device_id]
+
+        now = datetime.utcnow()
+        query = {"DeviceId": device_id,
+                 "$and": [{"$or": [{"LeaseNode": self._node_id}, {"LeaseNode": None},
+                                   {"LeaseExpires": {"$lte": now}}]},
+                          {"$or": [{"LastEnqueueTimestamp": None}, {"LastEnqueueTimestamp": {
+                              "$lte": now - timedelta(seconds=poll_interval * self._slot_tolerance)}}]}]}
+        update = {"$set": {"LeaseNode": self._node_id, "LeaseExpires": now + timedelta(seconds=self._lease_time),
+                           "LastEnqueueTimestamp": now}}
+        try:
+            previous = self._db.np.monitor.planner.find_one_and_update(query, update, {"LeaseNode": 1}, upsert=True,
+                                                                       return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            # record exists, slot already claimed or device leased by another node
+            return False
+        except PyMongoError as e:
+            # device is not polled when its lease can not be verified
+            self._logger.error("failed to claim device %s: %s", device_id, e)
+            return False
+
+        if previous is not None and previous.get("LeaseNode") not in (None, self._node_id):
+            self._logger.info("took over device %s from node %s", device_id, previous["LeaseNode"])
+        with self._lock:
+            self._devices.add(device_id)
+        return True
+
+    def forget(self, device_id):
+        # lease of device no longer planned by this node is not renewed and expires
+        with self._lock:
+            self._devices.discard(device_id)
+
+    def run(self):
+        self._logger.info("starting cluster node %s, lease time=%ds, heartbeat interval=%ds", self._node_id,
+                          self._lease_time, self._heartbeat_interval)
+        while True:
+            try:
+                self.heartbeat()
+            except Exception:
+                self._logger.exception("cluster heartbeat failed")
+            time.sleep(self._heartbeat_interval)
+
+    def heartbeat(self):
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=self._lease_time)
+        with self._lock:
+            device_ids = list(self._devices)
+        held = 0
+        if len(device_ids) > 0:
+            held = self._db.np.monitor.planner.update_many(
+                {"LeaseNode": self._node_id, "DeviceId": {"$in": device_ids}},
+                {"$set": {"LeaseExpires": expires}}).matched_count
+        self._db.np.cluster.node.update_one({"_id": self._node_id},
+                                            {"$set": {"Heartbeat": now, "Expires": expires, "Leases": held}},
+                                            upsert=True)
+        self._balance(held, now)
+
+    def _balance(self, held, now):
+        node_count = self._db.np.cluster.node.count_documents({"Expires": {"$gt": now}})
+        lease_count = self._db.np.monitor.planner.count_documents({"LeaseExpires": {"$gt": now}})
+        share = int(math.ceil(lease_count * self._balance_slack / max(node_count, 1)))
+        if held <= share:
+            return
+
+        with self._lock:
+            release_ids = list(self._devices)[:held - share]
+            released_until = time.time() + self._lease_time
+            for device_id in release_ids:
+                self._devices.discard(device_id)
+                self._released[device_id] = released_until
+        self._db.np.monitor.planner.update_many({"LeaseNode": self._node_id, "DeviceId": {"$in": release_ids}},
+                                                {"$unset": {"LeaseNode": "", "LeaseExpires": ""}})
+        self._logger.info("released %d of %d leased devices to other nodes, nodes=%d, share=%d", len(release_ids),
+                          held, node_count, share)
+
+    def release_all(self):
+        # devices of stopped node are taken over by other nodes in their next slot, without waiting for expiry
+        with self._lock:
+            self._devices.clear()
+        result = self._db.np.monitor.planner.update_many({"LeaseNode": self._node_id},
+                                                         {"$unset": {"LeaseNode": "", "LeaseExpires": ""}})
+        self._db.np.cluster.node.delete_one({"_id": self._node_id})
+        self._logger.info("released %d leased devices of node %s", result.modified_count, self._node_id)
@@ -4,4 +4,7 @@ __author__ = 'Lubomir Kaplan <castor@castor.sk>'
 class NetPadConstants(object):
     CONFIGURATION_FILE_NAME = "netpadd.conf"
     MONITOR_PLANNER_SLEEP_TIME = 5
-    MONITOR_MAX_POLLER_THREADS = 20
\ No newline at end of file
+    MONITOR_MAX_POLLER_THREADS = 20
+    # devices not stamped with current MonitorConfigurationVersion are normalized by planner, bump when probes require
+    # new configuration attributes
+    MONITOR_CONFIGURATION_VERSION = 1
@@ -1,14 +1,18 @@
 import ConfigParser
 from Queue import Queue
-import importlib
 import logging
-from os import listdir
+import signal
 from time import sleep
-from os.path import isfile, join
 from pymongo.mongo_client import MongoClient
 
+from ctrdn.netpadd.cluster import LeaseManager, get_node_id
 from ctrdn.netpadd.constants import NetPadConstants
-from ctrdn.netpadd.monitor import PollingPlanner, DevicePoller
+from ctrdn.netpadd.monitor import PollingPlanner, DevicePoller, EventDevicePoller, DeviceCache
+from ctrdn.netpadd.registry import ProbeRegistry
+from ctrdn.netpadd.rollup import RollupEngine
+from ctrdn.netpadd.storage import create_layouts
+from ctrdn.netpadd.workers import WorkerSupervisor
+from ctrdn.netpadd.writer import ResultWriter
 
 
 __author__ = 'Lubomir Kaplan <castor@castor.sk>'
@@ -19,6 +23,9 @@ class NetPadDaemon():
     _config = None
     _db = None
     _planner = None
+    _leases = None
+    _rollup = None
+    _probes = None
     _logger = logging.getLogger("daemon")
     _poller_threads = []
 
@@ -53,6 +60,49 @@ class NetPadDaemon():
     def start(self):
         self._logger.info("starting up")
 
+        worker_count = int(self._get_monitor_option("workers", 0))
+        if worker_count > 0:
+            self._supervise(worker_count)
+            return
+
+        self._connect()
+        self._load_probes()
+        self._start_polling(None)
+        self._start_rollup()
+        self._wait()
+
+    def _supervise(self, worker_count):
+        # devices are polled by worker processes, each one owns its partitions of devices and its database connection
+        supervisor = WorkerSupervisor(self._run_worker, worker_count,
+                                      int(self._get_monitor_option("worker-partitions", worker_count * 16)),
+                                      int(self._get_monitor_option("worker-max-restarts", 5)),
+                                      int(self._get_monitor_option("worker-restart-window", 300)),
+                                      int(self._get_monitor_option("worker-restart-delay", 1)))
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        supervisor.start_workers()
+        self._logger.debug("started %d worker processes", worker_count)
+        while True:
+            try:
+                supervisor.check_workers()
+                sleep(1)
+            except KeyboardInterrupt:
+                self._logger.warning("quitting, stopping workers")
+                supervisor.stop_workers()
+                quit()
+
+    def _run_worker(self, worker_index, partition):
+        # entry point of worker process, rollup engine is run by the first worker
+        self._logger = logging.getLogger("daemon-worker-{0}".format(worker_index))
+        self._poller_threads = []
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self._connect()
+        self._load_probes()
+        self._start_polling(partition)
+        if worker_index == 0:
+            self._start_rollup()
+        self._wait()
+
+    def _connect(self):
         mc = MongoClient(self._config.get("database", "host"), self._config.getint("database", "port"))
         self._logger.debug("connected to MongoDB at %r, %r", self._config.get("database", "host"),
                            self._config.getint("database", "port"))
@@ -65,45 +115,103 @@ class NetPadDaemon():
                                   self._config.get("database", "mongodb-auth-password"))
             self._logger.debug("authenticated against MongoDB")
 
-        # import available probes
-        probes_path = self._config.get("monitor", "probe-path")
-        probe_files = [f for f in listdir(probes_path) if isfile(join(probes_path, f))]
-        probe_modules = []
-        for probe_file in probe_files:
-            if probe_file.startswith("probe_") and probe_file.endswith(".py"):
-                probe_class_name = probes_path.replace("/", ".") + "." + probe_file.replace(".py", "")
-                probe_modules.append(importlib.import_module(probe_class_name))
-                self._logger.debug("importing probe " + probe_class_name)
-        for module in probe_modules:
-            self._logger.info("imported probe " + module.get_probe_name() +
-                              " (" + module.get_probe_description() + ") v" + module.get_probe_version())
+    def _load_probes(self):
+        # import available probes, one long-lived instance of every probe is shared by all pollers
+        self._probes = ProbeRegistry(self._config, self._db)
+        self._probes.load(self._config.get("monitor", "probe-path"))
+        self._probes.setup()
 
+    def _start_polling(self, partition):
         # create polling queue
         poll_queue = Queue(self._config.getint("monitor", "queue-max-size"))
         self._logger.debug("created device polling queue, maxsize=%d", poll_queue.maxsize)
 
+        # poll results are written to database in batches by result writer
+        storage_layouts = create_layouts(self._db, self._get_monitor_option("storage-layout", "document"),
+                                         int(self._get_monitor_option("metric-bucket-size", 120)))
+        result_writer = ResultWriter(storage_layouts, int(self._get_monitor_option("result-buffer-size", 10000)),
+                                     int(self._get_monitor_option("result-batch-size", 500)),
+                                     float(self._get_monitor_option("result-flush-interval", 2)),
+                                     float(self._get_monitor_option("result-put-timeout", 30)))
+        result_writer.setDaemon(True)
+        result_writer.start()
+
+        # device documents are handed from planner to pollers through the queue and shared device cache
+        device_cache = DeviceCache()
+
         # start device poller threads
         polling_thread_count = self._config.getint("monitor", "threads")
-        for i in range(0, polling_thread_count):
-            poller = DevicePoller(i, self._config, self._db, probe_modules, poll_queue)
+        if self._get_monitor_option("engine", "threaded") == "event":
+            poller = EventDevicePoller(0, self._config, self._db, self._probes, poll_queue, device_cache,
+                                       result_writer, int(self._get_monitor_option("max-concurrent-polls", 1000)),
+                                       polling_thread_count)
             poller.setDaemon(True)
             poller.start()
             self._poller_threads.append(poller)
-        self._logger.debug("started %d device polling threads", polling_thread_count)
+            self._logger.debug("started event device poller with %d executor threads", polling_thread_count)
+        else:
+            for i in range(0, polling_thread_count):
+                poller = DevicePoller(i, self._config, self._db, self._probes, poll_queue, device_cache,
+                                      result_writer)
+                poller.setDaemon(True)
+                poller.start()
+                self._poller_threads.append(poller)
+            self._logger.debug("started %d device polling threads", polling_thread_count)
 
         # start polling planner
-        self._planner = PollingPlanner(self._config, self._db, poll_queue)
+        self._start_cluster()
+        self._planner = PollingPlanner(self._config, self._db, poll_queue, device_cache, self._probes, partition,
+                                       self._leases)
         self._planner.setDaemon(True)
         self._planner.start()
 
+    def _start_cluster(self):
+        # devices are shared with other nodes by leases, every worker process is a separate node
+        if not self._config.has_section("cluster") or self._config.getboolean("cluster", "enabled") is not True:
+            return
+        node_name = self._get_cluster_option("node-name", None)
+        self._leases = LeaseManager(self._db, get_node_id(node_name), int(self._get_cluster_option("lease-time", 30)),
+                                    int(self._get_cluster_option("heartbeat-interval", 10)))
+        self._leases.ensure_indexes()
+        self._leases.setDaemon(True)
+        self._leases.start()
+
+    def _start_rollup(self):
+        if self._config.has_section("rollup") and self._config.getboolean("rollup", "enabled") is True:
+            retention = dict((tier, int(self._config.getfloat("rollup", tier + "-retention-days") * 86400))
+                             for tier in ("raw", "5m", "1h"))
+            self._rollup = RollupEngine(self._db, self._probes, self._config.getint("rollup", "interval"),
+                                        self._config.getint("rollup", "grace-period"), retention,
+                                        self._get_monitor_option("storage-layout", "document"))
+            self._rollup.setDaemon(True)
+            self._rollup.start()
+
+    def _wait(self):
         while True:
             try:
                 sleep(1)
             except KeyboardInterrupt:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
                 self._logger.warning("quitting")
+                self._probes.teardown()
+                if self._leases is not None:
+                    self._leases.release_all()
                 sleep(1)
                 quit()
 
+    def _get_monitor_option(self, option, default):
+        try:
+            return self._config.get("monitor", option)
+        except ConfigParser.NoOptionError:
+            return default
+
+    def _get_cluster_option(self, option, default):
+        try:
+            return self._config.get("cluster", option)
+        except ConfigParser.NoOptionError:
+            return default
+
 
 def _process_error(message, e):
     msg = "[ERROR] " + message
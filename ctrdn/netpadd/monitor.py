@@ -1,14 +1,18 @@
 from abc import abstractmethod
+from calendar import timegm
 from datetime import datetime
+from functools import partial
 import logging
-import os
 import threading
-from ConfigParser import ConfigParser
+from ConfigParser import ConfigParser, NoOptionError
 from Queue import Queue
 import time
+from pymongo import UpdateOne
 from pymongo.database import Database
 
 from ctrdn.netpadd.constants import NetPadConstants
+from ctrdn.netpadd.normalizer import ConfigNormalizer
+from ctrdn.netpadd.scheduler import PollScheduler, PlannerStatePersister
 
 __author__ = 'Lubomir Kaplan <castor@castor.sk>'
 
@@ -25,26 +29,93 @@ class DeviceProbe:
         self._config = config
         """:type : ConfigParser"""
 
+    def setup(self):
+        # called once in every process before the first poll, probe instances are shared by all pollers and polls
+        pass
+
+    def teardown(self):
+        pass
+
+    def forget_device(self, device_id):
+        # called when device is no longer planned by this process, state kept by probe for the device can be dropped
+        pass
+
+    def resolve_configuration(self, probe_config):
+        # probe configuration with references (e.g. to templates) replaced, as used for polling and metrics
+        return probe_config
+
     @abstractmethod
     def poll_device(self, device, probe_name, probe_config):
         return None
 
+    def supports_async_poll(self):
+        return False
+
+    def poll_device_async(self, device, probe_name, probe_config, callback):
+        # asynchronous probes must call callback with the probe result exactly once, from any thread, and must not
+        # block the calling thread while waiting for the network
+        raise NotImplementedError("probe does not support asynchronous polling")
+
     @abstractmethod
     def validate_configuration(self, device, probe_config):
         return True
 
 
+class DeviceCache(object):
+    _devices = None
+    _lock = None
+
+    def __init__(self):
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_revision(device):
+        return device.get("Revision", 0)
+
+    def get(self, device_id):
+        with self._lock:
+            return self._devices.get(device_id)
+
+    def store(self, device):
+        # documents with lower revision than cached one are stale reads, they are ignored
+        with self._lock:
+            cached = self._devices.get(device["_id"])
+            if cached is None or self.get_revision(device) >= self.get_revision(cached):
+                self._devices[device["_id"]] = device
+                return device
+            return cached
+
+    def resolve(self, device):
+        with self._lock:
+            cached = self._devices.get(device["_id"])
+            if cached is not None and self.get_revision(cached) > self.get_revision(device):
+                return cached
+            return device
+
+    def remove(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+
 class DevicePoller(threading.Thread):
     _logger = None
     _thread_id = None
     _poll_queue = None
+    _device_cache = None
+    _result_writer = None
     _probes = None
     _db = None
     _config = None
 
-    def __init__(self, thread_id, config, db, probes, poll_queue):
+    def __init__(self, thread_id, config, db, probes, poll_queue, device_cache, result_writer):
         threading.Thread.__init__(self)
         self._probes = probes
+        """:type : ProbeRegistry"""
+        self._device_cache = device_cache
+        """:type : DeviceCache"""
+        self._result_writer = result_writer
+        """:type : ResultWriter"""
 
         self._thread_id = thread_id
         self._logger = logging.getLogger("poller-{0}".format(self._thread_id))
@@ -63,18 +134,13 @@ class DevicePoller(threading.Thread):
         assert 0 <= self._thread_id < NetPadConstants.MONITOR_MAX_POLLER_THREADS, "invalid thread id"
 
     def run(self):
-        pid = os.fork()
-        if pid == 0:
-            self._logger.debug("started device poller thread, id=%d", self._thread_id)
-        else:
-            logging.getLogger("threading").debug("started device poller thread, pid=%d", pid)
+        self._logger.debug("started device poller thread, id=%d", self._thread_id)
 
         got_task = False
         while True:
             while not self._poll_queue.empty():
-                device_id = self._poll_queue.get()
+                device = self._device_cache.resolve(self._poll_queue.get())
                 got_task = True
-                device = self._db.np.core.device.find_one(dict(_id=device_id))
                 self._poll_device(device)
                 self._poll_queue.task_done()
             if got_task:
@@ -86,56 +152,209 @@ class DevicePoller(threading.Thread):
         self._logger.info("polling device %s", device["_id"])
         device_time_start = time.time()
         probe_stats_dict = {}
-        probe_result_dict = {}
         for probe_name, probe_config in device["MonitorConfiguration"]["Probes"].iteritems():
-            probe_module = None
-            for module in self._probes:
-                if module.get_probe_name() == probe_name:
-                    probe_module = module
-                    break
+            probe_module = self._get_probe_module(probe_name)
 
             if not probe_module:
                 self._logger.error("unknown probe %s", probe_name)
             else:
                 # start polling with probe
                 poll_start_time = time.time()
-                probe_instance = probe_module.Probe(self._config, self._db)
+                probe_instance = self._probes.get_probe(probe_name)
                 """:type : DeviceProbe"""
 
-                # validate configuration for specific probe
-                check_result = probe_instance.validate_configuration(device, probe_config)
-                if not check_result is None:
-                    probe_config = check_result
-                    device["MonitorConfiguration"]["Probes"][probe_name] = probe_config
-                    self._db.np.core.device.update(
-                        dict(_id=device["_id"]),
-                        {"$set": dict(MonitorConfiguration=device["MonitorConfiguration"])})
-
-                # perform probing itself
-                result = probe_instance.poll_device(device, probe_name, probe_config)
-                probe_result_dict[probe_name] = result
+                # configuration was normalized by planner, perform probing itself
+                try:
+                    result = probe_instance.poll_device(device, probe_name, probe_config)
+                except Exception as e:
+                    self._logger.exception("probe %s failed for device %s", probe_name, device["_id"])
+                    result = dict(Status=0, Error=dict(Id="PROBE_EXCEPTION", Message=str(e)))
                 poll_end_time = time.time()
 
                 probe_stats = dict(Probe=probe_name, ExecutionTime=poll_end_time - poll_start_time, Result=result)
                 probe_stats_dict[probe_name] = probe_stats
 
-        device_time_end = time.time()
+        self._store_poll_result(device, device_time_start, time.time(), probe_stats_dict)
+
+    def _get_probe_module(self, probe_name):
+        return self._probes.get_module(probe_name)
+
+    def _store_poll_result(self, device, device_time_start, device_time_end, probe_stats_dict):
         device_poll_result = dict(DeviceId=device["_id"], PollerThreadId=self._thread_id,
                                   PollTimestamp=datetime.utcfromtimestamp(device_time_start),
                                   ExecutionTime=device_time_end - device_time_start,
                                   ProbeResult=probe_stats_dict)
-        self._db.np.monitor.poll.insert(device_poll_result)
+
+        metrics = None
+        if self._result_writer.requires_metrics():
+            metrics = []
+            for probe_name, probe_stats in probe_stats_dict.iteritems():
+                probe_module = self._get_probe_module(probe_name)
+                if not hasattr(probe_module, "get_probe_metrics") or probe_stats["Result"] is None:
+                    continue
+                probe_config = self._probes.get_probe(probe_name).resolve_configuration(
+                    device["MonitorConfiguration"]["Probes"][probe_name])
+                for metric, instance, value in probe_module.get_probe_metrics(probe_config, probe_stats["Result"]):
+                    metrics.append((probe_name + "." + metric, instance, value))
+        self._result_writer.write(device_poll_result, metrics)
+
+
+class ProbeExecutor(object):
+    _logger = None
+    _task_queue = None
+    _threads = None
+
+    def __init__(self, name, thread_count):
+        self._logger = logging.getLogger(name)
+        self._task_queue = Queue()
+        self._threads = []
+        for i in range(0, thread_count):
+            thread = threading.Thread(target=self._run_tasks, name="{0}-{1}".format(name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        self._logger.debug("started %d executor threads", thread_count)
+
+    def submit(self, task, *args):
+        self._task_queue.put((task, args))
+
+    def _run_tasks(self):
+        while True:
+            task, args = self._task_queue.get()
+            try:
+                task(*args)
+            except Exception:
+                self._logger.exception("executor task failed")
+
+
+class EventDevicePoller(DevicePoller):
+    _executor = None
+    _poll_slots = None
+    _max_concurrent_polls = None
+
+    def __init__(self, thread_id, config, db, probes, poll_queue, device_cache, result_writer, max_concurrent_polls,
+                 executor_threads):
+        DevicePoller.__init__(self, thread_id, config, db, probes, poll_queue, device_cache, result_writer)
+        self._logger = logging.getLogger("event-poller-{0}".format(self._thread_id))
+        self._max_concurrent_polls = max_concurrent_polls
+        self._poll_slots = threading.Semaphore(max_concurrent_polls)
+        self._executor = ProbeExecutor("probe-executor-{0}".format(self._thread_id), executor_threads)
+        """:type : ProbeExecutor"""
+
+    def run(self):
+        self._logger.debug("started event device poller, max concurrent polls=%d", self._max_concurrent_polls)
+        while True:
+            self._poll_slots.acquire()
+            device = self._poll_queue.get()
+            self._executor.submit(DevicePollJob(self, device).start)
+
+    def _poll_finished(self):
+        self._poll_slots.release()
+        self._poll_queue.task_done()
+
+
+class DevicePollJob(object):
+    _poller = None
+    _device_id = None
+    _device = None
+    _device_time_start = None
+    _probe_stats_dict = None
+    _remaining = 0
+    _lock = None
+
+    def __init__(self, poller, device):
+        self._poller = poller
+        """:type : EventDevicePoller"""
+        self._device = device
+        self._device_id = device["_id"]
+        self._probe_stats_dict = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        poller = self._poller
+        try:
+            self._device = poller._device_cache.resolve(self._device)
+            poller._logger.info("polling device %s", self._device_id)
+            self._device_time_start = time.time()
+
+            probe_list = []
+            for probe_name, probe_config in self._device["MonitorConfiguration"]["Probes"].iteritems():
+                probe_module = poller._get_probe_module(probe_name)
+                if not probe_module:
+                    poller._logger.error("unknown probe %s", probe_name)
+                    continue
+                probe_instance = poller._probes.get_probe(probe_name)
+                """:type : DeviceProbe"""
+                probe_list.append((probe_name, probe_instance, probe_config))
+        except Exception:
+            poller._logger.exception("failed to prepare polling of device %s", self._device_id)
+            poller._poll_finished()
+            return
+
+        self._remaining = len(probe_list)
+        if self._remaining == 0:
+            poller._executor.submit(self._finish)
+            return
+
+        for probe_name, probe_instance, probe_config in probe_list:
+            callback = partial(self._probe_done, probe_name, time.time())
+            if probe_instance.supports_async_poll():
+                try:
+                    probe_instance.poll_device_async(self._device, probe_name, probe_config, callback)
+                except Exception as e:
+                    # probe which failed before starting its poll never calls back, job must still finish
+                    poller._logger.exception("probe %s failed for device %s", probe_name, self._device_id)
+                    callback(dict(Status=0, Error=dict(Id="PROBE_EXCEPTION", Message=str(e))))
+            else:
+                # synchronous probes are adapted by running them on executor threads
+                poller._executor.submit(self._run_sync_probe, probe_instance, probe_name, probe_config, callback)
+
+    def _run_sync_probe(self, probe_instance, probe_name, probe_config, callback):
+        try:
+            result = probe_instance.poll_device(self._device, probe_name, probe_config)
+        except Exception as e:
+            self._poller._logger.exception("probe %s failed for device %s", probe_name, self._device_id)
+            result = dict(Status=0, Error=dict(Id="PROBE_EXCEPTION", Message=str(e)))
+        callback(result)
+
+    def _probe_done(self, probe_name, poll_start_time, result):
+        with self._lock:
+            self._probe_stats_dict[probe_name] = dict(Probe=probe_name, ExecutionTime=time.time() - poll_start_time,
+                                                      Result=result)
+            self._remaining -= 1
+            finished = self._remaining == 0
+
+        if finished:
+            # callbacks may come from network service threads, storing is moved away from them
+            self._poller._executor.submit(self._finish)
+
+    def _finish(self):
+        try:
+            self._poller._store_poll_result(self._device, self._device_time_start, time.time(),
+                                            self._probe_stats_dict)
+        finally:
+            self._poller._poll_finished()
 
 
 class PollingPlanner(threading.Thread):
     _config = None
     _db = None
     _default_poll_interval = None
-    _default_probes = {}
+    _default_probes = None
+    _normalizer = None
+    _partition = None
+    _leases = None
     _poll_queue = None
+    _device_cache = None
+    _probes = None
+    _planner_mode = "scan"
+    _refresh_interval = 60
+    _persist_interval = NetPadConstants.MONITOR_PLANNER_SLEEP_TIME
+    _scheduler = None
+    _persister = None
     _logger = logging.getLogger("planner")
 
-    def __init__(self, config, db, poll_queue):
+    def __init__(self, config, db, poll_queue, device_cache, probes, partition=None, leases=None):
         threading.Thread.__init__(self)
         assert isinstance(config, ConfigParser), "config is not instance of ConfigParser"
         assert isinstance(poll_queue, Queue), "poll_queue is not instance of Queue"
@@ -147,6 +366,16 @@ class PollingPlanner(threading.Thread):
         """:type : Database"""
         self._poll_queue = poll_queue
         """:type : Queue"""
+        self._device_cache = device_cache
+        """:type : DeviceCache"""
+        self._probes = probes
+        """:type : ProbeRegistry"""
+        # worker process plans only devices of its partition, all devices are planned without partition
+        self._partition = partition
+        """:type : DevicePartition"""
+        # in cluster mode every poll slot is claimed first, devices leased by other nodes are not enqueued
+        self._leases = leases
+        """:type : LeaseManager"""
 
         assert self._config.get("monitor", "default-poll-interval"), "default-poll-interval not configured"
         self._default_poll_interval = self._config.getint("monitor", "default-poll-interval")
@@ -155,56 +384,167 @@ class PollingPlanner(threading.Thread):
         assert self._config.get("monitor", "default-probes"), "default-probes not configured"
         default_probes_string = self._config.get("monitor", "default-probes")
         default_probes_list = default_probes_string.split(",")
+        self._default_probes = {}
         for default_probe in default_probes_list:
             self._default_probes[default_probe.strip()] = {}
         self._logger.debug("set default probes %s", self._default_probes)
 
+        try:
+            self._planner_mode = self._config.get("monitor", "planner")
+        except NoOptionError:
+            self._logger.debug("no planner option in configuration, assuming scan")
+        try:
+            self._refresh_interval = self._config.getint("monitor", "planner-refresh-interval")
+        except NoOptionError:
+            self._logger.debug("no planner-refresh-interval option in configuration, assuming %ds",
+                               self._refresh_interval)
+        try:
+            self._persist_interval = self._config.getint("monitor", "planner-persist-interval")
+        except NoOptionError:
+            self._logger.debug("no planner-persist-interval option in configuration, assuming %ds",
+                               self._persist_interval)
+        assert self._planner_mode in ("scan", "heap"), "%r is not supported planner" % self._planner_mode
+        self._normalizer = ConfigNormalizer(probes, self._default_poll_interval, self._default_probes)
+
         self._logger.debug("polling planner initialized")
 
-    def check_device_monitor_config(self, device):
-        update_monitor_config = False
-        if not "MonitorConfiguration" in device:
-            self._logger.warn("no monitor configuration for %s", device["_id"])
-            monitor_config = dict(PollInterval=self._default_poll_interval, Probes=self._default_probes)
-            update_monitor_config = True
-        else:
-            monitor_config = device["MonitorConfiguration"]
-            if not "PollInterval" in monitor_config:
-                self._logger.warn("no poll interval configuration for %s", device["_id"])
-                monitor_config["PollInterval"] = self._default_poll_interval
-                update_monitor_config = True
-            if not "Probes" in monitor_config:
-                self._logger.warn("no probes configuration for %s", device["_id"])
-                monitor_config["Probes"] = self._default_probes
-                update_monitor_config = True
-
-        if update_monitor_config is True:
-            self._db.np.core.device.update(dict(_id=device["_id"]), {"$set": {"MonitorConfiguration": monitor_config}})
-            self._logger.warn("fixed-up monitor config for device %s", device["_id"])
-            return self._db.np.core.device.find_one(dict(_id=device["_id"]))
-
-        return device
+    def _find_devices(self):
+        # worker process reads ids of all monitored devices first, full documents only of devices it owns
+        query = {"MonitorEnabled": True}
+        if self._partition is not None:
+            device_ids = [device["_id"] for device in self._db.np.core.device.find(query, {"_id": 1})
+                          if self._partition.contains(device["_id"])]
+            query = {"_id": {"$in": device_ids}, "MonitorEnabled": True}
+        return self._db.np.core.device.find(query)
+
+    def _store_device(self, device, normalize_requests):
+        # only devices added or changed since the last normalization are validated
+        if not self._normalizer.is_current(device):
+            normalize_requests.append(self._normalizer.normalize(device))
+        return self._device_cache.store(device)
+
+    def _claim(self, device):
+        return self._leases is None or self._leases.claim(device["_id"], device["MonitorConfiguration"]["PollInterval"])
+
+    def _forget_device(self, device_id):
+        self._logger.debug("device %s is no longer monitored by this planner", device_id)
+        self._device_cache.remove(device_id)
+        if self._leases is not None:
+            self._leases.forget(device_id)
+        self._probes.forget_device(device_id)
+
+    def _get_planner_records(self, device_ids):
+        # planner records of other partitions are not read
+        query = {} if self._partition is None else {"DeviceId": {"$in": device_ids}}
+        return dict((record["DeviceId"], record) for record in self._db.np.monitor.planner.find(
+            query, {"DeviceId": 1, "LastEnqueueTimestamp": 1}))
+
+    def _write_normalized(self, normalize_requests):
+        if len(normalize_requests) > 0:
+            self._db.np.core.device.bulk_write(normalize_requests, ordered=False)
+            self._logger.info("normalized monitor configuration of %d devices", len(normalize_requests))
 
     def run(self):
-        self._logger.info("starting polling planner")
+        self._logger.info("starting polling planner, mode=%s", self._planner_mode)
+        self._normalizer.normalize_devices(self._db, self._find_devices())
+        if self._planner_mode == "heap":
+            self._run_heap()
+        else:
+            self._run_scan()
+
+    def _run_scan(self):
+        planned_ids = set()
         while True:
-            device_list = self._db.np.core.device.find({"MonitorEnabled": True})
+            device_list = list(self._find_devices())
+            planner_records = self._get_planner_records([device["_id"] for device in device_list])
+            planner_requests = []
+            normalize_requests = []
+            device_ids = set()
             for device in device_list:
-                device = self.check_device_monitor_config(device)
-                planner_record = self._db.np.monitor.planner.find_one({"DeviceId": device["_id"]})
-                force_enqueue = False
-                if not planner_record:
-                    record_id = self._db.np.monitor.planner.insert(
-                        dict(DeviceId=device["_id"], LastEnqueueTimestamp=datetime.utcnow()))
-                    planner_record = self._db.np.monitor.planner.find_one(dict(_id=record_id))
-                    force_enqueue = True
-                delta = datetime.utcnow() - planner_record["LastEnqueueTimestamp"]
-                if force_enqueue is True or delta.total_seconds() >= device["MonitorConfiguration"]["PollInterval"]:
+                device = self._store_device(device, normalize_requests)
+                device_ids.add(device["_id"])
+                planner_record = planner_records.get(device["_id"])
+                delta = None if not planner_record else datetime.utcnow() - planner_record["LastEnqueueTimestamp"]
+                if delta is None or delta.total_seconds() >= device["MonitorConfiguration"]["PollInterval"]:
+                    if not self._claim(device):
+                        continue
                     self._logger.debug("enqueuing device %s(%s), delta=%ds",
                                        device['_id'],
-                                       device['Hostname'], delta.total_seconds())
-                    self._poll_queue.put(device["_id"])
-                    self._db.np.monitor.planner.update(dict(DeviceId=device["_id"]),
-                                                       {"$set": {"LastEnqueueTimestamp": datetime.utcnow()}})
-
-            time.sleep(NetPadConstants.MONITOR_PLANNER_SLEEP_TIME)
\ No newline at end of file
+                                       device['Hostname'], 0 if delta is None else delta.total_seconds())
+                    self._poll_queue.put(device)
+                    if self._leases is None:
+                        # claim of the slot already stored the enqueue timestamp
+                        planner_requests.append(UpdateOne(dict(DeviceId=device["_id"]),
+                                                          {"$set": {"LastEnqueueTimestamp": datetime.utcnow()}},
+                                                          upsert=True))
+
+            self._write_normalized(normalize_requests)
+            for device_id in planned_ids.difference(device_ids):
+                self._forget_device(device_id)
+            planned_ids = device_ids
+
+            # new planner records and enqueue timestamps are written in one round trip
+            if len(planner_requests) > 0:
+                self._db.np.monitor.planner.bulk_write(planner_requests, ordered=False)
+
+            time.sleep(NetPadConstants.MONITOR_PLANNER_SLEEP_TIME)
+
+    def _run_heap(self):
+        self._scheduler = PollScheduler()
+        self._persister = PlannerStatePersister(self._db, self._persist_interval)
+        self._persister.setDaemon(True)
+        self._persister.start()
+
+        next_refresh_time = 0
+        while True:
+            if time.time() >= next_refresh_time:
+                self._refresh_schedule()
+                statistics = self._scheduler.get_statistics(reset=True)
+                self._logger.info("schedule statistics: devices=%d, enqueued=%d, lag avg=%.3fs, max=%.3fs",
+                                  statistics["Devices"], statistics["Enqueued"], statistics["LagAverage"],
+                                  statistics["LagMax"])
+                next_refresh_time = time.time() + self._refresh_interval
+
+            for device_id, due_time in self._scheduler.pop_due(time.time()):
+                device = self._device_cache.get(device_id)
+                if device is None or not self._claim(device):
+                    continue
+                self._logger.debug("enqueuing device %s, lag=%.3fs", device_id, time.time() - due_time)
+                self._poll_queue.put(device)
+                if self._leases is None:
+                    self._persister.record_enqueue(device_id, datetime.utcnow())
+
+            # sleep exactly until the next deadline (or schedule refresh)
+            next_due_time = self._scheduler.next_due_time()
+            wakeup_time = next_refresh_time if next_due_time is None else min(next_due_time, next_refresh_time)
+            sleep_time = wakeup_time - time.time()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+
+    def _refresh_schedule(self):
+        device_list = list(self._find_devices())
+        planner_records = self._get_planner_records([device["_id"] for device in device_list])
+        device_ids = set()
+        normalize_requests = []
+        for device in device_list:
+            device = self._store_device(device, normalize_requests)
+            device_ids.add(device["_id"])
+            poll_interval = device["MonitorConfiguration"]["PollInterval"]
+            scheduled_interval = self._scheduler.get_interval(device["_id"])
+            if scheduled_interval is None:
+                if device["_id"] in planner_records:
+                    last_enqueue = planner_records[device["_id"]]["LastEnqueueTimestamp"]
+                    due_time = timegm(last_enqueue.utctimetuple()) + last_enqueue.microsecond / 1e6 + poll_interval
+                else:
+                    due_time = time.time()
+                self._scheduler.schedule(device["_id"], poll_interval, due_time)
+            elif scheduled_interval != poll_interval:
+                self._logger.debug("poll interval of device %s changed to %ds", device["_id"], poll_interval)
+                due_time = self._scheduler.get_due_time(device["_id"]) - scheduled_interval + poll_interval
+                self._scheduler.schedule(device["_id"], poll_interval, due_time)
+        self._write_normalized(normalize_requests)
+
+        for device_id in self._scheduler.get_device_ids():
+            if not device_id in device_ids:
+                self._scheduler.remove(device_id)
+                self._forget_device(device_id)
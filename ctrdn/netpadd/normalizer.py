@@ -0,0 +1,88 @@
+from copy import deepcopy
+import logging
+from pymongo import UpdateOne
+
+from ctrdn.netpadd.constants import NetPadConstants
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+VERSION_FIELD = "MonitorConfigurationVersion"
+REVISION_FIELD = "MonitorConfigurationRevision"
+
+
+class ConfigNormalizer(object):
+    """
+    Fills in defaults of device monitor configuration and of configurations of its probes, and stamps the device with
+    current configuration version and with its revision after normalization. Devices already stamped are polled without
+    any validation, new devices and devices whose Revision changed since (after editing their configuration) are
+    normalized again.
+    """
+    _logger = logging.getLogger("config-normalizer")
+    _probes = None
+    _default_poll_interval = None
+    _default_probes = None
+
+    def __init__(self, probes, default_poll_interval, default_probes):
+        self._probes = probes
+        """:type : ProbeRegistry"""
+        self._default_poll_interval = default_poll_interval
+        self._default_probes = default_probes
+
+    @staticmethod
+    def is_current(device):
+        return device.get(VERSION_FIELD) == NetPadConstants.MONITOR_CONFIGURATION_VERSION and \
+            device.get(REVISION_FIELD) == device.get("Revision", 0)
+
+    def normalize(self, device):
+        """
+        Normalize device document in place and return update request writing it back, revision of the device is
+        incremented so cached copies of the old document are replaced.
+        """
+        if not "MonitorConfiguration" in device:
+            self._logger.warn("no monitor configuration for %s", device["_id"])
+            device["MonitorConfiguration"] = {}
+        monitor_config = device["MonitorConfiguration"]
+        if not "PollInterval" in monitor_config:
+            self._logger.warn("no poll interval configuration for %s", device["_id"])
+            monitor_config["PollInterval"] = self._default_poll_interval
+        if not "Probes" in monitor_config:
+            self._logger.warn("no probes configuration for %s", device["_id"])
+            monitor_config["Probes"] = deepcopy(self._default_probes)
+
+        for probe_name, probe_config in monitor_config["Probes"].items():
+            probe = self._probes.get_probe(probe_name)
+            if probe is None:
+                self._logger.error("unknown probe %s in configuration of device %s", probe_name, device["_id"])
+                continue
+            check_result = probe.validate_configuration(device, probe_config)
+            if not check_result is None:
+                monitor_config["Probes"][probe_name] = check_result
+
+        device[VERSION_FIELD] = NetPadConstants.MONITOR_CONFIGURATION_VERSION
+        device["Revision"] = device.get("Revision", 0) + 1
+        # device edited concurrently gets higher Revision than the stamped one, so it is normalized again
+        device[REVISION_FIELD] = device["Revision"]
+        self._logger.debug("normalized monitor configuration of device %s", device["_id"])
+        return UpdateOne(dict(_id=device["_id"]), {"$set": {"MonitorConfiguration": monitor_config,
+                                                            VERSION_FIELD: device[VERSION_FIELD],
+                                                            REVISION_FIELD: device[REVISION_FIELD]},
+                                                   "$inc": {"Revision": 1}})
+
+    def normalize_devices(self, db, devices, batch_size=500):
+        # startup pass, devices not stamped with current version and revision are normalized in batches, stamped
+        # revision is compared with Revision of the device here as query can not compare two fields
+        requests = []
+        count = 0
+        for device in devices:
+            if self.is_current(device):
+                continue
+            requests.append(self.normalize(device))
+            if len(requests) >= batch_size:
+                db.np.core.device.bulk_write(requests, ordered=False)
+                count += len(requests)
+                requests = []
+        if len(requests) > 0:
+            db.np.core.device.bulk_write(requests, ordered=False)
+            count += len(requests)
+        self._logger.info("normalized monitor configuration of %d devices, version=%d", count,
+                          NetPadConstants.MONITOR_CONFIGURATION_VERSION)
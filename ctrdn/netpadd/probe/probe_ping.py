@@ -1,6 +1,9 @@
-import time
+from ConfigParser import NoOptionError
+from functools import partial
+import socket
+import threading
 from ctrdn.netpadd.monitor import DeviceProbe
-from ctrdn.netpadd.probe.util import ping
+from ctrdn.netpadd.probe.util import icmp
 
 __author__ = 'Lubomir Kaplan <castor@castor.sk>'
 
@@ -9,6 +12,8 @@ class Probe(DeviceProbe):
     _default_count = None
     _default_timeout = None
     _default_address = None
+    _default_mode = "sequential"
+    _default_interval = 0.0
 
     def __init__(self, config, db):
         DeviceProbe.__init__(self, config, db, "probe-ping")
@@ -20,42 +25,61 @@ class Probe(DeviceProbe):
         self._default_timeout = self._config.getint("probe_ping", "default-timeout")
         self._default_address = self._config.get("probe_ping", "default-address")
 
+        try:
+            self._default_mode = self._config.get("probe_ping", "default-mode")
+        except NoOptionError:
+            self._logger.debug("no default-mode option in configuration, assuming sequential")
+        try:
+            self._default_interval = self._config.getfloat("probe_ping", "default-interval")
+        except NoOptionError:
+            self._logger.debug("no default-interval option in configuration, assuming 0")
+
+    def supports_async_poll(self):
+        return True
+
     def poll_device(self, device, probe_name, probe_config):
-        ip_result_list = []
+        result_holder = []
+        poll_done = threading.Event()
+
+        def _poll_done(result):
+            result_holder.append(result)
+            poll_done.set()
+
+        self.poll_device_async(device, probe_name, probe_config, _poll_done)
+        while not poll_done.is_set():
+            poll_done.wait(1)
+        return result_holder[0]
+
+    def poll_device_async(self, device, probe_name, probe_config, callback):
+        address_list = []
         if probe_config["PingAddress"] == "all":
             for address_index, address in enumerate(device["IpAddress"]):
-                ip_result_list.append(self._perform_ping(address, device, probe_config))
+                address_list.append(address)
         elif type(probe_config["PingAddress"]) == list:
             for address_index, address in enumerate(probe_config["PingAddress"]):
                 address = device["IpAddress"][address_index]
-                ip_result_list.append(self._perform_ping(address, device, probe_config))
+                address_list.append(address)
         else:
             self._logger.error("invalid configuration for device %s", device["_id"])
 
-        return dict(PerAddress=ip_result_list)
-
-    def _perform_ping(self, address, device, probe_config):
-        if address["Version"] == 4:
-            result = self._perform_ipv4_ping(address["Address"], probe_config["PingCount"], probe_config["PingTimeout"])
-        else:
-            self._logger.error("unsupported address version %d for ping probe, device=%s", address["Version"],
-                               device["_id"])
-            result = dict(Status=0, Error=dict(Id="UNSUPPORTED_ADDRESS_VERSION",
-                                               Message="Unsupported address version " + str(address["Version"])))
+        try:
+            icmp_service = icmp.get_service()
+        except socket.error as e:
+            self._logger.error("unable to start icmp service: %s", e)
+            callback(dict(PerAddress=[dict(Status=0, Address=ping_address,
+                                           Error=dict(Id="ICMP_SOCKET_ERROR", Message=str(e)))
+                                      for ping_address in address_list]))
+            return
 
-        result["Address"] = address
-        return result
+        _PingJob(self, icmp_service, device, address_list, probe_config, callback).start()
 
-    def _perform_ipv4_ping(self, host, count, timeout):
-        result_list = []
-        start_time = time.time()
-
-        # perform pings
-        for i in range(0, count):
-            result = ping.do_one(host, timeout)
-            result_list.append(result)
-        end_time = time.time()
+    def _unsupported_address_result(self, address, device):
+        self._logger.error("unsupported address version %d for ping probe, device=%s", address["Version"],
+                           device["_id"])
+        return dict(Status=0, Error=dict(Id="UNSUPPORTED_ADDRESS_VERSION",
+                                         Message="Unsupported address version " + str(address["Version"])))
 
+    def _process_ping_results(self, host, count, result_list, execution_time):
         # calculate min time, max time, avg time
         pt_min = None
         pt_max = None
@@ -70,10 +94,10 @@ class Probe(DeviceProbe):
             pt_avg_count += 1
         pt_avg = 0 if pt_avg_count == 0 else pt_avg_sum/pt_avg_count
 
-        ping_result = dict(ExecutionTime=end_time-start_time, PingTimes=result_list,
+        ping_result = dict(ExecutionTime=execution_time, PingTimes=result_list,
                            Max=pt_max, Min=pt_min, Average=pt_avg)
         self._logger.debug("processed pings for address=%s, count=%d/%d, time=%f",
-                           host, pt_avg_count, count, end_time-start_time)
+                           host, pt_avg_count, count, execution_time)
         if pt_avg_count < 1:
             return dict(Status=0, Error=dict(Id="NO_RESPONSES_RECEIVED", Message="no responses received"))
         else:
@@ -93,6 +117,14 @@ class Probe(DeviceProbe):
             self._logger.warn("no PingAddress in ping probe configuration for device %s", device["_id"])
             probe_config["PingAddress"] = self._default_address
             update_config = True
+        if not "PingMode" in probe_config:
+            self._logger.warn("no PingMode in ping probe configuration for device %s", device["_id"])
+            probe_config["PingMode"] = self._default_mode
+            update_config = True
+        if not "PingInterval" in probe_config:
+            self._logger.warn("no PingInterval in ping probe configuration for device %s", device["_id"])
+            probe_config["PingInterval"] = self._default_interval
+            update_config = True
 
         if update_config is True:
             self._logger.warn("fixed ping probe configuration for device %s", device["_id"])
@@ -101,6 +133,116 @@ class Probe(DeviceProbe):
         return None
 
 
+class _PingJob(object):
+    _probe = None
+    _icmp_service = None
+    _device = None
+    _address_list = None
+    _count = None
+    _timeout = None
+    _interval = None
+    _pipelined = False
+    _callback = None
+    _lock = None
+    _results = None
+    _remaining = 0
+    _sequence = None
+    _first_sent = None
+    _last_completed = None
+
+    def __init__(self, probe, icmp_service, device, address_list, probe_config, callback):
+        self._probe = probe
+        """:type : Probe"""
+        self._icmp_service = icmp_service
+        """:type : icmp.IcmpService"""
+        self._device = device
+        self._address_list = address_list
+        self._count = probe_config["PingCount"]
+        self._timeout = probe_config["PingTimeout"]
+        self._interval = probe_config.get("PingInterval", probe._default_interval)
+        self._pipelined = probe_config.get("PingMode", "sequential") == "pipelined"
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._results = {}
+        self._first_sent = {}
+        self._last_completed = {}
+
+    def start(self):
+        ipv4_indexes = [index for index, address in enumerate(self._address_list) if address["Version"] == 4]
+        for address_index in ipv4_indexes:
+            self._results[address_index] = [None] * self._count
+        self._remaining = len(ipv4_indexes) * self._count
+        if self._remaining == 0:
+            self._finish()
+            return
+
+        if self._pipelined:
+            # send all echoes for all addresses round-robin, one packet every interval
+            packet_index = 0
+            for sequence in range(0, self._count):
+                for address_index in ipv4_indexes:
+                    self._icmp_service.submit(self._address_list[address_index]["Address"], self._timeout,
+                                              partial(self._echo_done, address_index, sequence),
+                                              delay=packet_index * self._interval)
+                    packet_index += 1
+        else:
+            # every echo is sent after the previous one is answered or timed out
+            self._sequence = [(address_index, sequence) for address_index in ipv4_indexes
+                              for sequence in range(0, self._count)]
+            self._sequence.reverse()
+            self._send_next()
+
+    def _send_next(self):
+        address_index, sequence = self._sequence.pop()
+        self._icmp_service.submit(self._address_list[address_index]["Address"], self._timeout,
+                                  partial(self._echo_done, address_index, sequence))
+
+    def _echo_done(self, address_index, sequence, request):
+        with self._lock:
+            self._results[address_index][sequence] = request.delay
+            time_sent = request.time_sent if request.time_sent is not None else request.time_completed
+            if not address_index in self._first_sent or self._first_sent[address_index] > time_sent:
+                self._first_sent[address_index] = time_sent
+            self._last_completed[address_index] = max(self._last_completed.get(address_index, 0),
+                                                      request.time_completed)
+            self._remaining -= 1
+            finished = self._remaining == 0
+
+        if finished:
+            self._finish()
+        elif not self._pipelined:
+            self._send_next()
+
+    def _finish(self):
+        ip_result_list = []
+        for address_index, address in enumerate(self._address_list):
+            if not address_index in self._results:
+                result = self._probe._unsupported_address_result(address, self._device)
+            else:
+                result = self._probe._process_ping_results(
+                    address["Address"], self._count, self._results[address_index],
+                    self._last_completed[address_index] - self._first_sent[address_index])
+            result["Address"] = address
+            ip_result_list.append(result)
+        self._callback(dict(PerAddress=ip_result_list))
+
+
+def get_probe_metrics(probe_config, result):
+    metrics = []
+    for address_result in result["PerAddress"]:
+        instance = address_result["Address"]["Address"]
+        if address_result["Status"] == 1:
+            ping_result = address_result["Result"]
+            lost_count = len([x for x in ping_result["PingTimes"] if x is None])
+            metrics.append(("Loss", instance, float(lost_count) / len(ping_result["PingTimes"])))
+            metrics.append(("Min", instance, ping_result["Min"]))
+            metrics.append(("Max", instance, ping_result["Max"]))
+            metrics.append(("Average", instance, ping_result["Average"]))
+        elif address_result["Error"]["Id"] == "NO_RESPONSES_RECEIVED":
+            metrics.append(("Loss", instance, 1.0))
+    return metrics
+
+
 def get_probe_name():
     return "ping"
 
@@ -1,11 +1,28 @@
 from ConfigParser import NoOptionError
+from copy import deepcopy
+from functools import partial
 import json
-from pysnmp.entity.rfc3413.oneliner import cmdgen
+import threading
 import time
+from ctrdn.netpadd.addresses import AddressTracker
 from ctrdn.netpadd.monitor import DeviceProbe
+from ctrdn.netpadd.probe.util.snmp import CoalescedRequest, TablePlan, TableWalk, decode_value, get_engine, \
+    get_engine_statistics, get_service, group_walks, is_timeout, WalkGroup, ERROR_STATUS_TOO_BIG, \
+    ERROR_STATUS_NO_SUCH_NAME
+from ctrdn.netpadd.rates import RateEngine
+from ctrdn.netpadd.refresh import RefreshTracker
+from ctrdn.netpadd.tables import TableStore, is_stored_table
+from ctrdn.netpadd.templates import TemplateStore
+from ctrdn.netpadd.tuning import RepetitionTuner, TuningPersister
 
 __author__ = 'Lubomir Kaplan <castor@castor.sk>'
 
+# sysUpTime.0 is requested with every info request, ifLastChange column is the default change indicator
+UPTIME_OID = "1.3.6.1.2.1.1.3.0"
+DEFAULT_CHANGE_INDICATOR = "1.3.6.1.2.1.2.2.1.9"
+# walked structure of tables referencing a template always comes from the template
+TEMPLATE_WALK_ATTRIBUTES = ("BaseOid", "ColumnNameMode", "Columns", "ColumnNamePrefix", "SingleLevelTableStyle")
+
 
 class Probe(DeviceProbe):
     _default_snmp_port = None
@@ -14,10 +31,42 @@ class Probe(DeviceProbe):
     _default_snmp_info_dict = None
     _default_snmp_table_dict = None
     _bulk_command_size = None
+    _bulk_max_repetitions = None
+    _transport_cache_size = 256
+    _engine_mode = "sync"
+    _max_in_flight_per_agent = 4
+    _address_race_delay = 0.5
+    _poll_timeout = 300
+    _job_timeout_slack = 10
+    _coalesce_requests = True
+    _bulk_tuning_enabled = True
+    _bulk_tuning_min = 1
+    _bulk_tuning_max = 200
+    _bulk_tuning_max_latency = 1.0
+    _tuning_persist_interval = 60
+    _stream_table_rows = 10000
+    _stream_chunk_rows = 1000
+    _stream_buffer_chunks = 16
+    _rate_engine = None
+    _refresh_tracker = None
+    _address_tracker = None
+    _repetition_tuner = None
+    _tuning_persister = None
+    _table_store = None
+    _template_store = None
+    _template_refresh_interval = 60
+    _service = None
     _snmp_debug_enabled = False
+    _statistics_interval = 60
+    _teardown_timeout = 10
+    _next_statistics_time = 0
 
     def __init__(self, config, db):
         DeviceProbe.__init__(self, config, db, "probe-snmp-info")
+        self._rate_engine = RateEngine()
+        self._refresh_tracker = RefreshTracker()
+        self._address_tracker = AddressTracker()
+        self._repetition_tuner = RepetitionTuner(get_probe_name())
 
         assert self._config.get("probe_snmp_info", "default-snmp-port"), "no default snmp port configured"
         assert self._config.get("probe_snmp_info", "default-snmp-community"), "no default snmp community configured"
@@ -35,6 +84,91 @@ class Probe(DeviceProbe):
         self._default_snmp_table_dict = json.loads(self._config.get("probe_snmp_info", "default-snmp-table-dictionary"))
         self._bulk_command_size = self._config.getint("probe_snmp_info", "bulk-command-size")
 
+        try:
+            self._bulk_max_repetitions = self._config.getint("probe_snmp_info", "bulk-max-repetitions")
+        except NoOptionError:
+            self._logger.debug("no bulk-max-repetitions option in configuration, using bulk-command-size")
+            self._bulk_max_repetitions = self._bulk_command_size
+
+        try:
+            self._transport_cache_size = self._config.getint("probe_snmp_info", "transport-cache-size")
+        except NoOptionError:
+            self._logger.debug("no transport-cache-size option in configuration, using %d", self._transport_cache_size)
+
+        try:
+            self._engine_mode = self._config.get("probe_snmp_info", "engine")
+        except NoOptionError:
+            self._logger.debug("no engine option in configuration, using sync")
+        assert self._engine_mode in ("sync", "async"), "snmp engine must be sync or async"
+
+        try:
+            self._max_in_flight_per_agent = self._config.getint("probe_snmp_info", "max-in-flight-per-agent")
+        except NoOptionError:
+            self._logger.debug("no max-in-flight-per-agent option in configuration, using %d",
+                               self._max_in_flight_per_agent)
+
+        try:
+            self._address_race_delay = self._config.getfloat("probe_snmp_info", "address-race-delay")
+        except NoOptionError:
+            self._logger.debug("no address-race-delay option in configuration, using %.1fs", self._address_race_delay)
+
+        try:
+            self._poll_timeout = self._config.getint("probe_snmp_info", "poll-timeout")
+        except NoOptionError:
+            self._logger.debug("no poll-timeout option in configuration, using %ds", self._poll_timeout)
+
+        try:
+            self._coalesce_requests = self._config.getboolean("probe_snmp_info", "coalesce-requests")
+        except NoOptionError:
+            self._logger.debug("no coalesce-requests option in configuration, requests are coalesced")
+
+        try:
+            self._bulk_tuning_enabled = self._config.getboolean("probe_snmp_info", "bulk-tuning")
+        except NoOptionError:
+            self._logger.debug("no bulk-tuning option in configuration, tuning is enabled")
+
+        try:
+            self._bulk_tuning_min = self._config.getint("probe_snmp_info", "bulk-tuning-min")
+        except NoOptionError:
+            self._logger.debug("no bulk-tuning-min option in configuration, using %d", self._bulk_tuning_min)
+
+        try:
+            self._bulk_tuning_max = self._config.getint("probe_snmp_info", "bulk-tuning-max")
+        except NoOptionError:
+            self._logger.debug("no bulk-tuning-max option in configuration, using %d", self._bulk_tuning_max)
+
+        try:
+            self._bulk_tuning_max_latency = self._config.getfloat("probe_snmp_info", "bulk-tuning-max-latency")
+        except NoOptionError:
+            self._logger.debug("no bulk-tuning-max-latency option in configuration, using %.1fs",
+                               self._bulk_tuning_max_latency)
+
+        if self._bulk_tuning_enabled is True:
+            self._repetition_tuner.configure(self._bulk_tuning_min, self._bulk_tuning_max,
+                                             self._bulk_tuning_max_latency)
+
+        try:
+            self._stream_table_rows = self._config.getint("probe_snmp_info", "stream-table-rows")
+        except NoOptionError:
+            self._logger.debug("no stream-table-rows option in configuration, using %d", self._stream_table_rows)
+
+        try:
+            self._stream_chunk_rows = self._config.getint("probe_snmp_info", "stream-chunk-rows")
+        except NoOptionError:
+            self._logger.debug("no stream-chunk-rows option in configuration, using %d", self._stream_chunk_rows)
+
+        try:
+            self._stream_buffer_chunks = self._config.getint("probe_snmp_info", "stream-buffer-chunks")
+        except NoOptionError:
+            self._logger.debug("no stream-buffer-chunks option in configuration, using %d",
+                               self._stream_buffer_chunks)
+
+        try:
+            self._template_refresh_interval = self._config.getint("probe_snmp_info", "template-refresh-interval")
+        except NoOptionError:
+            self._logger.debug("no template-refresh-interval option in configuration, using %ds",
+                               self._template_refresh_interval)
+
         try:
             self._snmp_debug_enabled = self._config.getboolean("probe_snmp_info", "snmp-debug")
         except NoOptionError:
@@ -43,236 +177,447 @@ class Probe(DeviceProbe):
         if self._snmp_debug_enabled is True:
             self._logger.debug("snmp debugging is enabled")
 
+    def setup(self):
+        # learned request sizes and streamed tables of all pollers are written by one thread each
+        if self._bulk_tuning_enabled is True:
+            self._tuning_persister = TuningPersister(self._db, self._repetition_tuner, self._tuning_persist_interval)
+            self._tuning_persister.setDaemon(True)
+            self._tuning_persister.start()
+        self._table_store = TableStore(self._db, self._stream_buffer_chunks, self._stream_chunk_rows)
+        self._table_store.setDaemon(True)
+        self._table_store.start()
+        self._template_store = TemplateStore(self._db, TablePlan, self._template_refresh_interval)
+        self._template_store.setDaemon(True)
+        self._template_store.start()
+        if self._engine_mode == "async":
+            self._service = get_service(self._transport_cache_size, self._max_in_flight_per_agent)
+
+    def teardown(self):
+        if self._tuning_persister is not None:
+            try:
+                self._tuning_persister.flush()
+            except Exception:
+                self._logger.exception("failed to persist learned snmp request sizes")
+        if self._table_store is not None and not self._table_store.wait_written(self._teardown_timeout):
+            self._logger.warning("streamed tables were not written in %ds", self._teardown_timeout)
+
+    def forget_device(self, device_id):
+        self._rate_engine.forget(device_id)
+        self._refresh_tracker.forget(device_id)
+        self._address_tracker.forget(device_id)
+        self._repetition_tuner.forget(device_id)
+
+    def resolve_configuration(self, probe_config):
+        """
+        Return probe configuration with tables referencing a template ({"Template": template id}) replaced by the
+        template, other attributes of the table entry (PollInterval, RefreshMode, Stream, Metrics, Counters) override
+        attributes of the template.
+        """
+        table_dict = probe_config.get("SnmpTableDictionary", {})
+        if not any("Template" in table_config for table_config in table_dict.itervalues()):
+            return probe_config
+
+        resolved_table_dict = {}
+        for table_name, table_config in table_dict.iteritems():
+            if not "Template" in table_config:
+                resolved_table_dict[table_name] = table_config
+                continue
+            template = self._template_store.get(table_config["Template"])
+            if template is None:
+                self._logger.warn("snmp table %s references unavailable template %s", table_name,
+                                  table_config["Template"])
+                continue
+            resolved_config = dict(template.config)
+            resolved_config.update((key, value) for key, value in table_config.iteritems()
+                                   if not key in TEMPLATE_WALK_ATTRIBUTES)
+            resolved_table_dict[table_name] = resolved_config
+        return dict(probe_config, SnmpTableDictionary=resolved_table_dict)
+
+    def _get_template_plans(self, probe_config):
+        # tables resolved from a template share its compiled walk plan, templates are looked up before the poll
+        # starts, so the snmp service thread never waits for the database
+        template_plans = {}
+        for table_name, table_config in probe_config["SnmpTableDictionary"].iteritems():
+            if isinstance(table_config, dict) and "Template" in table_config:
+                template = self._template_store.get(table_config["Template"])
+                if template is not None:
+                    template_plans[table_name] = template.plan
+        return template_plans
+
     def _snmp_debug(self, message):
         if self._snmp_debug_enabled is True:
             self._logger.debug("[snmp debug] %s", message)
 
+    def supports_async_poll(self):
+        return self._engine_mode == "async"
+
     def poll_device(self, device, probe_name, probe_config):
-        probe_successful = False
-        tables_probe_successful = False
-        info_result = None
-        tables_result = None
-        probe_address_index = 0
+        if self._engine_mode == "async":
+            result_holder = []
+            poll_done = threading.Event()
+
+            def _poll_done(result):
+                result_holder.append(result)
+                poll_done.set()
+
+            self.poll_device_async(device, probe_name, probe_config, _poll_done)
+            # job ends itself after poll timeout, the extra time covers snmp service which is not able to end it
+            deadline = time.time() + self._poll_timeout + self._job_timeout_slack
+            while not poll_done.is_set() and time.time() < deadline:
+                poll_done.wait(1)
+            if len(result_holder) < 1:
+                self._logger.error("snmp poll of device %s did not finish in %ds", device["_id"],
+                                   self._poll_timeout + self._job_timeout_slack)
+                return dict(Status=0, Error=dict(Id="SNMP_TIMEOUT", Message="snmp poll did not finish in time"))
+            return result_holder[0]
+
+        probe_config = self.resolve_configuration(probe_config)
         if len(device["IpAddress"]) < 1:
             return dict(Status=0, Error=dict(Id="NO_IP_ADDRESSES",
                                              Message="no internet protocol addresses defined for device"))
+        candidates = self._get_candidates(device)
+        if len(candidates) < 1:
+            return self._unsupported_addresses_result()
 
         start_time = time.time()
-        snmp_error = None
-        while not probe_successful:
-            if probe_address_index >= len(device["IpAddress"]):
-                self._logger.error("failed to get snmp information from device %s, after trying all addresses",
-                                   device["_id"])
-                break
+        plan = self._refresh_tracker.create_plan(device["_id"], probe_config, start_time)
+        change_check = plan.requires_change_check()
+        engine = get_engine(self._transport_cache_size)
+        template_plans = self._get_template_plans(probe_config)
+        walks = self._create_walks(device, probe_config, template_plans, plan.table_names, start_time, True)
+        indicator_walk = self._create_indicator_walk(device, probe_config) if change_check else None
+        groups = self._group_walks(device, probe_config, ([] if indicator_walk is None else [indicator_walk]) +
+                                   [walk for table_name, walk in walks], True)
 
-            address_record = device["IpAddress"][probe_address_index]
-            if address_record["Version"] != 4:
-                self._logger.error("unsupported internet protocol version %d for device %s", address_record["Version"],
-                                   device["_id"])
-                continue
+        # info is fetched together with the first chunk of tables when possible, the request is raced over addresses
+        # of device starting with the healthiest one
+        oid_list, oid_name_map = _get_info_oids(probe_config, plan.info_names)
+        on_response = partial(self._report_address_response, device["_id"])
+        request = self._create_coalesced_request(device, probe_config, oid_list, groups)
+        address = None
+        info_result = None
+        if request is not None:
+            address, response = engine.race_bulk(
+                candidates, probe_config["SnmpPort"], probe_config["SnmpCommunity"], probe_config["SnmpVersion"],
+                request.non_repeaters, request.max_repetitions, request.oids, self._address_race_delay, on_response)
+            info_result = self._process_coalesced_response(device, probe_config, request, oid_name_map, address,
+                                                           response)
+        if info_result is None and address is None:
+            address, response = engine.race_get(
+                candidates, probe_config["SnmpPort"], probe_config["SnmpCommunity"], probe_config["SnmpVersion"],
+                oid_list, self._address_race_delay, on_response)
+            info_result = _process_info_response(oid_name_map, *response)
+        elif info_result is None:
+            info_result = self._probe_info(probe_config, dict(Version=4, Address=address), plan.info_names)
 
-            snmp_error = None
+        snmp_error = info_result.get("Error")
+        tables_result = None
+        if address is None or info_result["Status"] == 0:
+            self._logger.error("failed to get snmp information from device %s, after trying all addresses",
+                               device["_id"])
+            self._logger.warn("info snmp error: %s", snmp_error)
+            info_result = None
+        else:
+            # tables continue where the first request left them
+            address_record = dict(Version=4, Address=address)
+            failed_walks = self._walk_groups(device, probe_config, address_record, groups)
 
-            # attempt to fetch info
-            info_result = self._probe_info(probe_config, address_record)
-            probe_successful = True if info_result["Status"] == 1 else False
-            if probe_successful is False:
-                snmp_error = info_result["Error"]
-                self._logger.warn("info snmp error: %s", snmp_error)
+            # entries refreshed on change are fetched only after agent restart or change of the change indicator
+            indicator = None
+            if indicator_walk is not None and not indicator_walk in failed_walks:
+                indicator = indicator_walk.table_data
+            if self._refresh_tracker.detect_change(device["_id"], info_result["Uptime"], indicator, change_check):
+                changed_walks = self._create_walks(device, probe_config, template_plans, plan.tables_on_change,
+                                                   start_time, True)
+                changed_info_names = plan.apply_change()
+                if len(changed_info_names) > 0:
+                    changed_info_result = self._probe_info(probe_config, address_record, changed_info_names)
+                    if changed_info_result["Status"] == 1:
+                        info_result["Data"].update(changed_info_result["Data"])
+                failed_walks.extend(self._walk_groups(
+                    device, probe_config, address_record,
+                    self._group_walks(device, probe_config, [walk for table_name, walk in changed_walks], True)))
+                walks.extend(changed_walks)
+            tables_result = dict(Status=1, Data=self._collect_tables(device, walks, failed_walks))
+        end_time = time.time()
 
-            # attempt to fetch tables
-            if probe_successful is True:
-                tables_result = self._probe_tables(device, probe_config, address_record)
-                tables_probe_successful = True if tables_result["Status"] == 1 else False
-                if tables_probe_successful is False:
-                    snmp_error = tables_result["Error"]
-                    self._logger.warn("tables snmp error: %s", snmp_error)
+        return self._create_result(device, probe_config, plan, info_result, tables_result, snmp_error, start_time,
+                                   end_time)
 
-            probe_address_index += 1
-        end_time = time.time()
+    def poll_device_async(self, device, probe_name, probe_config, callback):
+        if len(device["IpAddress"]) < 1:
+            callback(dict(Status=0, Error=dict(Id="NO_IP_ADDRESSES",
+                                               Message="no internet protocol addresses defined for device")))
+            return
+        candidates = self._get_candidates(device)
+        if len(candidates) < 1:
+            callback(self._unsupported_addresses_result())
+            return
+        probe_config = self.resolve_configuration(probe_config)
+        _SnmpJob(self, self._service, device, probe_config, self._get_template_plans(probe_config), candidates,
+                 callback).start()
 
+    def _get_candidates(self, device):
+        addresses = []
+        for address_record in device["IpAddress"]:
+            if address_record["Version"] != 4:
+                self._logger.debug("unsupported internet protocol version %d for device %s",
+                                   address_record["Version"], device["_id"])
+                continue
+            addresses.append(address_record["Address"])
+        return self._address_tracker.order(device["_id"], addresses)
+
+    def _report_address_response(self, device_id, address, latency, successful, deciding):
+        # only the response which decided the race makes its address preferred
+        if successful:
+            self._address_tracker.report_success(device_id, address, latency, deciding)
+        else:
+            self._address_tracker.report_failure(device_id, address)
+
+    @staticmethod
+    def _unsupported_addresses_result():
+        return dict(Status=0, Error=dict(Id="UNSUPPORTED_ADDRESS_VERSION",
+                                         Message="no internet protocol version 4 address defined for device"))
+
+    def _create_result(self, device, probe_config, plan, info_result, tables_result, snmp_error, start_time,
+                       end_time):
         result_dict = {}
+        probe_successful = info_result is not None
+        tables_probe_successful = tables_result is not None
         if probe_successful is False:
             result_dict["Status"] = 0
             result_dict["Error"] = dict(Id="SNMP_ERROR", Message=str(snmp_error))
             self._logger.warn("failed to get snmp info, device=%s, time=%f", device["_id"], (end_time - start_time))
         else:
+            # entries which were not due in this poll are completed from previous polls
+            info_data, tables_data, cached_entries = self._refresh_tracker.update(
+                device["_id"], probe_config, plan, start_time, info_result["Data"],
+                tables_result["Data"] if tables_probe_successful else {})
             result_dict["Status"] = 1
-            result_dict["SnmpInfoData"] = info_result["Data"]
-            self._logger.debug("processed snmp info, device=%s, count=%d, time=%f",
-                               device["_id"], len(info_result["Data"]), (end_time - start_time))
+            result_dict["SnmpInfoData"] = info_data
+            if len(cached_entries["Info"]) > 0 or len(cached_entries["Tables"]) > 0:
+                result_dict["SnmpCachedEntries"] = cached_entries
+            self._logger.debug("processed snmp info, device=%s, count=%d, cached=%d, time=%f", device["_id"],
+                               len(info_data), len(cached_entries["Info"]), (end_time - start_time))
             if tables_probe_successful is True:
-                result_dict["SnmpTableData"] = tables_result["Data"]
-                self._logger.debug("processed snmp tables, device=%s, count=%d, time=%f",
-                                   device["_id"], len(tables_result["Data"]), (end_time - start_time))
+                # streamed tables are stored on their own, result carries only references to them
+                stored_tables = dict((table_name, table_data) for table_name, table_data in tables_data.iteritems()
+                                     if is_stored_table(table_data))
+                for table_name in stored_tables:
+                    del tables_data[table_name]
+                if len(stored_tables) > 0:
+                    result_dict["SnmpStoredTables"] = stored_tables
+                result_dict["SnmpTableData"] = tables_data
+                table_rates = self._compute_table_rates(device, probe_config, info_result["Uptime"],
+                                                        tables_result["Data"], end_time)
+                if len(table_rates) > 0:
+                    result_dict["SnmpTableRates"] = table_rates
+                self._logger.debug("processed snmp tables, device=%s, count=%d, cached=%d, time=%f", device["_id"],
+                                   len(tables_data), len(cached_entries["Tables"]), (end_time - start_time))
             else:
                 self._logger.warning("failed to get snmp tables data for device=%s", device["_id"])
-        return result_dict
 
-    def _probe_tables(self, device, probe_config, address_record):
-        table_result = {}
-        for table_name, table_config in probe_config["SnmpTableDictionary"].iteritems():
-            table = self._probe_single_table(table_config, probe_config, address_record)
-            if table["Status"] == 0:
-                self._logger.warn("failed to get snmp table %s from device %s", table_name, device["_id"])
-                self._logger.warn("snmp tables error: %s", table["Error"])
-            else:
-                table_result[table_name] = table["Data"]
-        return dict(Status=1, Data=table_result)
-
-    def _probe_single_table(self, table_config, probe_config, address_record):
-        cmd_generator = cmdgen.CommandGenerator()
-        base_oid = table_config["BaseOid"]
-        snmpid_table_map = {}
-        oid_column_map = {}
-        lowest_oid = None
-        highest_oid = None
-
-        col_name_mode = "manual-multi-level"
-        asl_prefix = ""
-        asl_style = "list"
-
-        if not "ColumnNameMode" in table_config:
-            self._logger.info("no ColumnNameMode specified, assuming manual-multi-level")
-        elif table_config["ColumnNameMode"] == "auto-single-level" or \
-                        table_config["ColumnNameMode"] == "manual-multi-level":
-            col_name_mode = table_config["ColumnNameMode"]
-
-        if col_name_mode == "manual-multi-level":
-            table_data = []
-            for col_name, col_oid in table_config["Columns"].iteritems():
-                if lowest_oid is None or lowest_oid > col_oid:
-                    lowest_oid = col_oid
-                if highest_oid is None or highest_oid < col_oid:
-                    highest_oid = col_oid
-                oid_column_map[col_oid] = col_name
-            last_oid = base_oid + "." + str(lowest_oid)
-        elif col_name_mode == "auto-single-level":
-            if "ColumnNamePrefix" in table_config:
-                asl_prefix = table_config["ColumnNamePrefix"]
-            else:
-                self._logger.debug("no prefix for auto-single-level mode, assuming none")
+        if end_time >= self._next_statistics_time:
+            self._next_statistics_time = end_time + self._statistics_interval
+            statistics = get_engine_statistics()
+            self._logger.info("snmp engine statistics: engines=%d, targets created=%d, reused=%d, evicted=%d",
+                              statistics["Engines"], statistics["TargetsCreated"], statistics["TargetsReused"],
+                              statistics["TargetsEvicted"])
+            if self._engine_mode == "async":
+                statistics = self._service.get_statistics()
+                self._logger.info("snmp service statistics: in-flight=%d, waiting=%d, submitted=%d, sent=%d, "
+                                  "completed=%d", statistics["InFlight"], statistics["Waiting"],
+                                  statistics["Submitted"], statistics["Sent"], statistics["Completed"])
+        return result_dict
 
-            if not "SingleLevelTableStyle" in table_config:
-                self._logger.debug("no prefix for auto-single-level mode, assuming list")
-            elif table_config["SingleLevelTableStyle"] == "list" or table_config["SingleLevelTableStyle"] == "dict":
-                asl_style = table_config["SingleLevelTableStyle"]
+    def _compute_table_rates(self, device, probe_config, uptime, tables_data, timestamp):
+        # sysUptime going backwards means agent restart, counters are not comparable across it
+        table_rates = {}
+        for table_name, table_data in tables_data.iteritems():
+            counters = probe_config["SnmpTableDictionary"][table_name].get("Counters")
+            if not counters:
+                continue
+            if is_stored_table(table_data):
+                # rows of streamed table are not kept in memory
+                if self._rate_engine.skip(device["_id"], table_name):
+                    self._logger.warning("counter rates of snmp table %s of device %s are not computed, the table is "
+                                         "streamed", table_name, device["_id"])
+                continue
+            if not isinstance(table_data, list):
+                continue
+            rows = [(row["RowIndex"], row) for row in table_data if "RowIndex" in row]
+            table_rates[table_name] = self._rate_engine.compute(device["_id"], table_name, timestamp, uptime, counters,
+                                                           rows)
+        return table_rates
 
-            if asl_style == "dict":
-                table_data = {}
-            else:
-                table_data = []
+    def _create_walks(self, device, probe_config, template_plans, table_names, timestamp, blocking):
+        # streamed tables of walks which must not block keep rows not accepted by the table store until their walk
+        # is continued
+        walks = []
+        for table_name in table_names:
+            table_config = probe_config["SnmpTableDictionary"][table_name]
+            try:
+                # tables with Stream set are streamed from the first row, others once they exceed stream-table-rows
+                stream = table_config.get("Stream")
+                plan = template_plans.get(table_name, table_config)
+                if stream is False or (stream is None and self._stream_table_rows <= 0):
+                    walk = TableWalk(plan)
+                else:
+                    walk = TableWalk(plan, self._table_store.create_table(device["_id"], table_name, timestamp,
+                                                                          blocking),
+                                     0 if stream is True else self._stream_table_rows)
+                walks.append((table_name, walk))
+            except (KeyError, AttributeError, TypeError, ValueError):
+                self._logger.warn("invalid configuration of snmp table %s for device %s", table_name, device["_id"])
+        return walks
 
-            last_oid = base_oid
-        else:
-            return dict(Status=0, Error="Invalid configuration - INVALID_COLUMN_NAME_MODE")
+    def _create_indicator_walk(self, device, probe_config):
+        try:
+            return TableWalk(_get_indicator_table_config(probe_config))
+        except (KeyError, AttributeError, TypeError, ValueError):
+            self._logger.warn("invalid snmp change indicator for device %s", device["_id"])
+            return None
 
-        self._snmp_debug("processing table with oid base {}".format(base_oid))
+    def _group_walks(self, device, probe_config, walks, blocking):
+        # snmp v1 agent fails whole GETNEXT when one of its columns reaches end of mib view, blocking command
+        # generator hides that error, so snmp v1 tables are not grouped there
+        if blocking and probe_config["SnmpVersion"] == "1":
+            return [WalkGroup([walk]) for walk in walks]
+        # columns of several tables share one request up to the getbulk size of device
+        return group_walks(walks, self._get_max_repetitions(device, probe_config)[0])
 
-        probe_done = False
-        snmp_error = None
-        while not probe_done:
-            self._snmp_debug("requesting {} items with oid {}".format(self._bulk_command_size, last_oid))
-            last_oid = last_oid.encode('ascii', 'ignore')
-            snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds = cmd_generator.nextCmd(
-                cmdgen.CommunityData(probe_config["SnmpCommunity"]),
-                cmdgen.UdpTransportTarget((address_record["Address"], probe_config["SnmpPort"])),
-                last_oid, lexicographicMode=True, maxRows=self._bulk_command_size, ignoreNonIncreasingOid=True)
+    def _create_coalesced_request(self, device, probe_config, oid_list, groups):
+        # snmp v1 has no GETBULK to carry info oids as non-repeaters
+        if self._coalesce_requests is False or probe_config["SnmpVersion"] == "1" or len(groups) < 1 or \
+                groups[0].is_done() or not CoalescedRequest.supports(oid_list):
+            return None
+        return CoalescedRequest(oid_list, groups[0], self._get_max_repetitions(device, probe_config)[0])
 
-            if snmp_err_indication:
-                snmp_error = str(snmp_err_indication)
-                break
-            else:
-                if snmp_err_status:
-                    snmp_error = 'snmp error: %s at %s' % (snmp_err_status.prettyPrint(),
-                                                           snmp_err_index and snmp_var_binds[-1][
-                                                               int(snmp_err_index) - 1] or '?')
-                    break
-                else:
-                    self._snmp_debug("received {}/{} bindings for oid {}".format(len(snmp_var_binds),
-                                                                                 self._bulk_command_size, last_oid))
-                    if len(snmp_var_binds) == 0:
-                        break
-                    for oid_tuple in snmp_var_binds:
-                        oid = oid_tuple[0][0]
-                        oid_string = str(oid.prettyOut(oid))
-                        value = oid_tuple[0][1]
-                        value = value.prettyOut(value)
-                        self._snmp_debug("processing incoming oid {}".format(oid_string))
-                        if not oid_string.startswith(base_oid):
-                            self._snmp_debug("out-of-sequence oid received {}, finishing up".format(oid_string))
-                            probe_done = True
-                            break
-                        last_oid = oid_string
-                        """:type : str"""
-                        if col_name_mode == "manual-multi-level":
-                            column_id = int(oid_string[len(base_oid) + 1:oid_string.find(".", len(base_oid) + 1)])
-                            item_id = oid_string[oid_string.find(".", len(base_oid) + 1) + 1:]
-                            if not column_id in oid_column_map:
-                                continue
-                            if not item_id in snmpid_table_map:
-                                table_data.append({oid_column_map[column_id]: value})
-                                snmpid_table_map[item_id] = len(table_data) - 1
-                            else:
-                                table_data[snmpid_table_map[item_id]][oid_column_map[column_id]] = value
-                        elif col_name_mode == "auto-single-level":
-                            try:
-                                item_id = int(oid_string[len(base_oid) + 1:])
-                            except ValueError:
-                                self._logger.error("not a valid single level structure for oid %s with base %s",
-                                                   oid_string, base_oid)
-                                continue
-                            item_name = "{}{}".format(asl_prefix, item_id)
-                            if asl_style == "dict":
-                                table_data[item_name] = value
-                            else:
-                                table_data.append(dict(Name=item_name, Value=value))
-
-                    if len(snmp_var_binds) < self._bulk_command_size:
-                        probe_done = True
+    def _process_coalesced_response(self, device, probe_config, request, oid_name_map, address, response):
+        """
+        Return info result of coalesced request, or None when info has to be requested on its own (agent returned
+        tooBig or truncated the response before its first row).
+        """
+        snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds = response
+        if snmp_err_status and int(snmp_err_status) == ERROR_STATUS_TOO_BIG:
+            if self._get_max_repetitions(device, probe_config)[1] is True:
+                self._repetition_tuner.report_failure(device["_id"])
+            return None
+        if address is None:
+            return _process_info_response(oid_name_map, *response)
+        info_var_binds = request.feed(snmp_var_binds)
+        if info_var_binds is None:
+            self._snmp_debug("coalesced request returned no complete row, requesting info separately")
+            return None
+        return _process_info_response(oid_name_map, None, 0, 0, info_var_binds)
 
+    def _walk_groups(self, device, probe_config, address_record, groups):
+        # returns walks of groups which failed
+        failed_walks = []
+        for group in groups:
+            self._snmp_debug("processing tables with oid base {}".format(
+                ", ".join(walk.base_oid for walk in group.walks)))
+            snmp_error = self._walk(device, group, probe_config, address_record)
             if not snmp_error is None:
                 self._logger.error("snmp tables error: %s", snmp_error)
-                break
+                failed_walks.extend(group.walks)
+        return failed_walks
 
-        if not snmp_error is None:
-            return dict(Status=0, Error=snmp_error)
-        else:
-            return dict(Status=1, Data=table_data)
+    def _collect_tables(self, device, walks, failed_walks):
+        tables_data = {}
+        for table_name, walk in walks:
+            if walk in failed_walks:
+                self._logger.warn("failed to get snmp table %s from device %s", table_name, device["_id"])
+                if walk.is_streamed():
+                    walk.close_stream(False)
+            elif walk.is_streamed():
+                tables_data[table_name] = walk.close_stream(True)
+            else:
+                tables_data[table_name] = walk.table_data
+        return tables_data
 
-    @staticmethod
-    def _probe_info(probe_config, address_record):
-        cmd_generator = cmdgen.CommandGenerator()
-        snmp_error = None
-        snmp_data = None
+    def _get_max_repetitions(self, device, probe_config):
+        """
+        Return GETBULK size of device and whether it is tuned, SnmpMaxRepetitions of device disables tuning.
+        """
+        if "SnmpMaxRepetitions" in probe_config:
+            return probe_config["SnmpMaxRepetitions"], False
+        if self._bulk_tuning_enabled is False:
+            return self._bulk_max_repetitions, False
+        return self._repetition_tuner.get(device, self._bulk_max_repetitions), True
 
-        oid_list = []
-        oid_name_map = {}
-        for name, oid in probe_config["SnmpInfoDictionary"].iteritems():
-            oid = oid.encode('ascii', 'ignore')
-            oid_list.append(oid)
-            oid_name_map[oid] = name
+    def _walk(self, device, walk, probe_config, address_record):
+        """
+        Walk table (or group of tables) to its end, return snmp error or None.
+        """
+        engine = get_engine(self._transport_cache_size)
+        auth_data = engine.get_auth_data(probe_config["SnmpCommunity"], probe_config["SnmpVersion"])
 
-        snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds = cmd_generator.getCmd(
-            cmdgen.CommunityData(probe_config["SnmpCommunity"]),
-            cmdgen.UdpTransportTarget((address_record["Address"], probe_config["SnmpPort"])), *oid_list)
+        # snmp v1 agents do not know GETBULK, they are walked with GETNEXT requests
+        use_bulk = probe_config["SnmpVersion"] != "1"
+        tuned = False
 
-        if snmp_err_indication:
-            snmp_error = str(snmp_err_indication)
-        else:
-            if snmp_err_status:
-                snmp_error = 'snmp error: %s at %s' % (snmp_err_status.prettyPrint(),
-                                                       snmp_err_index and snmp_var_binds[-1][
-                                                           int(snmp_err_index) - 1] or '?')
+        snmp_error = None
+        while not walk.is_done():
+            # every remaining column is one varbind, response size is kept around max repetitions varbinds
+            request_oids = walk.get_request_oids()
+            request_time = time.time()
+            if use_bulk:
+                max_repetitions, tuned = self._get_max_repetitions(device, probe_config)
+                chunk_size = max(1, max_repetitions // len(request_oids))
+                self._snmp_debug("requesting {} rows with getbulk for oids {}".format(chunk_size, request_oids))
+                snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds = engine.cmd_generator.bulkCmd(
+                    auth_data, engine.get_target(address_record["Address"], probe_config["SnmpPort"],
+                                                 probe_config["SnmpCommunity"]),
+                    0, chunk_size, *request_oids, lexicographicMode=True, maxRows=chunk_size,
+                    ignoreNonIncreasingOid=True)
             else:
-                snmp_data = {}
-                for oid, value in snmp_var_binds:
-                    mib_name = oid_name_map[oid.prettyOut(oid)]
-                    snmp_data[mib_name] = str(value)
-        if not snmp_error is None:
-            return dict(Status=0, Error=snmp_error)
+                chunk_size = self._bulk_command_size
+                self._snmp_debug("requesting {} rows with getnext for oids {}".format(chunk_size, request_oids))
+                snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds = engine.cmd_generator.nextCmd(
+                    auth_data, engine.get_target(address_record["Address"], probe_config["SnmpPort"],
+                                                 probe_config["SnmpCommunity"]),
+                    *request_oids, lexicographicMode=True, maxRows=chunk_size, ignoreNonIncreasingOid=True)
 
-        return dict(Status=1, Data=snmp_data)
+            if snmp_err_indication:
+                snmp_error = str(snmp_err_indication)
+                if use_bulk and tuned and is_timeout(snmp_err_indication):
+                    self._repetition_tuner.report_failure(device["_id"])
+            elif snmp_err_status and use_bulk and int(snmp_err_status) == ERROR_STATUS_TOO_BIG:
+                # response would not fit into agent's message size, rest of the table is walked with getnext
+                self._snmp_debug("agent returned tooBig for getbulk, falling back to getnext")
+                if tuned:
+                    self._repetition_tuner.report_failure(device["_id"])
+                use_bulk = False
+                continue
+            elif snmp_err_status:
+                snmp_error = _format_snmp_error(snmp_err_status, snmp_err_index, snmp_var_binds and snmp_var_binds[-1])
+            else:
+                self._snmp_debug("received {}/{} rows for oids {}".format(len(snmp_var_binds), chunk_size,
+                                                                          request_oids))
+                walk.feed(snmp_var_binds)
+                if len(snmp_var_binds) < chunk_size:
+                    # agent ran out of mib view before the chunk was filled
+                    walk.finish()
+                if use_bulk and tuned:
+                    # blocking command generator completes responses truncated by the agent itself
+                    self._repetition_tuner.report_response(device["_id"], chunk_size, len(snmp_var_binds),
+                                                      len(request_oids), time.time() - request_time, walk.is_done())
+
+            if not snmp_error is None:
+                return snmp_error
+
+        return None
+
+    def _probe_info(self, probe_config, address_record, info_names):
+        engine = get_engine(self._transport_cache_size)
+        oid_list, oid_name_map = _get_info_oids(probe_config, info_names)
+        snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds = engine.cmd_generator.getCmd(
+            engine.get_auth_data(probe_config["SnmpCommunity"], probe_config["SnmpVersion"]),
+            engine.get_target(address_record["Address"], probe_config["SnmpPort"], probe_config["SnmpCommunity"]),
+            *oid_list)
+        return _process_info_response(oid_name_map, snmp_err_indication, snmp_err_status, snmp_err_index,
+                                      snmp_var_binds)
 
     def validate_configuration(self, device, probe_config):
         update_config = False
@@ -290,11 +635,11 @@ class Probe(DeviceProbe):
             update_config = True
         if not "SnmpInfoDictionary" in probe_config:
             self._logger.warn("no SnmpInfoDictionary in probe configuration for device %s", device["_id"])
-            probe_config["SnmpInfoDictionary"] = self._default_snmp_info_dict
+            probe_config["SnmpInfoDictionary"] = deepcopy(self._default_snmp_info_dict)
             update_config = True
         if not "SnmpTableDictionary" in probe_config:
             self._logger.warn("no SnmpTableDictionary in probe configuration for device %s", device["_id"])
-            probe_config["SnmpTableDictionary"] = self._default_snmp_table_dict
+            probe_config["SnmpTableDictionary"] = deepcopy(self._default_snmp_table_dict)
             update_config = True
 
         if update_config is True:
@@ -304,6 +649,382 @@ class Probe(DeviceProbe):
         return None
 
 
+class _SnmpJob(object):
+    """
+    Asynchronous poll of one device. Info is requested together with the first chunk of tables (or on its own), all
+    unfinished table groups are walked concurrently afterwards, entries refreshed on change are fetched last.
+    All callbacks are called from the snmp service thread.
+    """
+    _probe = None
+    _service = None
+    _device = None
+    _probe_config = None
+    _template_plans = None
+    _candidates = None
+    _callback = None
+    _address = None
+    _start_time = None
+    _snmp_error = None
+    _plan = None
+    _change_check = False
+    _info_result = None
+    _walks = None
+    _indicator_walk = None
+    _groups = None
+    _failed_walks = None
+    _remaining_requests = 0
+    _stream_retry_delay = 0.1
+    _finished = False
+
+    def __init__(self, probe, service, device, probe_config, template_plans, candidates, callback):
+        self._probe = probe
+        """:type : Probe"""
+        self._service = service
+        """:type : AsyncSnmpService"""
+        self._device = device
+        self._probe_config = probe_config
+        self._template_plans = template_plans
+        self._candidates = candidates
+        self._callback = callback
+        self._failed_walks = []
+
+    def start(self):
+        self._start_time = time.time()
+        self._service.call_later(self._probe._poll_timeout, self._expire)
+        try:
+            self._start()
+        except Exception:
+            # caller reports the failure, job must not call back on expiry
+            self._finished = True
+            raise
+
+    def _start(self):
+        self._plan = self._probe._refresh_tracker.create_plan(self._device["_id"], self._probe_config, self._start_time)
+        self._change_check = self._plan.requires_change_check()
+        self._walks = self._probe._create_walks(self._device, self._probe_config, self._template_plans,
+                                                self._plan.table_names, self._start_time, False)
+        if self._change_check:
+            self._indicator_walk = self._probe._create_indicator_walk(self._device, self._probe_config)
+        self._groups = self._probe._group_walks(
+            self._device, self._probe_config, ([] if self._indicator_walk is None else [self._indicator_walk]) +
+            [walk for table_name, walk in self._walks], False)
+
+        # info is fetched together with the first chunk of tables when possible, the request is raced over addresses
+        # of device starting with the healthiest one
+        oid_list, oid_name_map = _get_info_oids(self._probe_config, self._plan.info_names)
+        request = self._probe._create_coalesced_request(self._device, self._probe_config, oid_list, self._groups)
+        if request is None:
+            self._race_info(oid_list, oid_name_map)
+            return
+        self._service.race_bulk(self._candidates, self._probe_config["SnmpPort"],
+                                self._probe_config["SnmpCommunity"], self._probe_config["SnmpVersion"],
+                                request.non_repeaters, request.max_repetitions, request.oids,
+                                self._probe._address_race_delay,
+                                self._guard(partial(self._coalesced_done, request, oid_name_map)),
+                                partial(self._probe._report_address_response, self._device["_id"]))
+
+    def _guard(self, function):
+        # responses of finished job are ignored, callback which fails ends the job with error
+        def _call(*args):
+            if self._finished:
+                return
+            try:
+                function(*args)
+            except Exception as e:
+                self._probe._logger.exception("snmp poll of device %s failed", self._device["_id"])
+                self._fail("PROBE_EXCEPTION", str(e))
+        return _call
+
+    def _expire(self):
+        if not self._finished:
+            self._probe._logger.error("snmp poll of device %s did not finish in %ds", self._device["_id"],
+                                      self._probe._poll_timeout)
+            self._fail("SNMP_TIMEOUT", "snmp poll did not finish in %ds" % self._probe._poll_timeout)
+
+    def _fail(self, error_id, message):
+        if self._finished:
+            return
+        self._finished = True
+        for table_name, walk in self._walks or []:
+            if walk.is_streamed():
+                try:
+                    walk.close_stream(False)
+                except Exception:
+                    self._probe._logger.exception("failed to close streamed table %s", table_name)
+        self._callback(dict(Status=0, Error=dict(Id=error_id, Message=message)))
+
+    def _race_info(self, oid_list, oid_name_map):
+        self._service.race_get(self._candidates, self._probe_config["SnmpPort"], self._probe_config["SnmpCommunity"],
+                               self._probe_config["SnmpVersion"], oid_list, self._probe._address_race_delay,
+                               self._guard(partial(self._race_done, oid_name_map)),
+                               partial(self._probe._report_address_response, self._device["_id"]))
+
+    def _coalesced_done(self, request, oid_name_map, address, response):
+        info_result = self._probe._process_coalesced_response(self._device, self._probe_config, request, oid_name_map,
+                                                              address, response)
+        if info_result is None and address is None:
+            self._race_info(request.info_oids, oid_name_map)
+        elif info_result is None:
+            self._address = address
+            self._get_info(self._plan.info_names, self._info_done)
+        elif address is None:
+            self._race_failed(info_result["Error"])
+        else:
+            self._address = address
+            self._info_received(info_result)
+
+    def _race_done(self, oid_name_map, address, response):
+        if address is None:
+            self._race_failed(_process_info_response(oid_name_map, *response)["Error"])
+            return
+        self._address = address
+        self._info_done(oid_name_map, *response)
+
+    def _race_failed(self, snmp_error):
+        self._snmp_error = snmp_error
+        self._probe._logger.error("failed to get snmp information from device %s, after trying all addresses",
+                                  self._device["_id"])
+        self._probe._logger.warn("info snmp error: %s", self._snmp_error)
+        self._finish()
+
+    def _get_info(self, info_names, callback):
+        oid_list, oid_name_map = _get_info_oids(self._probe_config, info_names)
+        self._service.get(self._address, self._probe_config["SnmpPort"], self._probe_config["SnmpCommunity"],
+                          self._probe_config["SnmpVersion"], oid_list, self._guard(partial(callback, oid_name_map)))
+
+    def _info_done(self, oid_name_map, snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds):
+        self._info_received(_process_info_response(oid_name_map, snmp_err_indication, snmp_err_status, snmp_err_index,
+                                                   snmp_var_binds))
+
+    def _info_received(self, info_result):
+        if info_result["Status"] == 0:
+            self._snmp_error = info_result["Error"]
+            self._probe._logger.warn("info snmp error: %s", self._snmp_error)
+            self._finish()
+            return
+
+        # tables continue where the first request left them
+        self._info_result = info_result
+        self._walk_groups(self._groups, self._tables_done)
+
+    def _walk_groups(self, groups, done):
+        groups = [group for group in groups if not group.is_done()]
+        self._remaining_requests = len(groups)
+        if self._remaining_requests == 0:
+            done()
+            return
+        # snmp v1 agents do not know GETBULK, they are walked with GETNEXT requests
+        use_bulk = self._probe_config["SnmpVersion"] != "1"
+        for group in groups:
+            self._walk_next(group, use_bulk, partial(self._group_done, group, done))
+
+    def _group_done(self, group, done, snmp_error):
+        if not snmp_error is None:
+            self._probe._logger.error("snmp tables error: %s", snmp_error)
+            self._failed_walks.extend(group.walks)
+        self._request_done(done)
+
+    def _request_done(self, done):
+        self._remaining_requests -= 1
+        if self._remaining_requests == 0:
+            done()
+
+    def _tables_done(self):
+        # entries refreshed on change are fetched only after agent restart or change of the change indicator
+        indicator = None
+        if self._indicator_walk is not None and not self._indicator_walk in self._failed_walks:
+            indicator = self._indicator_walk.table_data
+        if not self._probe._refresh_tracker.detect_change(self._device["_id"], self._info_result["Uptime"], indicator,
+                                              self._change_check):
+            self._finish()
+            return
+
+        changed_walks = self._probe._create_walks(self._device, self._probe_config, self._template_plans,
+                                                  self._plan.tables_on_change, self._start_time, False)
+        changed_info_names = self._plan.apply_change()
+        self._walks.extend(changed_walks)
+        groups = self._probe._group_walks(self._device, self._probe_config,
+                                          [walk for table_name, walk in changed_walks], False)
+        # changed info and changed tables are requested concurrently
+        self._remaining_requests = len(groups) + (1 if len(changed_info_names) > 0 else 0)
+        if self._remaining_requests == 0:
+            self._finish()
+            return
+        if len(changed_info_names) > 0:
+            self._get_info(changed_info_names, self._changed_info_done)
+        use_bulk = self._probe_config["SnmpVersion"] != "1"
+        for group in groups:
+            self._walk_next(group, use_bulk, partial(self._group_done, group, self._finish))
+
+    def _changed_info_done(self, oid_name_map, snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds):
+        info_result = _process_info_response(oid_name_map, snmp_err_indication, snmp_err_status, snmp_err_index,
+                                             snmp_var_binds)
+        if info_result["Status"] == 1:
+            self._info_result["Data"].update(info_result["Data"])
+        self._request_done(self._finish)
+
+    def _walk_next(self, walk, use_bulk, done):
+        if walk.is_stream_blocked():
+            # streamed rows wait for the table store, only this walk is paused, the service thread is never blocked
+            self._service.call_later(self._stream_retry_delay,
+                                     self._guard(partial(self._walk_next, walk, use_bulk, done)))
+            return
+        request_oids = walk.get_request_oids()
+        if use_bulk:
+            max_repetitions, tuned = self._probe._get_max_repetitions(self._device, self._probe_config)
+            chunk_size = max(1, max_repetitions // len(request_oids))
+            # latency includes time spent waiting for free in-flight slot of the agent
+            callback = self._guard(partial(self._walk_response, walk, use_bulk, done,
+                                           (chunk_size, len(request_oids), time.time()) if tuned else None))
+            self._service.get_bulk(self._address, self._probe_config["SnmpPort"], self._probe_config["SnmpCommunity"],
+                                   self._probe_config["SnmpVersion"], request_oids, chunk_size, callback)
+        else:
+            callback = self._guard(partial(self._walk_response, walk, use_bulk, done, None))
+            self._service.get_next(self._address, self._probe_config["SnmpPort"], self._probe_config["SnmpCommunity"],
+                                   self._probe_config["SnmpVersion"], request_oids, callback)
+
+    def _walk_response(self, walk, use_bulk, done, tuned_request, snmp_err_indication, snmp_err_status,
+                       snmp_err_index, snmp_var_binds):
+        # tuned_request is tuple of requested rows, number of columns and request time, when request size is tuned
+        if snmp_err_indication:
+            if tuned_request is not None and is_timeout(snmp_err_indication):
+                self._probe._repetition_tuner.report_failure(self._device["_id"])
+            done(str(snmp_err_indication))
+            return
+        elif snmp_err_status and use_bulk and int(snmp_err_status) == ERROR_STATUS_TOO_BIG:
+            # response would not fit into agent's message size, rest of the table is walked with getnext
+            if tuned_request is not None:
+                self._probe._repetition_tuner.report_failure(self._device["_id"])
+            self._walk_next(walk, False, done)
+            return
+        elif snmp_err_status and int(snmp_err_status) == ERROR_STATUS_NO_SUCH_NAME and snmp_err_index:
+            # snmp v1 agent reports end of mib view of one column as noSuchName, other columns are walked further
+            walk.finish_column(int(snmp_err_index) - 1)
+        elif snmp_err_status:
+            done(_format_snmp_error(snmp_err_status, snmp_err_index, snmp_var_binds and snmp_var_binds[-1]))
+            return
+        else:
+            walk.feed(snmp_var_binds)
+            if tuned_request is not None:
+                requested, columns, request_time = tuned_request
+                self._probe._repetition_tuner.report_response(self._device["_id"], requested, len(snmp_var_binds),
+                                                              columns, time.time() - request_time, walk.is_done())
+
+        if walk.is_done():
+            done(None)
+        else:
+            self._walk_next(walk, use_bulk, done)
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            tables_result = None
+            if self._info_result is not None:
+                tables_result = dict(Status=1, Data=self._probe._collect_tables(self._device, self._walks,
+                                                                                self._failed_walks))
+            result = self._probe._create_result(self._device, self._probe_config, self._plan, self._info_result,
+                                                tables_result, self._snmp_error, self._start_time, time.time())
+        except Exception as e:
+            self._probe._logger.exception("failed to process snmp results of device %s", self._device["_id"])
+            result = dict(Status=0, Error=dict(Id="PROBE_EXCEPTION", Message=str(e)))
+        self._callback(result)
+
+
+def get_probe_metrics(probe_config, result):
+    metrics = []
+    if result.get("Status") != 1:
+        return metrics
+
+    # entries served from previous polls were already stored as metrics when they were fetched
+    cached_entries = result.get("SnmpCachedEntries", {})
+    for name, value in result["SnmpInfoData"].iteritems():
+        if name in cached_entries.get("Info", []):
+            continue
+        numeric_value = _to_number(value)
+        if not numeric_value is None:
+            metrics.append((name, "", numeric_value))
+
+    # only columns listed in Metrics of table configuration are stored as metrics ("Value" for single-level tables)
+    for table_name, table_data in result.get("SnmpTableData", {}).iteritems():
+        if table_name in cached_entries.get("Tables", []):
+            continue
+        table_config = probe_config["SnmpTableDictionary"].get(table_name, {})
+        metric_columns = table_config.get("Metrics", [])
+        if len(metric_columns) < 1:
+            continue
+        if isinstance(table_data, dict):
+            rows = [(name, dict(Value=value)) for name, value in table_data.iteritems()]
+        elif table_config.get("ColumnNameMode") == "auto-single-level":
+            rows = [(row["Name"], row) for row in table_data]
+        else:
+            rows = [(row.get("RowIndex", ""), row) for row in table_data]
+        for instance, row in rows:
+            for column in metric_columns:
+                numeric_value = _to_number(row.get(column))
+                if not numeric_value is None:
+                    metrics.append((table_name + "." + column, instance, numeric_value))
+
+    # per-second rates of counter columns
+    for table_name, table_rates in result.get("SnmpTableRates", {}).iteritems():
+        for row_rates in table_rates:
+            for column, rate in row_rates.iteritems():
+                if column != "RowIndex":
+                    metrics.append((table_name + "." + column + "Rate", row_rates["RowIndex"], rate))
+    return metrics
+
+
+def _get_info_oids(probe_config, info_names):
+    oid_list = [UPTIME_OID]
+    oid_name_map = {}
+    for name in info_names:
+        oid = probe_config["SnmpInfoDictionary"][name]
+        oid = (oid["Oid"] if isinstance(oid, dict) else oid).encode('ascii', 'ignore')
+        if oid != UPTIME_OID:
+            oid_list.append(oid)
+        oid_name_map[oid] = name
+    return oid_list, oid_name_map
+
+
+def _get_indicator_table_config(probe_config):
+    return {"BaseOid": probe_config.get("SnmpChangeIndicator", DEFAULT_CHANGE_INDICATOR),
+            "ColumnNameMode": "auto-single-level", "SingleLevelTableStyle": "dict"}
+
+
+def _process_info_response(oid_name_map, snmp_err_indication, snmp_err_status, snmp_err_index, snmp_var_binds):
+    if snmp_err_indication:
+        return dict(Status=0, Error=str(snmp_err_indication))
+    if snmp_err_status:
+        return dict(Status=0, Error=_format_snmp_error(snmp_err_status, snmp_err_index, snmp_var_binds))
+
+    snmp_data = {}
+    uptime = None
+    for oid, value in snmp_var_binds:
+        oid = oid.prettyOut(oid)
+        if oid == UPTIME_OID:
+            uptime = _to_number(str(value))
+        if oid in oid_name_map:
+            # binary octet strings (mac addresses) are stored as hexadecimal strings, as values of tables are
+            snmp_data[oid_name_map[oid]] = decode_value(value)
+    return dict(Status=1, Data=snmp_data, Uptime=uptime)
+
+
+def _format_snmp_error(snmp_err_status, snmp_err_index, snmp_var_binds):
+    return 'snmp error: %s at %s' % (snmp_err_status.prettyPrint(),
+                                     snmp_err_index and snmp_var_binds[int(snmp_err_index) - 1] or '?')
+
+
+def _to_number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
 def get_probe_name():
     return "snmp_info"
 
@@ -0,0 +1,276 @@
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from ctrdn.netpadd.probe.util.ping import ICMP_CODE, ERROR_DESCR
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_PAYLOAD = 192 * 'Q'
+
+_service = None
+_service_pid = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """Return the ICMP service of the current process, starting it on first use."""
+    global _service, _service_pid
+    with _service_lock:
+        if _service is None or _service_pid != os.getpid() or not _service.is_alive():
+            _service = IcmpService()
+            _service.setDaemon(True)
+            _service.start()
+            _service_pid = os.getpid()
+        return _service
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def create_echo_request(identifier, sequence):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    packet_checksum = _checksum(header + ICMP_PAYLOAD)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, packet_checksum, identifier, sequence)
+    return header + ICMP_PAYLOAD
+
+
+class PingRequest(object):
+    host = None
+    key = None
+    timeout = None
+    time_sent = None
+    time_completed = None
+    delay = None
+    _callback = None
+    _event = None
+
+    def __init__(self, host, key, timeout, callback=None):
+        self.host = host
+        self.key = key
+        self.timeout = timeout
+        self._callback = callback
+        self._event = threading.Event()
+
+    def wait(self):
+        """Block until the reply arrives or the request times out, return delay in seconds or None."""
+        while not self._event.is_set():
+            # waiting with timeout keeps the calling thread interruptible
+            self._event.wait(self.timeout + 1)
+        return self.delay
+
+    def is_done(self):
+        return self._event.is_set()
+
+    def _complete(self, delay):
+        self.delay = delay
+        self.time_completed = time.time()
+        self._event.set()
+        if self._callback is not None:
+            self._callback(self)
+
+
+class IcmpService(threading.Thread):
+    _logger = logging.getLogger("icmp-service")
+    _socket = None
+    _poller = None
+    _epoll = False
+    _wakeup_read = None
+    _wakeup_write = None
+    _lock = None
+    _pending = None
+    _deadlines = None
+    _scheduled = None
+    _scheduled_counter = 0
+    _next_deadline = None
+    _sequence = 0
+    _identifier = None
+    _running = False
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="icmp-service")
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, ICMP_CODE)
+        except socket.error as e:
+            if e.errno in ERROR_DESCR:
+                # Operation not permitted
+                raise socket.error(''.join((e.args[1], ERROR_DESCR[e.errno])))
+            raise
+        self._socket.setblocking(0)
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self._epoll = hasattr(select, "epoll")
+        if self._epoll:
+            self._poller = select.epoll()
+            self._poller.register(self._socket.fileno(), select.EPOLLIN)
+            self._poller.register(self._wakeup_read, select.EPOLLIN)
+        else:
+            self._poller = select.poll()
+            self._poller.register(self._socket.fileno(), select.POLLIN)
+            self._poller.register(self._wakeup_read, select.POLLIN)
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._deadlines = []
+        self._scheduled = []
+        # replies to echoes of all processes arrive at every raw socket, identifier tells processes apart
+        self._identifier = os.getpid() & 0xffff
+        self._running = True
+
+    def submit(self, host, timeout, callback=None, delay=0):
+        """
+        Send one echo request to "host" and return the PingRequest tracking it.
+        "callback" (optional) is called with the request from the service thread once it is completed.
+        "delay" (optional) postpones sending of the request by given number of seconds.
+        """
+        try:
+            socket.inet_aton(host)
+        except socket.error:
+            try:
+                host = socket.gethostbyname(host)
+            except socket.gaierror:
+                request = PingRequest(host, None, timeout, callback)
+                request._complete(None)
+                return request
+
+        request = PingRequest(host, None, timeout, callback)
+        if delay > 0:
+            send_time = time.time() + delay
+            with self._lock:
+                self._scheduled_counter += 1
+                heapq.heappush(self._scheduled, (send_time, self._scheduled_counter, request))
+                wakeup = self._next_deadline is None or send_time < self._next_deadline
+            if wakeup:
+                self._wakeup()
+        else:
+            self._send(request)
+        return request
+
+    def _send(self, request):
+        with self._lock:
+            self._sequence = (self._sequence + 1) & 0xffff
+            key = (self._identifier, self._sequence)
+            request.key = key
+            request.time_sent = time.time()
+            deadline = request.time_sent + request.timeout
+            self._pending[key] = request
+            heapq.heappush(self._deadlines, (deadline, key, request))
+            wakeup = self._next_deadline is None or deadline < self._next_deadline
+
+        try:
+            self._socket.sendto(create_echo_request(key[0], key[1]), (request.host, 1))
+        except socket.error as e:
+            self._logger.debug("failed to send echo request to %s: %s", request.host, e)
+            with self._lock:
+                unsent = self._pending.pop(key, None)
+            if unsent is not None:
+                unsent._complete(None)
+            return
+
+        if wakeup:
+            self._wakeup()
+
+    def stop(self):
+        self._running = False
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, 'w')
+        except OSError as e:
+            # pipe is full, the service thread is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        self._logger.debug("started icmp service, identifier=%d", self._identifier)
+        while self._running:
+            with self._lock:
+                self._next_deadline = self._deadlines[0][0] if self._deadlines else None
+                if self._scheduled and (self._next_deadline is None or self._scheduled[0][0] < self._next_deadline):
+                    self._next_deadline = self._scheduled[0][0]
+            if self._next_deadline is None:
+                wait_time = -1
+            else:
+                wait_time = max(self._next_deadline - time.time(), 0)
+
+            if self._epoll:
+                events = self._poller.poll(wait_time)
+            else:
+                events = self._poller.poll(wait_time * 1000 if wait_time >= 0 else None)
+
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    try:
+                        os.read(self._wakeup_read, 4096)
+                    except OSError:
+                        pass
+                else:
+                    self._receive_replies()
+            self._send_scheduled()
+            self._expire_requests()
+
+        if self._epoll:
+            self._poller.close()
+        self._socket.close()
+        self._logger.debug("stopped icmp service")
+
+    def _receive_replies(self):
+        while True:
+            try:
+                packet, address = self._socket.recvfrom(1024)
+            except socket.error:
+                return
+            time_received = time.time()
+            header_length = (ord(packet[0]) & 0x0f) * 4
+            if len(packet) < header_length + 8:
+                continue
+            icmp_type, icmp_code, icmp_checksum, identifier, sequence = struct.unpack(
+                '!BBHHH', packet[header_length:header_length + 8])
+            if icmp_type != ICMP_ECHO_REPLY or identifier != self._identifier:
+                continue
+            with self._lock:
+                request = self._pending.get((identifier, sequence))
+                # reply from other host (to a reused sequence) does not complete the request
+                if request is None or request.host != address[0]:
+                    continue
+                del self._pending[(identifier, sequence)]
+            request._complete(time_received - request.time_sent)
+
+    def _send_scheduled(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._scheduled and self._scheduled[0][0] <= now:
+                due.append(heapq.heappop(self._scheduled)[2])
+        for request in due:
+            self._send(request)
+
+    def _expire_requests(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, key, request = heapq.heappop(self._deadlines)
+                # deadline of answered request must not expire a newer request reusing its (wrapped) sequence
+                if self._pending.get(key) is request:
+                    del self._pending[key]
+                    expired.append(request)
+        for request in expired:
+            request._complete(None)
@@ -0,0 +1,804 @@
+import asyncore
+import binascii
+from collections import OrderedDict, deque
+from functools import partial
+import heapq
+import itertools
+import logging
+import os
+import threading
+from Queue import Queue, Empty
+import re
+import time
+from pyasn1.type import univ
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto import errind, rfc1902, rfc1905
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+# error-status values of snmp response pdu (rfc 3416)
+ERROR_STATUS_TOO_BIG = 1
+ERROR_STATUS_NO_SUCH_NAME = 2
+
+_engine_storage = threading.local()
+_engine_list = []
+_engine_list_lock = threading.Lock()
+_service = None
+_service_pid = None
+_service_lock = threading.Lock()
+
+
+def get_engine(transport_cache_size):
+    """
+    Return snmp engine of the calling thread, engine is created on first use and lives as long as the thread.
+    """
+    engine = getattr(_engine_storage, "engine", None)
+    if engine is None:
+        engine = SnmpEngine(transport_cache_size)
+        _engine_storage.engine = engine
+        with _engine_list_lock:
+            _engine_list.append(engine)
+    return engine
+
+
+def get_engine_statistics():
+    statistics = dict(Engines=0, TargetsCreated=0, TargetsReused=0, TargetsEvicted=0)
+    with _engine_list_lock:
+        for engine in _engine_list:
+            statistics["Engines"] += 1
+            for name, value in engine.get_statistics().iteritems():
+                statistics[name] += value
+    return statistics
+
+
+def get_service(transport_cache_size, max_in_flight_per_agent):
+    """Return the asynchronous SNMP service of the current process, starting it on first use."""
+    global _service, _service_pid
+    with _service_lock:
+        if _service is None or _service_pid != os.getpid() or not _service.is_alive():
+            _service = AsyncSnmpService(transport_cache_size, max_in_flight_per_agent)
+            _service.setDaemon(True)
+            _service.start()
+            _service_pid = os.getpid()
+        return _service
+
+
+class SnmpEngine(object):
+    """
+    Command generator with cache of transport targets, used by one thread only.
+    """
+    _cmd_generator = None
+    _race_cmd_generator = None
+    _targets = None
+    _auth_data = None
+    _cache_size = None
+    _poll_interval = 0.05
+    _created_count = 0
+    _reused_count = 0
+    _evicted_count = 0
+
+    def __init__(self, cache_size, cmd_generator=None):
+        self._cmd_generator = cmdgen.CommandGenerator() if cmd_generator is None else cmd_generator
+        self._targets = OrderedDict()
+        self._auth_data = {}
+        self._cache_size = cache_size
+
+    @property
+    def cmd_generator(self):
+        return self._cmd_generator
+
+    def get_auth_data(self, community, version):
+        key = (community, version)
+        auth_data = self._auth_data.get(key)
+        if auth_data is None:
+            # message processing model 0 is snmp v1, 1 is snmp v2c
+            auth_data = cmdgen.CommunityData(community, mpModel=0 if version == "1" else 1)
+            self._auth_data[key] = auth_data
+        return auth_data
+
+    def get_target(self, address, port, community):
+        # least recently used targets are evicted when the cache is full
+        key = (address, port, community)
+        target = self._targets.pop(key, None)
+        if target is None:
+            target = cmdgen.UdpTransportTarget((address, port))
+            self._created_count += 1
+            if len(self._targets) >= self._cache_size:
+                self._targets.popitem(last=False)
+                self._evicted_count += 1
+        else:
+            self._reused_count += 1
+        self._targets[key] = target
+        return target
+
+    def get_statistics(self):
+        return dict(TargetsCreated=self._created_count, TargetsReused=self._reused_count,
+                    TargetsEvicted=self._evicted_count)
+
+    def race_get(self, candidates, port, community, version, oids, race_delay, on_response=None):
+        """
+        Send get request to candidate addresses as AddressRace and block until the race is decided, return tuple of
+        winning address (None when all candidates failed) and its response.
+        """
+        def _send(cmd_generator, auth_data, target, callback_info):
+            cmd_generator.asyncGetCmd(auth_data, target, oids, callback_info)
+        return self._race(candidates, port, community, version, race_delay, on_response, _send)
+
+    def race_bulk(self, candidates, port, community, version, non_repeaters, max_repetitions, oids, race_delay,
+                  on_response=None):
+        """Race one getbulk request as race_get does, response carries varbind table."""
+        def _send(cmd_generator, auth_data, target, callback_info):
+            cmd_generator.asyncBulkCmd(auth_data, target, non_repeaters, max_repetitions, oids, callback_info)
+        return self._race(candidates, port, community, version, race_delay, on_response, _send)
+
+    def _race(self, candidates, port, community, version, race_delay, on_response, send_request):
+        if self._race_cmd_generator is None:
+            # blocking command generator can not keep more requests in flight, race has its own dispatcher
+            self._race_cmd_generator = cmdgen.AsynCommandGenerator()
+        cmd_generator = self._race_cmd_generator
+        auth_data = self.get_auth_data(community, version)
+        timers = []
+        timer_counter = itertools.count()
+        result = []
+
+        def _send(address, callback):
+            send_request(cmd_generator, auth_data, self.get_target(address, port, community),
+                         (_forward_response, callback))
+
+        def _schedule(delay, function):
+            heapq.heappush(timers, (time.time() + delay, next(timer_counter), function))
+
+        AddressRace(candidates, race_delay, _send, _schedule, lambda *args: result.append(args), on_response).start()
+        while len(result) < 1:
+            while len(timers) > 0 and timers[0][0] <= time.time():
+                heapq.heappop(timers)[2]()
+            dispatcher = cmd_generator.snmpEngine.transportDispatcher
+            if dispatcher is not None:
+                asyncore.poll(self._poll_interval, dispatcher.getSocketMap())
+                dispatcher.handleTimerTick(time.time())
+        return result[0]
+
+
+def _forward_response(send_request_handle, error_indication, error_status, error_index, var_binds, callback):
+    callback(error_indication, error_status, error_index, var_binds)
+
+
+class AddressRace(object):
+    """
+    The same get request raced over candidate addresses of one device. Candidates are started in order, next one
+    after race delay (negative delay waits for failure of the previous one) or immediately after all started
+    candidates failed. First successful response wins (tooBig is successful too, the address answered and request size
+    is left to the caller), "done" is called exactly once with winning address (or None) and its response (or the last
+    failed one). Responses received until the race is decided are reported to "on_response" with address, latency,
+    success flag and flag whether the response decided the race, late responses are discarded.
+    """
+    _candidates = None
+    _race_delay = None
+    _send = None
+    _schedule = None
+    _done = None
+    _on_response = None
+    _started = 0
+    _pending = 0
+    _finished = False
+    _last_response = None
+
+    def __init__(self, candidates, race_delay, send, schedule, done, on_response=None):
+        self._candidates = candidates
+        self._race_delay = race_delay
+        self._send = send
+        self._schedule = schedule
+        self._done = done
+        self._on_response = on_response
+
+    def start(self):
+        if len(self._candidates) < 1:
+            self._finish(None, ("no candidate addresses", None, None, []))
+            return
+        self._start_next()
+
+    def _start_next(self):
+        address = self._candidates[self._started]
+        self._started += 1
+        self._pending += 1
+        if self._started < len(self._candidates) and self._race_delay >= 0:
+            self._schedule(self._race_delay, partial(self._race_timeout, self._started))
+        self._send(address, partial(self._response_received, address, time.time()))
+
+    def _race_timeout(self, started):
+        # timer is ignored when race is decided or next candidate was already started after failure
+        if not self._finished and self._started == started:
+            self._start_next()
+
+    def _response_received(self, address, send_time, error_indication, error_status, error_index, var_binds):
+        self._pending -= 1
+        if self._finished:
+            return
+        successful = not error_indication and (not error_status or int(error_status) == ERROR_STATUS_TOO_BIG)
+        deciding = successful or (self._pending == 0 and self._started == len(self._candidates))
+        if self._on_response is not None:
+            self._on_response(address, time.time() - send_time, successful, deciding)
+        if successful:
+            self._finish(address, (error_indication, error_status, error_index, var_binds))
+        elif self._pending == 0 and self._started < len(self._candidates):
+            self._last_response = (error_indication, error_status, error_index, var_binds)
+            self._start_next()
+        elif deciding:
+            self._finish(None, (error_indication, error_status, error_index, var_binds))
+        else:
+            self._last_response = (error_indication, error_status, error_index, var_binds)
+
+    def _finish(self, address, response):
+        self._finished = True
+        self._done(address, response)
+
+
+class SnmpRequest(object):
+    command = None
+    address = None
+    port = None
+    community = None
+    version = None
+    oids = None
+    max_repetitions = None
+    non_repeaters = 0
+    _callback = None
+
+    def __init__(self, command, address, port, community, version, oids, max_repetitions, callback,
+                 non_repeaters=0):
+        self.command = command
+        self.address = address
+        self.port = port
+        self.community = community
+        self.version = version
+        self.oids = oids
+        self.max_repetitions = max_repetitions
+        self.non_repeaters = non_repeaters
+        self._callback = callback
+
+    @property
+    def agent(self):
+        return self.address, self.port
+
+    def _complete(self, error_indication, error_status, error_index, var_binds):
+        self._callback(error_indication, error_status, error_index, var_binds)
+
+
+class AsyncSnmpService(threading.Thread):
+    """
+    One pysnmp dispatcher keeping requests to many agents in flight at once.
+
+    Requests are submitted from any thread, they are sent by the service thread which is the only one touching pysnmp
+    objects. Every request is one PDU (get, getnext or getbulk without continuation), callback is called from the
+    service thread with error indication, error status, error index and varbinds (varbind table for getnext/getbulk).
+    """
+    _logger = logging.getLogger("snmp-service")
+    _engine = None
+    _submitted = None
+    _max_in_flight_per_agent = None
+    _in_flight = None
+    _waiting = None
+    _in_flight_count = 0
+    _poll_interval = 0.05
+    _idle_interval = 1
+    _lock = None
+    _timers = None
+    _timer_counter = 0
+    _sent_count = 0
+    _completed_count = 0
+    _running = False
+
+    def __init__(self, transport_cache_size, max_in_flight_per_agent):
+        threading.Thread.__init__(self, name="snmp-service")
+        self._engine = SnmpEngine(transport_cache_size, cmdgen.AsynCommandGenerator())
+        with _engine_list_lock:
+            _engine_list.append(self._engine)
+        self._submitted = Queue()
+        self._max_in_flight_per_agent = max_in_flight_per_agent
+        self._in_flight = {}
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._timers = []
+        self._running = True
+
+    def get(self, address, port, community, version, oids, callback):
+        self._submitted.put(SnmpRequest("get", address, port, community, version, oids, None, callback))
+
+    def get_next(self, address, port, community, version, oids, callback):
+        self._submitted.put(SnmpRequest("next", address, port, community, version, oids, None, callback))
+
+    def get_bulk(self, address, port, community, version, oids, max_repetitions, callback, non_repeaters=0):
+        self._submitted.put(SnmpRequest("bulk", address, port, community, version, oids, max_repetitions, callback,
+                                        non_repeaters))
+
+    def call_later(self, delay, function):
+        """Call function from the service thread after given number of seconds."""
+        with self._lock:
+            self._timer_counter += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._timer_counter, function))
+        # empty submission wakes up idle service thread to recompute its sleep time
+        self._submitted.put(None)
+
+    def race_get(self, candidates, port, community, version, oids, race_delay, done, on_response=None):
+        """Send get request to candidate addresses as AddressRace, done is called from the service thread."""
+        def _send(address, callback):
+            self.get(address, port, community, version, oids, callback)
+        # race state is touched only by the service thread
+        self.call_later(0, AddressRace(candidates, race_delay, _send, self.call_later, done, on_response).start)
+
+    def race_bulk(self, candidates, port, community, version, non_repeaters, max_repetitions, oids, race_delay, done,
+                  on_response=None):
+        """Race one getbulk request as race_get does, response carries varbind table."""
+        def _send(address, callback):
+            self.get_bulk(address, port, community, version, oids, max_repetitions, callback, non_repeaters)
+        self.call_later(0, AddressRace(candidates, race_delay, _send, self.call_later, done, on_response).start)
+
+    def get_statistics(self):
+        with self._lock:
+            return dict(InFlight=self._in_flight_count, Waiting=sum(len(x) for x in self._waiting.itervalues()),
+                        Submitted=self._submitted.qsize(), Sent=self._sent_count, Completed=self._completed_count)
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        self._logger.info("starting snmp service, max in-flight requests per agent=%d",
+                          self._max_in_flight_per_agent)
+        while self._running:
+            # service thread is the only one sending requests of all probes, it must survive any failure
+            try:
+                self._run_once()
+            except Exception:
+                self._logger.exception("snmp service failed")
+
+    def _run_once(self):
+        # service thread sleeps on the submission queue when there is nothing to wait for on the network
+        self._accept_requests(self._get_idle_timeout() if self._in_flight_count == 0 else 0)
+        self._run_timers()
+        dispatcher = self._engine.cmd_generator.snmpEngine.transportDispatcher
+        if dispatcher is None or self._in_flight_count == 0:
+            return
+        try:
+            asyncore.poll(self._poll_interval, dispatcher.getSocketMap())
+            dispatcher.handleTimerTick(time.time())
+        except Exception:
+            self._logger.exception("snmp dispatcher failed")
+
+    def _get_idle_timeout(self):
+        with self._lock:
+            if len(self._timers) < 1:
+                return self._idle_interval
+            return min(self._idle_interval, max(0.001, self._timers[0][0] - time.time()))
+
+    def _run_timers(self):
+        while True:
+            with self._lock:
+                if len(self._timers) < 1 or self._timers[0][0] > time.time():
+                    return
+                function = heapq.heappop(self._timers)[2]
+            try:
+                function()
+            except Exception:
+                self._logger.exception("snmp service timer failed")
+
+    def _accept_requests(self, timeout):
+        try:
+            request = self._submitted.get(True, timeout) if timeout > 0 else self._submitted.get_nowait()
+            while True:
+                if request is not None:
+                    self._enqueue(request)
+                request = self._submitted.get_nowait()
+        except Empty:
+            pass
+
+    def _enqueue(self, request):
+        # requests above per-agent limit wait for completion of older request to the same agent
+        if self._in_flight.get(request.agent, 0) < self._max_in_flight_per_agent:
+            self._send(request)
+        else:
+            with self._lock:
+                self._waiting.setdefault(request.agent, deque()).append(request)
+
+    def _send(self, request):
+        with self._lock:
+            self._in_flight[request.agent] = self._in_flight.get(request.agent, 0) + 1
+            self._in_flight_count += 1
+            self._sent_count += 1
+
+        cmd_generator = self._engine.cmd_generator
+        callback_info = (self._response_received, request)
+        try:
+            # unresolvable address fails here, the request is completed with error and its in-flight slot released
+            auth_data = self._engine.get_auth_data(request.community, request.version)
+            target = self._engine.get_target(request.address, request.port, request.community)
+            if request.command == "get":
+                cmd_generator.asyncGetCmd(auth_data, target, request.oids, callback_info)
+            elif request.command == "next":
+                cmd_generator.asyncNextCmd(auth_data, target, request.oids, callback_info)
+            else:
+                cmd_generator.asyncBulkCmd(auth_data, target, request.non_repeaters, request.max_repetitions,
+                                           request.oids, callback_info)
+        except Exception as e:
+            self._logger.exception("failed to send snmp request to %s", request.address)
+            self._response_received(None, str(e), 0, 0, [], request)
+
+    def _response_received(self, send_request_handle, error_indication, error_status, error_index, var_binds,
+                           request):
+        with self._lock:
+            self._in_flight[request.agent] -= 1
+            self._in_flight_count -= 1
+            self._completed_count += 1
+            waiting = self._waiting.get(request.agent)
+            next_request = waiting.popleft() if waiting else None
+            if waiting is not None and len(waiting) < 1:
+                del self._waiting[request.agent]
+            if self._in_flight[request.agent] == 0:
+                del self._in_flight[request.agent]
+
+        try:
+            request._complete(error_indication, error_status, error_index, var_binds)
+        except Exception:
+            self._logger.exception("snmp request callback failed")
+
+        if next_request is not None:
+            self._send(next_request)
+        # getnext and getbulk requests are never continued by pysnmp, caller sends the next chunk itself
+        return False
+
+
+def is_timeout(error_indication):
+    return isinstance(error_indication, errind.RequestTimedOut)
+
+
+def parse_oid(oid):
+    return tuple(int(part) for part in str(oid).strip(".").split("."))
+
+
+def format_oid(oid_tuple):
+    return ".".join([str(part) for part in oid_tuple])
+
+
+def decode_value(value):
+    """
+    Return string representation of varbind value, same as value.prettyOut(value) of pyasn1 types.
+    Decoder is selected once per value class, plain integer and octet string types skip the generic pyasn1 path.
+    """
+    value_class = value.__class__
+    decoder = _value_decoders.get(value_class)
+    if decoder is None:
+        decoder = _get_value_decoder(value_class)
+        _value_decoders[value_class] = decoder
+    return decoder(value)
+
+
+def _get_value_decoder(value_class):
+    pretty_out = getattr(value_class.prettyOut, "__func__", None)
+    if issubclass(value_class, univ.Integer) and pretty_out is _integer_pretty_out and \
+            len(value_class.namedValues) == 0:
+        return _decode_integer
+    if issubclass(value_class, univ.OctetString) and pretty_out is _octet_string_pretty_out:
+        return _decode_octet_string
+    if issubclass(value_class, univ.ObjectIdentifier) and pretty_out is _object_identifier_pretty_out:
+        return _decode_object_identifier
+    return _decode_generic
+
+
+def _decode_integer(value):
+    return str(int(value))
+
+
+def _decode_octet_string(value):
+    # printable strings are returned as they are, others as hexadecimal string
+    octets = value.asOctets()
+    if _printable_octets.match(octets):
+        return octets
+    return "0x" + binascii.hexlify(octets)
+
+
+def _decode_object_identifier(value):
+    return format_oid(value.asTuple())
+
+
+def _decode_generic(value):
+    return value.prettyOut(value)
+
+
+_value_decoders = {}
+_printable_octets = re.compile(r"^[\x20-\x7e]*\Z")
+_integer_pretty_out = univ.Integer.prettyOut.__func__
+_octet_string_pretty_out = univ.OctetString.prettyOut.__func__
+_object_identifier_pretty_out = univ.ObjectIdentifier.prettyOut.__func__
+
+
+class TablePlan(object):
+    """
+    Compiled walk structure of one table configuration (column oid prefixes and names), shared by walks of the table.
+    """
+    _logger = logging.getLogger("snmp-walk")
+    base_oid = None
+    column_name_mode = "manual-multi-level"
+    column_prefixes = None
+    column_names = None
+    asl_prefix = ""
+    asl_style = "list"
+
+    def __init__(self, table_config):
+        self.base_oid = table_config["BaseOid"]
+        base_oid = parse_oid(self.base_oid)
+
+        if not "ColumnNameMode" in table_config:
+            self._logger.info("no ColumnNameMode specified, assuming manual-multi-level")
+        elif table_config["ColumnNameMode"] == "auto-single-level" or \
+                table_config["ColumnNameMode"] == "manual-multi-level":
+            self.column_name_mode = table_config["ColumnNameMode"]
+
+        if self.column_name_mode == "manual-multi-level":
+            columns = sorted((int(col_oid), col_name) for col_name, col_oid in table_config["Columns"].iteritems())
+            self.column_prefixes = [base_oid + (col_oid,) for col_oid, col_name in columns]
+            self.column_names = [col_name for col_oid, col_name in columns]
+        else:
+            if "ColumnNamePrefix" in table_config:
+                self.asl_prefix = table_config["ColumnNamePrefix"]
+            else:
+                self._logger.debug("no prefix for auto-single-level mode, assuming none")
+
+            if not "SingleLevelTableStyle" in table_config:
+                self._logger.debug("no prefix for auto-single-level mode, assuming list")
+            elif table_config["SingleLevelTableStyle"] == "list" or table_config["SingleLevelTableStyle"] == "dict":
+                self.asl_style = table_config["SingleLevelTableStyle"]
+
+            self.column_prefixes = [base_oid]
+            self.column_names = [None]
+
+
+class TableWalk(object):
+    """
+    Column-targeted walk of one snmp table.
+
+    Every configured column is walked as a separate varbind of the same request, each column is finished as soon as
+    the agent returns oid outside of that column. The walk is driven by caller, which sends oids returned by
+    get_request_oids() (GETNEXT or GETBULK) and passes the received varbind table to feed().
+    Received oids are handled as integer tuples, row index string is built only once per row.
+
+    Walk with a sink starts streaming when it holds more than stream_threshold rows: rows which can not receive more
+    values (all walked columns are past them) are written to the sink, table_data holds only incomplete rows then.
+    """
+    _logger = logging.getLogger("snmp-walk")
+    base_oid = None
+    column_name_mode = "manual-multi-level"
+    table_data = None
+    _column_prefixes = None
+    _column_names = None
+    _cursors = None
+    _row_map = None
+    _asl_prefix = ""
+    _asl_style = "list"
+    _sink = None
+    _stream_threshold = 0
+    _streaming = False
+
+    def __init__(self, table_config, sink=None, stream_threshold=0):
+        # table configuration is compiled for every walk unless its compiled plan is passed
+        plan = table_config if isinstance(table_config, TablePlan) else TablePlan(table_config)
+        self.base_oid = plan.base_oid
+        self.column_name_mode = plan.column_name_mode
+        self._column_prefixes = plan.column_prefixes
+        self._column_names = plan.column_names
+        self._asl_prefix = plan.asl_prefix
+        self._asl_style = plan.asl_style
+
+        if self.column_name_mode == "manual-multi-level":
+            self.table_data = []
+            self._row_map = {}
+        else:
+            self.table_data = {} if self._asl_style == "dict" else []
+
+        # cursor is the last oid received for the column, None when the column is finished
+        self._cursors = list(self._column_prefixes)
+        self._sink = sink
+        self._stream_threshold = stream_threshold
+
+    def is_done(self):
+        return all(cursor is None for cursor in self._cursors)
+
+    def get_request_oids(self):
+        return [format_oid(cursor) for cursor in self._cursors if cursor is not None]
+
+    def get_column_count(self):
+        return sum(1 for cursor in self._cursors if cursor is not None)
+
+    def finish(self):
+        self._cursors = [None] * len(self._cursors)
+
+    def finish_column(self, request_position):
+        # position is index of the column oid in the last get_request_oids() list
+        slots = [index for index, cursor in enumerate(self._cursors) if cursor is not None]
+        self._cursors[slots[request_position]] = None
+
+    def feed(self, var_bind_table):
+        # varbinds of every row are ordered as oids returned by get_request_oids() at the time of request
+        slots = [(index, self._column_prefixes[index], len(self._column_prefixes[index]))
+                 for index, cursor in enumerate(self._cursors) if cursor is not None]
+        if len(var_bind_table) < 1:
+            self.finish()
+            return
+
+        cursors = self._cursors
+        multi_level = self.column_name_mode == "manual-multi-level"
+        for var_bind_row in var_bind_table:
+            for (slot, prefix, prefix_length), (oid, value) in zip(slots, var_bind_row):
+                cursor = cursors[slot]
+                if cursor is None:
+                    continue
+                oid = oid.asTuple()
+                # end of mib view, column boundary or non-increasing oid finishes the column
+                if oid[:prefix_length] != prefix or oid <= cursor or isinstance(value, univ.Null) or \
+                        len(oid) == prefix_length:
+                    cursors[slot] = None
+                    continue
+                cursors[slot] = oid
+                if multi_level:
+                    self._store_row_value(slot, oid[prefix_length:], decode_value(value))
+                else:
+                    self._store_single_level_value(oid[prefix_length:], decode_value(value))
+
+        if self._sink is not None and (self._streaming or len(self.table_data) > self._stream_threshold):
+            self._streaming = True
+            self._stream_rows()
+
+    def is_streamed(self):
+        return self._streaming
+
+    def is_stream_blocked(self):
+        """Return True when streamed rows still wait for the sink, the walk should not request more rows then."""
+        return self._streaming and not self._sink.flush()
+
+    def close_stream(self, complete):
+        """Write all remaining rows to the sink and return its reference."""
+        self.finish()
+        self._stream_rows()
+        return self._sink.close(complete)
+
+    def _stream_rows(self):
+        if self.column_name_mode != "manual-multi-level":
+            rows = self.table_data if self._asl_style == "list" else \
+                [dict(Name=name, Value=value) for name, value in sorted(self.table_data.iteritems())]
+            self.table_data = {} if self._asl_style == "dict" else []
+        elif self.is_done():
+            rows = [self._row_map[row_key] for row_key in sorted(self._row_map)]
+            self.table_data = []
+            self._row_map = {}
+        else:
+            # rows below the lowest cursor of unfinished columns are complete
+            watermark = min(cursor[len(prefix):] for cursor, prefix in zip(self._cursors, self._column_prefixes)
+                            if cursor is not None)
+            rows = [self._row_map.pop(row_key) for row_key in sorted(self._row_map) if row_key < watermark]
+            streamed = set(id(row) for row in rows)
+            self.table_data = [row for row in self.table_data if not id(row) in streamed]
+        if len(rows) > 0:
+            self._sink.write_rows(rows)
+
+    def _store_row_value(self, slot, row_key, value):
+        row = self._row_map.get(row_key)
+        if row is None:
+            row = {"RowIndex": format_oid(row_key)}
+            self.table_data.append(row)
+            self._row_map[row_key] = row
+        row[self._column_names[slot]] = value
+
+    def _store_single_level_value(self, item_key, value):
+        if len(item_key) != 1:
+            self._logger.error("not a valid single level structure for oid %s.%s", self.base_oid, format_oid(item_key))
+            return
+        item_name = "{}{}".format(self._asl_prefix, item_key[0])
+        if self._asl_style == "dict":
+            self.table_data[item_name] = value
+        else:
+            self.table_data.append(dict(Name=item_name, Value=value))
+
+
+class WalkGroup(object):
+    """
+    Table walks requested together, columns of all unfinished walks are sent side by side in one request. Group is
+    driven the same way as a single TableWalk.
+    """
+    walks = None
+
+    def __init__(self, walks):
+        self.walks = walks
+
+    def is_done(self):
+        return all(walk.is_done() for walk in self.walks)
+
+    def get_request_oids(self):
+        request_oids = []
+        for walk in self.walks:
+            request_oids.extend(walk.get_request_oids())
+        return request_oids
+
+    def finish(self):
+        for walk in self.walks:
+            walk.finish()
+
+    def is_stream_blocked(self):
+        # every walk gets the chance to flush its rows
+        return any([walk.is_stream_blocked() for walk in self.walks])
+
+    def finish_column(self, request_position):
+        for walk in self.walks:
+            column_count = walk.get_column_count()
+            if request_position < column_count:
+                walk.finish_column(request_position)
+                return
+            request_position -= column_count
+
+    def feed(self, var_bind_table):
+        if len(var_bind_table) < 1:
+            self.finish()
+            return
+        position = 0
+        for walk, column_count in [(walk, walk.get_column_count()) for walk in self.walks]:
+            if column_count > 0:
+                walk.feed([var_bind_row[position:position + column_count] for var_bind_row in var_bind_table])
+                position += column_count
+
+
+def group_walks(walks, max_varbinds):
+    """
+    Pack walks, in their order, into groups requesting at most max_varbinds columns at once, wider walk is a group on
+    its own. Columns of finished walks drop out of the request, so grouping does not add requests for large tables.
+    """
+    groups = []
+    group_walk_list = []
+    column_count = 0
+    for walk in walks:
+        walk_column_count = walk.get_column_count()
+        if len(group_walk_list) > 0 and column_count + walk_column_count > max_varbinds:
+            groups.append(WalkGroup(group_walk_list))
+            group_walk_list = []
+            column_count = 0
+        group_walk_list.append(walk)
+        column_count += walk_column_count
+    if len(group_walk_list) > 0:
+        groups.append(WalkGroup(group_walk_list))
+    return groups
+
+
+class CoalescedRequest(object):
+    """
+    Scalar info oids and the first chunk of a walk group in one GETBULK request. Scalars (oids ending with .0) are
+    sent as non-repeaters by their parent oid, the scalar itself is the next oid returned by the agent.
+    """
+    info_oids = None
+    group = None
+    oids = None
+    non_repeaters = None
+    max_repetitions = None
+
+    def __init__(self, info_oids, group, max_varbinds):
+        self.info_oids = info_oids
+        self.group = group
+        table_oids = group.get_request_oids()
+        self.oids = [oid[:-2] for oid in info_oids] + table_oids
+        self.non_repeaters = len(info_oids)
+        self.max_repetitions = max(1, (max_varbinds - self.non_repeaters) // len(table_oids))
+
+    @staticmethod
+    def supports(info_oids):
+        return all(oid.endswith(".0") for oid in info_oids)
+
+    def feed(self, var_bind_table):
+        """
+        Feed table chunk of the response into the group and return varbinds of info oids, or None when the response
+        carried no complete row (group is not fed then). Scalars missing on the agent are noSuchObject, as in response
+        to get request.
+        """
+        if len(var_bind_table) < 1:
+            return None
+        info_var_binds = []
+        for (oid, value), info_oid in zip(var_bind_table[0][:self.non_repeaters], self.info_oids):
+            if oid.asTuple() != parse_oid(info_oid) or isinstance(value, univ.Null):
+                oid, value = rfc1902.ObjectName(info_oid), rfc1905.noSuchObject
+            info_var_binds.append((oid, value))
+        self.group.feed([var_bind_row[self.non_repeaters:] for var_bind_row in var_bind_table])
+        return info_var_binds
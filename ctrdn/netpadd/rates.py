@@ -0,0 +1,83 @@
+import threading
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class RateEngine(object):
+    _samples = None
+    _lock = None
+
+    def __init__(self):
+        # (device id, table name) -> (timestamp, uptime, counter columns, {row index: counter values tuple})
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def compute(self, device_id, table_name, timestamp, uptime, counters, rows):
+        """
+        Store current counter values of table rows and return per-second rates against the previous sample.
+        "counters" maps counter column names to their bit width (32, 64), "rows" is a list of (row index, row dict).
+        """
+        columns = tuple(sorted(counters.iterkeys()))
+        widths = tuple(counters[column] for column in columns)
+        current_rows = {}
+        for row_index, row in rows:
+            current_rows[row_index] = tuple(_to_counter(row.get(column)) for column in columns)
+
+        key = (device_id, table_name)
+        with self._lock:
+            previous = self._samples.get(key)
+            self._samples[key] = (timestamp, uptime, columns, current_rows)
+
+        if previous is None:
+            return []
+        previous_timestamp, previous_uptime, previous_columns, previous_rows = previous
+        interval = timestamp - previous_timestamp
+        if previous_columns != columns or interval <= 0:
+            return []
+        # counters of restarted agent start from zero, there is no valid delta across the restart
+        if uptime is not None and previous_uptime is not None and uptime < previous_uptime:
+            return []
+
+        rates = []
+        for row_index, values in current_rows.iteritems():
+            previous_values = previous_rows.get(row_index)
+            if previous_values is None:
+                continue
+            row_rates = {}
+            for column, width, value, previous_value in zip(columns, widths, values, previous_values):
+                if value is None or previous_value is None:
+                    continue
+                delta = value - previous_value
+                if delta < 0 and width == 32:
+                    delta += 1 << 32
+                if delta < 0:
+                    # 64-bit counters do not wrap in practice, negative delta is a counter discontinuity
+                    continue
+                row_rates[column] = float(delta) / interval
+            if len(row_rates) > 0:
+                row_rates["RowIndex"] = row_index
+                rates.append(row_rates)
+        return rates
+
+    def skip(self, device_id, table_name):
+        """
+        Drop the sample of table whose rates are not computed in this poll, so rates are not computed over the gap.
+        Return True when rates of the table were not skipped in its previous poll.
+        """
+        key = (device_id, table_name)
+        with self._lock:
+            skipped = key in self._samples and self._samples[key] is None
+            self._samples[key] = None
+        return not skipped
+
+    def forget(self, device_id):
+        with self._lock:
+            for key in [key for key in self._samples.iterkeys() if key[0] == device_id]:
+                del self._samples[key]
+
+
+def _to_counter(value):
+    try:
+        return long(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,140 @@
+import json
+import threading
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class RefreshPlan(object):
+    """
+    Entries of one snmp poll, "info_names" and "table_names" are fetched, "info_on_change" and "tables_on_change" are
+    fetched only when device change is detected, all other entries are served from previous polls.
+    """
+    info_names = None
+    table_names = None
+    info_on_change = None
+    tables_on_change = None
+    change_detected = False
+
+    def __init__(self):
+        self.info_names = []
+        self.table_names = []
+        self.info_on_change = []
+        self.tables_on_change = []
+
+    def requires_change_check(self):
+        return len(self.info_on_change) > 0 or len(self.tables_on_change) > 0
+
+    def apply_change(self):
+        # returns info entries which were not requested yet
+        self.change_detected = True
+        info_names = self.info_on_change
+        self.info_names.extend(self.info_on_change)
+        self.table_names.extend(self.tables_on_change)
+        self.info_on_change = []
+        self.tables_on_change = []
+        return info_names
+
+
+class RefreshTracker(object):
+    _devices = None
+    _lock = None
+    # polls are not perfectly periodic, entry is refreshed slightly before its interval elapses
+    _interval_tolerance = 0.95
+
+    def __init__(self):
+        # device id -> dict(Entries={(kind, name): (timestamp, fingerprint, data)}, Uptime=..., Indicator=...)
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def create_plan(self, device_id, probe_config, timestamp):
+        plan = RefreshPlan()
+        with self._lock:
+            entries = self._devices.get(device_id, {}).get("Entries", {})
+            for name, entry_config in probe_config["SnmpInfoDictionary"].iteritems():
+                interval, mode = get_entry_refresh(entry_config)
+                self._plan_entry(plan.info_names, plan.info_on_change, entries.get(("info", name)), name,
+                                 _fingerprint(entry_config), interval, mode, timestamp)
+            for name, table_config in probe_config["SnmpTableDictionary"].iteritems():
+                interval, mode = get_entry_refresh(table_config)
+                self._plan_entry(plan.table_names, plan.tables_on_change, entries.get(("table", name)), name,
+                                 _fingerprint(table_config), interval, mode, timestamp)
+        return plan
+
+    def _plan_entry(self, fetch_list, on_change_list, cached, name, fingerprint, interval, mode, timestamp):
+        if cached is None or cached[1] != fingerprint:
+            fetch_list.append(name)
+            return
+        expired = interval is None or timestamp - cached[0] >= interval * self._interval_tolerance
+        if mode == "change":
+            # entries refreshed on change have no interval by default, interval is their maximum age
+            expired = interval is not None and expired
+            if not expired:
+                on_change_list.append(name)
+                return
+        if expired:
+            fetch_list.append(name)
+
+    def detect_change(self, device_id, uptime, indicator, indicator_checked):
+        """
+        Store current sysUptime and change indicator value (None when it could not be fetched) of device and return
+        True when agent restarted (uptime went backwards) or change indicator differs from its previous value.
+        """
+        with self._lock:
+            state = self._devices.setdefault(device_id, dict(Entries={}, Uptime=None, Indicator=None))
+            changed = False
+            if uptime is not None and state["Uptime"] is not None and uptime < state["Uptime"]:
+                changed = True
+            if uptime is not None:
+                state["Uptime"] = uptime
+            if indicator_checked:
+                if indicator is None or indicator != state["Indicator"]:
+                    changed = True
+                state["Indicator"] = indicator
+            return changed
+
+    def update(self, device_id, probe_config, plan, timestamp, info_data, tables_data):
+        """
+        Store fetched entries and return info data and tables data completed with entries of previous polls, together
+        with names of entries served from previous polls.
+        """
+        info_data = dict(info_data)
+        tables_data = dict(tables_data)
+        cached_entries = dict(Info=[], Tables=[])
+        with self._lock:
+            entries = self._devices.setdefault(device_id, dict(Entries={}, Uptime=None, Indicator=None))["Entries"]
+            for name, entry_config in probe_config["SnmpInfoDictionary"].iteritems():
+                self._update_entry(entries, ("info", name), name in plan.info_names, info_data, name, entry_config,
+                                   timestamp, cached_entries["Info"])
+            for name, table_config in probe_config["SnmpTableDictionary"].iteritems():
+                self._update_entry(entries, ("table", name), name in plan.table_names, tables_data, name,
+                                   table_config, timestamp, cached_entries["Tables"])
+        return info_data, tables_data, cached_entries
+
+    @staticmethod
+    def _update_entry(entries, key, fetched, data, name, entry_config, timestamp, cached_list):
+        if fetched:
+            # entries which failed to be fetched are fetched again on next poll, entries fetched in every poll are
+            # never served from cache, so their data is not kept
+            interval, mode = get_entry_refresh(entry_config)
+            if name in data and (interval is not None or mode == "change"):
+                entries[key] = (timestamp, _fingerprint(entry_config), data[name])
+            else:
+                entries.pop(key, None)
+        elif key in entries:
+            data[name] = entries[key][2]
+            cached_list.append(name)
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+
+def get_entry_refresh(entry_config):
+    # info entries are plain oid strings or dicts with Oid key, tables are always dicts
+    if not isinstance(entry_config, dict):
+        return None, "interval"
+    return entry_config.get("PollInterval"), entry_config.get("RefreshMode", "interval")
+
+
+def _fingerprint(entry_config):
+    return json.dumps(entry_config, sort_keys=True)
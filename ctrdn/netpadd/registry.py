@@ -0,0 +1,84 @@
+import importlib
+import logging
+import os
+import threading
+from os import listdir
+from os.path import isfile, join
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class ProbeRegistry(object):
+    """
+    Probe modules and their instances, looked up by probe name. Every probe has one instance shared by all pollers
+    (probes must be thread-safe), created and configured once. Instances are set up once in every process using them,
+    so background threads and sockets held by probes are never shared by forked processes.
+    """
+    _logger = logging.getLogger("probe-registry")
+    _config = None
+    _db = None
+    _modules = None
+    _probes = None
+    _setup_pid = None
+    _lock = None
+
+    def __init__(self, config, db):
+        self._config = config
+        """:type : ConfigParser"""
+        self._db = db
+        """:type : Database"""
+        self._modules = {}
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def load(self, probes_path):
+        probe_files = [f for f in listdir(probes_path) if isfile(join(probes_path, f))]
+        for probe_file in sorted(probe_files):
+            if probe_file.startswith("probe_") and probe_file.endswith(".py"):
+                probe_class_name = probes_path.replace("/", ".") + "." + probe_file.replace(".py", "")
+                self._logger.debug("importing probe " + probe_class_name)
+                self.register(importlib.import_module(probe_class_name))
+
+    def register(self, module):
+        probe_name = module.get_probe_name()
+        assert not probe_name in self._modules, "probe %s is already registered" % probe_name
+        self._modules[probe_name] = module
+        self._probes[probe_name] = module.Probe(self._config, self._db)
+        self._logger.info("imported probe " + probe_name + " (" + module.get_probe_description() + ") v" +
+                          module.get_probe_version())
+
+    def get_module(self, probe_name):
+        return self._modules.get(probe_name)
+
+    def get_probe(self, probe_name):
+        probe = self._probes.get(probe_name)
+        if probe is not None and self._setup_pid != os.getpid():
+            self.setup()
+        return probe
+
+    def setup(self):
+        with self._lock:
+            if self._setup_pid == os.getpid():
+                return
+            for probe_name, probe in self._probes.iteritems():
+                probe.setup()
+                self._logger.debug("set up probe %s", probe_name)
+            self._setup_pid = os.getpid()
+
+    def forget_device(self, device_id):
+        for probe_name, probe in self._probes.iteritems():
+            try:
+                probe.forget_device(device_id)
+            except Exception:
+                self._logger.exception("failed to forget device %s in probe %s", device_id, probe_name)
+
+    def teardown(self):
+        with self._lock:
+            if self._setup_pid != os.getpid():
+                return
+            for probe_name, probe in self._probes.iteritems():
+                try:
+                    probe.teardown()
+                except Exception:
+                    self._logger.exception("failed to tear down probe %s", probe_name)
+            self._setup_pid = None
@@ -0,0 +1,221 @@
+from calendar import timegm
+from datetime import datetime
+import logging
+import threading
+import time
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class RollupEngine(threading.Thread):
+    """
+    Aggregates raw metrics into tiers. Raw metrics are read from stored polls (document layout) or from metric
+    buckets (bucket layout). Period is aggregated once, grace period after its end, raw metrics written later than
+    that (result writer backlog) are not aggregated.
+    """
+    _logger = logging.getLogger("rollup")
+    _db = None
+    _probes = None
+    _interval = None
+    _grace_period = None
+    _max_window = 6 * 3600
+    _retention = None
+    _raw_source = None
+
+    # (tier name, tier period in seconds, source tier name or None for raw metrics)
+    TIERS = [("5m", 300, None), ("1h", 3600, "5m")]
+
+    def __init__(self, db, probes, interval, grace_period, retention, storage_layout="document"):
+        threading.Thread.__init__(self, name="rollup")
+        self._db = db
+        """:type : Database"""
+        self._probes = probes
+        """:type : ProbeRegistry"""
+        self._interval = interval
+        self._grace_period = grace_period
+        # retention in seconds for "raw" polls and every tier, zero keeps data forever
+        self._retention = retention
+        # raw metrics are read from poll documents whenever they are stored
+        assert storage_layout in ("document", "bucket", "both"), "%r is not supported storage layout" % storage_layout
+        self._raw_source = "metric" if storage_layout == "bucket" else "poll"
+
+    def run(self):
+        self._logger.info("starting rollup engine, interval=%ds, raw metrics from np.monitor.%s", self._interval,
+                          self._raw_source)
+        self._ensure_indexes()
+        while True:
+            try:
+                for tier_name, tier_period, source_tier in self.TIERS:
+                    self._process_tier(tier_name, tier_period, source_tier)
+            except Exception:
+                self._logger.exception("rollup failed")
+            time.sleep(self._interval)
+
+    def _ensure_indexes(self):
+        self._ensure_ttl_index(self._db.np.monitor.poll, "PollTimestamp", self._retention["raw"])
+        # streamed snmp tables are kept as long as raw polls referencing them
+        self._ensure_ttl_index(self._db.np.monitor.table, "PollTimestamp", self._retention["raw"])
+        self._ensure_ttl_index(self._db.np.monitor.table.chunk, "PollTimestamp", self._retention["raw"])
+        # bucket expires with its last sample
+        self._ensure_ttl_index(self._db.np.monitor.metric, "End", self._retention["raw"])
+        # buckets overlapping aggregated window
+        self._db.np.monitor.metric.create_index([("Start", ASCENDING), ("End", ASCENDING)])
+        for tier_name, tier_period, source_tier in self.TIERS:
+            collection = self._get_tier_collection(tier_name)
+            collection.create_index([("DeviceId", ASCENDING), ("Metric", ASCENDING), ("Instance", ASCENDING),
+                                     ("Start", ASCENDING)], unique=True)
+            self._ensure_ttl_index(collection, "Start", self._retention[tier_name])
+
+    def _ensure_ttl_index(self, collection, field, retention):
+        if retention <= 0:
+            return
+        try:
+            collection.create_index([(field, ASCENDING)], expireAfterSeconds=retention)
+        except OperationFailure:
+            # index already exists with different retention
+            self._db.command("collMod", collection.name,
+                             index={"keyPattern": {field: ASCENDING}, "expireAfterSeconds": retention})
+        self._logger.debug("retention of %s set to %ds", collection.name, retention)
+
+    def _get_tier_collection(self, tier_name):
+        return self._db["np.monitor.rollup." + tier_name]
+
+    def _process_tier(self, tier_name, tier_period, source_tier):
+        # only closed periods are aggregated, so every period is processed exactly once
+        end = _floor_timestamp(time.time() - self._grace_period, tier_period)
+        if source_tier is not None:
+            source_watermark = self._get_watermark(source_tier)
+            if source_watermark is None:
+                return
+            end = _floor_timestamp(min(end, _to_timestamp(source_watermark)), tier_period)
+
+        watermark = self._get_watermark(tier_name)
+        if watermark is None:
+            start = self._find_first_timestamp(source_tier)
+            if start is None:
+                return
+            start = _floor_timestamp(start, tier_period)
+        else:
+            start = _to_timestamp(watermark)
+
+        # probe configurations decide which snmp columns of stored polls are metrics
+        probe_configs = None
+        if source_tier is None and self._raw_source == "poll" and start < end:
+            probe_configs = self._load_probe_configs()
+
+        while start < end:
+            window_end = min(end, start + max(self._max_window, tier_period))
+            window_end = _floor_timestamp(window_end, tier_period)
+            if source_tier is None and self._raw_source == "poll":
+                aggregates = self._aggregate_polls(probe_configs, start, window_end, tier_period)
+            elif source_tier is None:
+                aggregates = self._aggregate_buckets(start, window_end, tier_period)
+            else:
+                aggregates = self._aggregate_tier(source_tier, start, window_end, tier_period)
+            self._store_aggregates(tier_name, aggregates)
+            self._set_watermark(tier_name, window_end)
+            self._logger.debug("rolled up %d %s aggregates until %s", len(aggregates), tier_name,
+                               datetime.utcfromtimestamp(window_end))
+            start = window_end
+
+    def _find_first_timestamp(self, source_tier):
+        if source_tier is None and self._raw_source == "poll":
+            record = self._db.np.monitor.poll.find_one({}, {"PollTimestamp": 1}, sort=[("PollTimestamp", ASCENDING)])
+            return None if record is None else _to_timestamp(record["PollTimestamp"])
+        collection = self._db.np.monitor.metric if source_tier is None else self._get_tier_collection(source_tier)
+        record = collection.find_one({}, {"Start": 1}, sort=[("Start", ASCENDING)])
+        return None if record is None else _to_timestamp(record["Start"])
+
+    def _load_probe_configs(self):
+        probe_configs = {}
+        for device in self._db.np.core.device.find({}, {"MonitorConfiguration.Probes": 1}):
+            if "MonitorConfiguration" in device and "Probes" in device["MonitorConfiguration"]:
+                probe_configs[device["_id"]] = device["MonitorConfiguration"]["Probes"]
+        return probe_configs
+
+    def _aggregate_polls(self, probe_configs, start, end, period):
+        aggregates = {}
+        poll_list = self._db.np.monitor.poll.find(
+            {"PollTimestamp": {"$gte": datetime.utcfromtimestamp(start), "$lt": datetime.utcfromtimestamp(end)}},
+            {"DeviceId": 1, "PollTimestamp": 1, "ProbeResult": 1})
+        for poll in poll_list:
+            period_start = _floor_timestamp(_to_timestamp(poll["PollTimestamp"]), period)
+            device_probe_configs = probe_configs.get(poll["DeviceId"], {})
+            for probe_name, probe_stats in poll["ProbeResult"].iteritems():
+                probe_module = self._probes.get_module(probe_name)
+                if not hasattr(probe_module, "get_probe_metrics") or probe_stats["Result"] is None:
+                    continue
+                probe_config = self._probes.get_probe(probe_name).resolve_configuration(
+                    device_probe_configs.get(probe_name, {"SnmpTableDictionary": {}}))
+                for metric, instance, value in probe_module.get_probe_metrics(probe_config, probe_stats["Result"]):
+                    if value is None:
+                        continue
+                    key = (poll["DeviceId"], probe_name + "." + metric, instance, period_start)
+                    _merge_aggregate(aggregates, key, value, value, value, 1)
+        return aggregates
+
+    def _aggregate_buckets(self, start, end, period):
+        aggregates = {}
+        start_time, end_time = datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(end)
+        # buckets overlapping the window, their samples outside of it belong to other windows
+        bucket_list = self._db.np.monitor.metric.find({"Start": {"$lt": end_time}, "End": {"$gte": start_time}},
+                                                      {"DeviceId": 1, "Metric": 1, "Instance": 1, "Samples": 1})
+        for bucket in bucket_list:
+            for sample in bucket["Samples"]:
+                if sample["T"] < start_time or sample["T"] >= end_time or sample["V"] is None:
+                    continue
+                key = (bucket["DeviceId"], bucket["Metric"], bucket["Instance"],
+                       _floor_timestamp(_to_timestamp(sample["T"]), period))
+                _merge_aggregate(aggregates, key, sample["V"], sample["V"], sample["V"], 1)
+        return aggregates
+
+    def _aggregate_tier(self, source_tier, start, end, period):
+        aggregates = {}
+        source_list = self._get_tier_collection(source_tier).find(
+            {"Start": {"$gte": datetime.utcfromtimestamp(start), "$lt": datetime.utcfromtimestamp(end)}})
+        for source in source_list:
+            key = (source["DeviceId"], source["Metric"], source["Instance"],
+                   _floor_timestamp(_to_timestamp(source["Start"]), period))
+            _merge_aggregate(aggregates, key, source["Min"], source["Max"], source["Sum"], source["Count"])
+        return aggregates
+
+    def _store_aggregates(self, tier_name, aggregates):
+        if len(aggregates) < 1:
+            return
+        requests = []
+        for (device_id, metric, instance, period_start), (pt_min, pt_max, pt_sum, pt_count) in \
+                aggregates.iteritems():
+            key = dict(DeviceId=device_id, Metric=metric, Instance=instance,
+                       Start=datetime.utcfromtimestamp(period_start))
+            requests.append(UpdateOne(key, {"$set": dict(Min=pt_min, Max=pt_max, Sum=pt_sum, Count=pt_count,
+                                                         Average=float(pt_sum) / pt_count)}, upsert=True))
+        self._get_tier_collection(tier_name).bulk_write(requests, ordered=False)
+
+    def _get_watermark(self, tier_name):
+        record = self._db.np.monitor.rollup.state.find_one(dict(_id=tier_name))
+        return None if record is None else record["Watermark"]
+
+    def _set_watermark(self, tier_name, timestamp):
+        self._db.np.monitor.rollup.state.update_one(dict(_id=tier_name),
+                                                    {"$set": dict(Watermark=datetime.utcfromtimestamp(timestamp))},
+                                                    upsert=True)
+
+
+def _merge_aggregate(aggregates, key, pt_min, pt_max, pt_sum, pt_count):
+    aggregate = aggregates.get(key)
+    if aggregate is None:
+        aggregates[key] = (pt_min, pt_max, pt_sum, pt_count)
+    else:
+        aggregates[key] = (min(aggregate[0], pt_min), max(aggregate[1], pt_max), aggregate[2] + pt_sum,
+                           aggregate[3] + pt_count)
+
+
+def _to_timestamp(value):
+    return timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def _floor_timestamp(timestamp, period):
+    return int(timestamp) // period * period
+
@@ -0,0 +1,142 @@
+import heapq
+import logging
+import threading
+import time
+from pymongo import UpdateOne
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class PollScheduler(object):
+    _heap = None
+    _entries = None
+    _lock = None
+    _lag_count = 0
+    _lag_sum = 0.0
+    _lag_max = 0.0
+    _lag_last = 0.0
+
+    def __init__(self):
+        # heap items are (due time, device id, generation), items with stale generation are skipped when popped
+        self._heap = []
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, device_id, interval, due_time):
+        with self._lock:
+            generation = self._entries[device_id][0] + 1 if device_id in self._entries else 0
+            self._entries[device_id] = (generation, interval, due_time)
+            heapq.heappush(self._heap, (due_time, device_id, generation))
+
+    def remove(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def get_interval(self, device_id):
+        with self._lock:
+            return self._entries[device_id][1] if device_id in self._entries else None
+
+    def get_due_time(self, device_id):
+        with self._lock:
+            return self._entries[device_id][2] if device_id in self._entries else None
+
+    def get_device_ids(self):
+        with self._lock:
+            return self._entries.keys()
+
+    def next_due_time(self):
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        due_list = []
+        with self._lock:
+            while True:
+                self._discard_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                due_time, device_id, generation = heapq.heappop(self._heap)
+                interval = self._entries[device_id][1]
+
+                # next due time keeps the phase of the device schedule, missed slots are skipped
+                next_due_time = due_time + interval
+                if next_due_time <= now:
+                    next_due_time += ((now - next_due_time) // interval + 1) * interval
+                self._entries[device_id] = (generation + 1, interval, next_due_time)
+                heapq.heappush(self._heap, (next_due_time, device_id, generation + 1))
+
+                lag = now - due_time
+                self._lag_count += 1
+                self._lag_sum += lag
+                self._lag_max = max(self._lag_max, lag)
+                self._lag_last = lag
+                due_list.append((device_id, due_time))
+        return due_list
+
+    def get_statistics(self, reset=False):
+        with self._lock:
+            statistics = dict(Devices=len(self._entries), Enqueued=self._lag_count,
+                              LagAverage=self._lag_sum / self._lag_count if self._lag_count > 0 else 0.0,
+                              LagMax=self._lag_max, LagLast=self._lag_last)
+            if reset is True:
+                self._lag_count = 0
+                self._lag_sum = 0.0
+                self._lag_max = 0.0
+            return statistics
+
+    def _discard_stale(self):
+        while self._heap:
+            due_time, device_id, generation = self._heap[0]
+            if device_id in self._entries and self._entries[device_id][0] == generation:
+                return
+            heapq.heappop(self._heap)
+
+
+class PlannerStatePersister(threading.Thread):
+    _logger = logging.getLogger("planner-persister")
+    _db = None
+    _flush_interval = None
+    _pending = None
+    _lock = None
+
+    def __init__(self, db, flush_interval):
+        threading.Thread.__init__(self, name="planner-persister")
+        self._db = db
+        """:type : Database"""
+        self._flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def record_enqueue(self, device_id, timestamp):
+        with self._lock:
+            self._pending[device_id] = timestamp
+
+    def run(self):
+        self._logger.debug("started planner state persister, flush interval=%ds", self._flush_interval)
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self._logger.exception("failed to persist planner state")
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if len(pending) < 1:
+            return
+
+        requests = [UpdateOne(dict(DeviceId=device_id), {"$set": {"LastEnqueueTimestamp": timestamp}}, upsert=True)
+                    for device_id, timestamp in pending.iteritems()]
+        try:
+            self._db.np.monitor.planner.bulk_write(requests, ordered=False)
+        except Exception:
+            # keep state for next flush, unless there are newer records already
+            with self._lock:
+                for device_id, timestamp in pending.iteritems():
+                    if not device_id in self._pending:
+                        self._pending[device_id] = timestamp
+            raise
+        self._logger.debug("persisted planner state of %d devices", len(pending))
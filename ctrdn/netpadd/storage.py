@@ -0,0 +1,114 @@
+import logging
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+def create_layouts(db, layout_name, bucket_size):
+    if layout_name == "document":
+        return [DocumentLayout(db)]
+    elif layout_name == "bucket":
+        return [BucketLayout(db, bucket_size)]
+    elif layout_name == "both":
+        return [DocumentLayout(db), BucketLayout(db, bucket_size)]
+    raise ValueError("%r is not supported storage layout" % layout_name)
+
+
+class DocumentLayout(object):
+    _logger = logging.getLogger("storage-document")
+    _db = None
+
+    def __init__(self, db):
+        self._db = db
+        """:type : Database"""
+
+    @staticmethod
+    def requires_metrics():
+        return False
+
+    def ensure_indexes(self):
+        self._db.np.monitor.poll.create_index([("DeviceId", ASCENDING), ("PollTimestamp", DESCENDING)])
+
+    def write(self, batch, retry=False):
+        # documents carry their _id, retried batch can not produce duplicates
+        try:
+            self._db.np.monitor.poll.insert_many([document for document, metrics in batch], ordered=False)
+        except BulkWriteError as e:
+            # duplicate key errors come from documents written before the retried flush failed
+            failed_count = len([error for error in e.details.get("writeErrors", []) if error.get("code") != 11000])
+            self._logger.error("failed to write %d of %d poll results", failed_count, len(batch))
+            return failed_count
+        return 0
+
+
+class BucketLayout(object):
+    _logger = logging.getLogger("storage-bucket")
+    _db = None
+    _bucket_size = None
+
+    def __init__(self, db, bucket_size):
+        self._db = db
+        """:type : Database"""
+        self._bucket_size = bucket_size
+
+    @staticmethod
+    def requires_metrics():
+        return True
+
+    def ensure_indexes(self):
+        # first index serves range queries, second one finds the open bucket of metric instance
+        self._db.np.monitor.metric.create_index([("DeviceId", ASCENDING), ("Metric", ASCENDING),
+                                                 ("Start", ASCENDING)])
+        self._db.np.monitor.metric.create_index([("DeviceId", ASCENDING), ("Metric", ASCENDING),
+                                                 ("Instance", ASCENDING), ("Count", ASCENDING)])
+
+    def write(self, batch, retry=False):
+        """
+        Push metric samples of batch into open buckets, return number of poll results whose samples failed to be
+        written. Samples of retried batch which were written before the failure are not pushed again.
+        """
+        written = self._get_written_samples(batch) if retry else set()
+        requests = []
+        owners = []
+        for position, (document, metrics) in enumerate(batch):
+            timestamp = document["PollTimestamp"]
+            for metric, instance, value in metrics or []:
+                if (document["DeviceId"], metric, instance, _to_bson_time(timestamp)) in written:
+                    continue
+                requests.append(UpdateOne(
+                    {"DeviceId": document["DeviceId"], "Metric": metric, "Instance": instance,
+                     "Count": {"$lt": self._bucket_size}},
+                    {"$push": {"Samples": dict(T=timestamp, V=value)}, "$inc": {"Count": 1},
+                     "$min": {"Start": timestamp}, "$max": {"End": timestamp}},
+                    upsert=True))
+                owners.append(position)
+        if len(requests) < 1:
+            return 0
+
+        try:
+            self._db.np.monitor.metric.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed_count = len(set(owners[error["index"]] for error in errors))
+            self._logger.error("failed to write %d of %d metric samples of %d poll results", len(errors),
+                               len(requests), failed_count)
+            return failed_count
+        return 0
+
+    def _get_written_samples(self, batch):
+        # samples are identified by device, metric instance and poll timestamp
+        device_ids = list(set(document["DeviceId"] for document, metrics in batch))
+        timestamps = list(set(document["PollTimestamp"] for document, metrics in batch))
+        written = set()
+        query = {"DeviceId": {"$in": device_ids}, "Samples.T": {"$in": timestamps}}
+        for bucket in self._db.np.monitor.metric.find(query, {"DeviceId": 1, "Metric": 1, "Instance": 1,
+                                                              "Samples.T": 1}):
+            for sample in bucket["Samples"]:
+                written.add((bucket["DeviceId"], bucket["Metric"], bucket["Instance"], sample["T"]))
+        return written
+
+
+def _to_bson_time(timestamp):
+    # database keeps datetime values with millisecond precision
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
@@ -0,0 +1,170 @@
+from collections import deque
+from datetime import datetime
+import logging
+import threading
+import time
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class TableStore(threading.Thread):
+    """
+    Writer of streamed snmp tables. Rows are stored in chunk documents (np.monitor.table.chunk) referenced by one
+    index document per table and poll (np.monitor.table), written after all chunks of the table.
+
+    Buffer of pending documents is bounded, walks producing rows faster than they are stored are blocked (or paused
+    by their caller, when the walk must not block), so memory used by a streamed table does not depend on its size.
+    """
+    _logger = logging.getLogger("table-store")
+    _db = None
+    _buffer = None
+    _buffer_size = None
+    _condition = None
+    _unfinished = 0
+    _chunk_rows = None
+    _retry_interval = 5
+
+    def __init__(self, db, buffer_size, chunk_rows):
+        threading.Thread.__init__(self, name="table-store")
+        self._db = db
+        """:type : Database"""
+        self._buffer = deque()
+        self._buffer_size = buffer_size
+        self._condition = threading.Condition()
+        self._chunk_rows = chunk_rows
+
+    def create_table(self, device_id, table_name, timestamp, blocking=True):
+        return StoredTable(self, device_id, table_name, timestamp, self._chunk_rows, blocking)
+
+    def put(self, collection_name, document, block=True, overflow=False):
+        """
+        Hand document to the writer thread. When the buffer is full the call blocks, or returns False when block is
+        False. Documents put with overflow are accepted over the buffer size (last documents of a finished table).
+        """
+        with self._condition:
+            while not overflow and len(self._buffer) >= self._buffer_size:
+                if not block:
+                    return False
+                self._condition.wait()
+            self._buffer.append((collection_name, document))
+            self._unfinished += 1
+            self._condition.notify_all()
+        return True
+
+    def wait_written(self, timeout):
+        # returns False when buffered documents were not written in time
+        deadline = time.time() + timeout
+        while self._unfinished > 0:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def run(self):
+        self._logger.debug("started table store, buffer size=%d, chunk rows=%d", self._buffer_size, self._chunk_rows)
+        self._db.np.monitor.table.create_index([("DeviceId", ASCENDING), ("Table", ASCENDING),
+                                                ("PollTimestamp", DESCENDING)])
+        self._db.np.monitor.table.chunk.create_index([("TableId", ASCENDING), ("Sequence", ASCENDING)])
+        while True:
+            with self._condition:
+                while len(self._buffer) < 1:
+                    self._condition.wait()
+                collection_name, document = self._buffer.popleft()
+                self._condition.notify_all()
+            while True:
+                try:
+                    self._db.np.monitor[collection_name].insert_one(document)
+                    break
+                except DuplicateKeyError:
+                    # document was written before the retried insert failed
+                    break
+                except PyMongoError as e:
+                    self._logger.error("failed to store %s document of table %s, retrying in %ds: %s",
+                                       collection_name, document.get("TableId", document["_id"]),
+                                       self._retry_interval, e)
+                    time.sleep(self._retry_interval)
+            with self._condition:
+                self._unfinished -= 1
+
+
+class StoredTable(object):
+    """
+    Sink of one streamed table, rows are buffered up to one chunk and handed to the store.
+
+    Table which must not block keeps chunks not accepted by the full store as pending, its walk is not continued
+    until flush() hands them over.
+    """
+    table_id = None
+    _store = None
+    _device_id = None
+    _table_name = None
+    _timestamp = None
+    _chunk_rows = None
+    _blocking = True
+    _rows = None
+    _pending = None
+    _row_count = 0
+    _chunk_count = 0
+
+    def __init__(self, store, device_id, table_name, timestamp, chunk_rows, blocking=True):
+        self.table_id = ObjectId()
+        self._store = store
+        """:type : TableStore"""
+        self._device_id = device_id
+        self._table_name = table_name
+        self._timestamp = datetime.utcfromtimestamp(timestamp)
+        self._chunk_rows = chunk_rows
+        self._blocking = blocking
+        self._rows = []
+        self._pending = deque()
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        while len(self._rows) >= self._chunk_rows:
+            self._write_chunk(self._rows[:self._chunk_rows])
+            self._rows = self._rows[self._chunk_rows:]
+
+    def close(self, complete):
+        """
+        Write remaining rows and index document, return reference to the table used in poll result.
+        """
+        if len(self._rows) > 0:
+            self._write_chunk(self._rows)
+            self._rows = []
+        self._put("table", dict(_id=self.table_id, DeviceId=self._device_id, Table=self._table_name,
+                                PollTimestamp=self._timestamp, Rows=self._row_count, Chunks=self._chunk_count,
+                                Complete=complete))
+        # walk is over, its last documents are accepted over the buffer size instead of blocking
+        self.flush(True)
+        return dict(StoredTableId=self.table_id, Rows=self._row_count, Chunks=self._chunk_count)
+
+    def flush(self, overflow=False):
+        """
+        Hand pending documents to the store without blocking, return True when no document is pending.
+        """
+        while len(self._pending) > 0:
+            collection_name, document = self._pending[0]
+            if not self._store.put(collection_name, document, False, overflow):
+                return False
+            self._pending.popleft()
+        return True
+
+    def _write_chunk(self, rows):
+        self._put("table.chunk", dict(_id=ObjectId(), TableId=self.table_id, Sequence=self._chunk_count,
+                                      PollTimestamp=self._timestamp, Rows=rows))
+        self._row_count += len(rows)
+        self._chunk_count += 1
+
+    def _put(self, collection_name, document):
+        if self._blocking:
+            self._store.put(collection_name, document)
+        else:
+            self._pending.append((collection_name, document))
+            self.flush()
+
+
+def is_stored_table(table_data):
+    return isinstance(table_data, dict) and "StoredTableId" in table_data
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class Template(object):
+    revision = None
+    config = None
+    plan = None
+
+    def __init__(self, revision, config, plan):
+        self.revision = revision
+        self.config = config
+        self.plan = plan
+
+
+class TemplateStore(threading.Thread):
+    """
+    In-memory cache of table templates stored in np.snmp.tpl.table. Templates are loaded on first use and compiled by
+    "compile_template" once per template revision. Revisions of all templates are checked every refresh interval,
+    templates whose Revision changed (or which were removed) are loaded again on their next use.
+    """
+    _logger = logging.getLogger("template-store")
+    _db = None
+    _compile_template = None
+    _refresh_interval = None
+    _templates = None
+    _lock = None
+
+    def __init__(self, db, compile_template, refresh_interval):
+        threading.Thread.__init__(self, name="template-store")
+        self._db = db
+        """:type : Database"""
+        self._compile_template = compile_template
+        self._refresh_interval = refresh_interval
+        # template id -> Template, None for templates which do not exist
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_id):
+        with self._lock:
+            if template_id in self._templates:
+                return self._templates[template_id]
+
+        document = self._db.np.snmp.tpl.table.find_one(dict(_id=template_id))
+        template = None
+        if document is None:
+            self._logger.error("table template %s not found", template_id)
+        else:
+            revision = document.pop("Revision", None)
+            document.pop("_id")
+            try:
+                template = Template(revision, document, self._compile_template(document))
+                self._logger.debug("loaded table template %s, revision=%s", template_id, revision)
+            except (KeyError, TypeError, ValueError) as e:
+                self._logger.error("invalid table template %s: %r", template_id, e)
+        with self._lock:
+            self._templates[template_id] = template
+        return template
+
+    def run(self):
+        self._logger.debug("started template store, refresh interval=%ds", self._refresh_interval)
+        while True:
+            time.sleep(self._refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                self._logger.exception("failed to check revisions of table templates")
+
+    def refresh(self):
+        with self._lock:
+            if len(self._templates) < 1:
+                return
+            template_ids = self._templates.keys()
+        revisions = dict((document["_id"], document.get("Revision")) for document in
+                         self._db.np.snmp.tpl.table.find({"_id": {"$in": template_ids}}, {"Revision": 1}))
+        with self._lock:
+            for template_id in template_ids:
+                template = self._templates.get(template_id)
+                if template is None:
+                    # template was missing or invalid, it is loaded again when it exists now
+                    if template_id in revisions:
+                        self._templates.pop(template_id, None)
+                elif not template_id in revisions or revisions[template_id] != template.revision:
+                    self._logger.debug("table template %s changed, revision=%s", template_id,
+                                       revisions.get(template_id))
+                    self._templates.pop(template_id, None)
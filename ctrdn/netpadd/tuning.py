@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from pymongo import UpdateOne
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+# learned request sizes are stored in device document next to MonitorConfiguration, without touching its Revision
+TUNING_FIELD = "MonitorTuning"
+
+
+class RepetitionTuner(object):
+    """
+    Per-device GETBULK size (varbinds in one response), tuned by additive increase / multiplicative decrease: one row
+    per column is added after every full and fast response, size is halved after timeout or tooBig, lowered after slow
+    responses and set to the size of responses truncated by the agent.
+    """
+    _probe_name = None
+    _minimum = 1
+    _maximum = 200
+    _max_latency = 1.0
+    _slow_factor = 0.75
+    _devices = None
+    _pending = None
+    _lock = None
+
+    def __init__(self, probe_name):
+        self._probe_name = probe_name
+        # device id -> learned size
+        self._devices = {}
+        # device id -> size not yet persisted
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_field(self):
+        return "%s.%s.MaxRepetitions" % (TUNING_FIELD, self._probe_name)
+
+    def configure(self, minimum, maximum, max_latency):
+        assert 0 < minimum <= maximum, "invalid bulk tuning limits"
+        self._minimum = minimum
+        self._maximum = maximum
+        self._max_latency = max_latency
+
+    def get(self, device, default):
+        with self._lock:
+            size = self._devices.get(device["_id"])
+            if size is None:
+                # first poll in this process continues with the size learned by previous runs
+                size = device.get(TUNING_FIELD, {}).get(self._probe_name, {}).get("MaxRepetitions", default)
+                size = self._clamp(size)
+                self._devices[device["_id"]] = size
+            return size
+
+    def report_response(self, device_id, requested, received, columns, latency, walk_done):
+        """
+        Report successful response with "received" of "requested" rows of "columns" columns. Size is changed only by
+        responses after which the walk continues, shorter of them were truncated by the agent.
+        """
+        with self._lock:
+            size = self._devices.get(device_id)
+            if size is None:
+                return
+            if latency > self._max_latency:
+                new_size = int(size * self._slow_factor)
+            elif walk_done:
+                return
+            elif received < requested:
+                new_size = received * columns
+            else:
+                new_size = size + columns
+            self._set(device_id, size, new_size)
+
+    def report_failure(self, device_id):
+        # timeout or tooBig
+        with self._lock:
+            size = self._devices.get(device_id)
+            if size is not None:
+                self._set(device_id, size, size // 2)
+
+    def _set(self, device_id, size, new_size):
+        new_size = self._clamp(new_size)
+        if new_size != size:
+            self._devices[device_id] = new_size
+            self._pending[device_id] = new_size
+
+    def _clamp(self, size):
+        return max(self._minimum, min(self._maximum, int(size)))
+
+    def take_pending(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        return pending
+
+    def restore_pending(self, pending):
+        with self._lock:
+            for device_id, size in pending.iteritems():
+                if not device_id in self._pending:
+                    self._pending[device_id] = size
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._pending.pop(device_id, None)
+
+
+class TuningPersister(threading.Thread):
+    _logger = logging.getLogger("tuning-persister")
+    _db = None
+    _tuner = None
+    _flush_interval = None
+
+    def __init__(self, db, tuner, flush_interval):
+        threading.Thread.__init__(self, name="tuning-persister")
+        self._db = db
+        """:type : Database"""
+        self._tuner = tuner
+        """:type : RepetitionTuner"""
+        self._flush_interval = flush_interval
+
+    def run(self):
+        self._logger.debug("started tuning persister, flush interval=%ds", self._flush_interval)
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self._logger.exception("failed to persist learned snmp request sizes")
+
+    def flush(self):
+        pending = self._tuner.take_pending()
+        if len(pending) < 1:
+            return
+
+        requests = [UpdateOne(dict(_id=device_id), {"$set": {self._tuner.get_field(): size}})
+                    for device_id, size in pending.iteritems()]
+        try:
+            self._db.np.core.device.bulk_write(requests, ordered=False)
+        except Exception:
+            self._tuner.restore_pending(pending)
+            raise
+        self._logger.debug("persisted learned snmp request sizes of %d devices", len(pending))
@@ -0,0 +1,141 @@
+import logging
+from multiprocessing import Process, RawArray
+import time
+import zlib
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+def get_partition(device_id, partition_count):
+    # stable across processes and restarts, unlike hash() of some id types
+    return (zlib.crc32(str(device_id)) & 0xffffffff) % partition_count
+
+
+class DevicePartition(object):
+    """
+    Devices owned by one worker process, ownership of partitions is shared with the supervisor, which can move
+    partitions between workers at any time. Planners of workers pick the change up on their next device refresh.
+    """
+    worker_index = None
+    _assignment = None
+
+    def __init__(self, worker_index, assignment):
+        self.worker_index = worker_index
+        self._assignment = assignment
+
+    def contains(self, device_id):
+        return self._assignment[get_partition(device_id, len(self._assignment))] == self.worker_index
+
+
+class WorkerSupervisor(object):
+    """
+    Starts worker processes which poll their partitions of devices and restarts workers which exit. Every partition
+    belongs to its home worker (partition modulo worker count), partitions of a worker which exits more than
+    max_restarts times within restart_window seconds are moved to the other workers, the worker is started again
+    after restart_window and its partitions are moved back.
+
+    Supervisor does not start any threads or database connections, so workers forked after a crash start clean.
+    """
+    _logger = logging.getLogger("supervisor")
+    _run_worker = None
+    _worker_count = None
+    _max_restarts = None
+    _restart_window = None
+    _restart_delay = None
+    _stop_timeout = 15
+    _assignment = None
+    _processes = None
+    _exit_times = None
+    _start_times = None
+    _suspended = None
+
+    def __init__(self, run_worker, worker_count, partition_count, max_restarts, restart_window, restart_delay):
+        assert worker_count > 0, "invalid worker count"
+        assert partition_count >= worker_count, "there must be at least one partition per worker"
+        self._run_worker = run_worker
+        self._worker_count = worker_count
+        self._max_restarts = max_restarts
+        self._restart_window = restart_window
+        self._restart_delay = restart_delay
+        # partition -> index of owning worker, -1 when no worker is running, shared with worker processes
+        self._assignment = RawArray("i", partition_count)
+        self._processes = [None] * worker_count
+        self._exit_times = [[] for i in range(0, worker_count)]
+        self._start_times = [0] * worker_count
+        self._suspended = set()
+
+    def start_workers(self):
+        self._rebalance()
+        for worker_index in range(0, self._worker_count):
+            self._start_worker(worker_index)
+
+    def check_workers(self):
+        now = time.time()
+        rebalance = False
+        for worker_index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                process.join()
+                self._processes[worker_index] = None
+                exit_times = [t for t in self._exit_times[worker_index] if now - t < self._restart_window] + [now]
+                self._exit_times[worker_index] = exit_times
+                if len(exit_times) > self._max_restarts:
+                    self._logger.error("worker %d exited %d times in %ds (exit code %s), moving its partitions to "
+                                       "other workers for %ds", worker_index, len(exit_times), self._restart_window,
+                                       process.exitcode, self._restart_window)
+                    self._suspended.add(worker_index)
+                    self._start_times[worker_index] = now + self._restart_window
+                    rebalance = True
+                else:
+                    self._logger.error("worker %d exited with code %s, restarting in %ds", worker_index,
+                                       process.exitcode, self._restart_delay)
+                    self._start_times[worker_index] = now + self._restart_delay
+        if rebalance:
+            self._rebalance()
+
+        for worker_index, process in enumerate(self._processes):
+            if process is None and now >= self._start_times[worker_index]:
+                if worker_index in self._suspended:
+                    self._suspended.discard(worker_index)
+                    self._exit_times[worker_index] = []
+                    self._rebalance()
+                self._start_worker(worker_index)
+
+    def stop_workers(self):
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.time() + self._stop_timeout
+        for worker_index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                self._logger.warning("worker %d did not stop in %ds", worker_index, self._stop_timeout)
+
+    def _start_worker(self, worker_index):
+        process = Process(target=self._run_worker, args=(worker_index, DevicePartition(worker_index, self._assignment)),
+                          name="worker-{0}".format(worker_index))
+        # workers are terminated when supervisor exits
+        process.daemon = True
+        process.start()
+        self._processes[worker_index] = process
+        self._logger.info("started worker %d, pid=%d", worker_index, process.pid)
+
+    def _rebalance(self):
+        active = [worker_index for worker_index in range(0, self._worker_count)
+                  if not worker_index in self._suspended]
+        counts = dict((worker_index, 0) for worker_index in active)
+        for partition in range(0, len(self._assignment)):
+            home = partition % self._worker_count
+            if not home in self._suspended:
+                owner = home
+            elif len(active) > 0:
+                # partitions of suspended worker are spread over active workers
+                owner = active[(partition // self._worker_count) % len(active)]
+            else:
+                owner = -1
+            self._assignment[partition] = owner
+            if owner >= 0:
+                counts[owner] += 1
+        self._logger.info("assigned %d partitions to workers: %s", len(self._assignment),
+                          ", ".join("%d=%d" % (worker_index, count) for worker_index, count in sorted(counts.items())))
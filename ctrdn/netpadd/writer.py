@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from Queue import Queue, Empty, Full
+from pymongo.errors import PyMongoError
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class ResultWriter(threading.Thread):
+    _logger = logging.getLogger("result-writer")
+    _layouts = None
+    _buffer = None
+    _batch_size = None
+    _flush_interval = None
+    _put_timeout = None
+    _retry_interval = 5
+    _statistics_interval = 60
+    _counter_lock = None
+    _flushed_count = 0
+    _dropped_count = 0
+    _failed_flush_count = 0
+
+    def __init__(self, layouts, buffer_size, batch_size, flush_interval, put_timeout):
+        threading.Thread.__init__(self, name="result-writer")
+        self._layouts = layouts
+        self._buffer = Queue(buffer_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._put_timeout = put_timeout
+        self._counter_lock = threading.Lock()
+
+    def requires_metrics(self):
+        return any(layout.requires_metrics() for layout in self._layouts)
+
+    def write(self, document, metrics=None):
+        # full buffer blocks the caller (backpressure), document is dropped only after put timeout
+        try:
+            self._buffer.put((document, metrics), True, self._put_timeout)
+            return True
+        except Full:
+            with self._counter_lock:
+                self._dropped_count += 1
+            self._logger.warning("result buffer is full, dropped poll result of device %s", document["DeviceId"])
+            return False
+
+    def get_statistics(self):
+        with self._counter_lock:
+            return dict(Buffered=self._buffer.qsize(), Flushed=self._flushed_count, Dropped=self._dropped_count,
+                        FailedFlushes=self._failed_flush_count)
+
+    def run(self):
+        self._logger.debug("started result writer, buffer size=%d, batch size=%d, flush interval=%ds",
+                           self._buffer.maxsize, self._batch_size, self._flush_interval)
+        for layout in self._layouts:
+            layout.ensure_indexes()
+        next_statistics_time = time.time() + self._statistics_interval
+        while True:
+            batch = self._collect_batch()
+            if len(batch) > 0:
+                # the only writer thread must survive any failure, otherwise pollers block on the full buffer
+                try:
+                    self._flush(batch)
+                except Exception:
+                    self._logger.exception("failed to flush %d poll results", len(batch))
+                    with self._counter_lock:
+                        self._dropped_count += len(batch)
+
+            if time.time() >= next_statistics_time:
+                statistics = self.get_statistics()
+                self._logger.info("result writer statistics: buffered=%d, flushed=%d, dropped=%d, failed flushes=%d",
+                                  statistics["Buffered"], statistics["Flushed"], statistics["Dropped"],
+                                  statistics["FailedFlushes"])
+                next_statistics_time = time.time() + self._statistics_interval
+
+    def _collect_batch(self):
+        # batch is flushed when it is full or when flush interval since its first document has passed
+        batch = []
+        flush_time = None
+        while len(batch) < self._batch_size:
+            timeout = self._flush_interval if flush_time is None else flush_time - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._buffer.get(True, timeout))
+            except Empty:
+                break
+            if flush_time is None:
+                flush_time = time.time() + self._flush_interval
+        return batch
+
+    def _flush(self, batch):
+        pending_layouts = list(self._layouts)
+        failed_count = 0
+        retry = False
+        while len(pending_layouts) > 0:
+            try:
+                failed_count = max(failed_count, pending_layouts[0].write(batch, retry))
+                pending_layouts.pop(0)
+                retry = False
+            except PyMongoError as e:
+                # batch may be partially written, layouts skip what was written when it is retried
+                retry = True
+                with self._counter_lock:
+                    self._failed_flush_count += 1
+                self._logger.error("failed to flush %d poll results, retrying in %ds: %s", len(batch),
+                                   self._retry_interval, e)
+                time.sleep(self._retry_interval)
+            except Exception:
+                # batch which can not be encoded (invalid document) would fail again, it is dropped
+                self._logger.exception("failed to write %d poll results, batch is dropped", len(batch))
+                failed_count = len(batch)
+                pending_layouts.pop(0)
+                retry = False
+
+        with self._counter_lock:
+            self._flushed_count += len(batch) - failed_count
+            self._dropped_count += failed_count
+        self._logger.debug("flushed %d poll results", len(batch) - failed_count)
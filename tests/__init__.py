@@ -0,0 +1 @@
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+import unittest
+from ctrdn.netpadd.cluster import LeaseManager
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class LeaseManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient()["netpad"]
+        self.node_a = LeaseManager(self.db, "a:1", 30, 10)
+        self.node_b = LeaseManager(self.db, "b:1", 30, 10)
+        self.node_a.ensure_indexes()
+
+    def get_record(self, device_id):
+        return self.db.np.monitor.planner.find_one({"DeviceId": device_id})
+
+    def test_first_claim_creates_lease(self):
+        self.assertTrue(self.node_a.claim("d1", 60))
+        self.assertEqual(self.get_record("d1")["LeaseNode"], "a:1")
+
+    def test_slot_is_claimed_once(self):
+        self.assertTrue(self.node_a.claim("d1", 60))
+        self.assertFalse(self.node_a.claim("d1", 60))
+        self.assertFalse(self.node_b.claim("d1", 60))
+
+    def test_leased_device_is_not_claimed_by_other_node(self):
+        self.node_a.claim("d1", 60)
+        self.db.np.monitor.planner.update_one({"DeviceId": "d1"}, {"$set": {
+            "LastEnqueueTimestamp": datetime.utcnow() - timedelta(seconds=120)}})
+        self.assertFalse(self.node_b.claim("d1", 60))
+        self.assertTrue(self.node_a.claim("d1", 60))
+
+    def test_expired_lease_is_taken_over(self):
+        self.node_a.claim("d1", 60)
+        self.db.np.monitor.planner.update_one({"DeviceId": "d1"}, {"$set": {
+            "LastEnqueueTimestamp": datetime.utcnow() - timedelta(seconds=120),
+            "LeaseExpires": datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertTrue(self.node_b.claim("d1", 60))
+        self.assertEqual(self.get_record("d1")["LeaseNode"], "b:1")
+
+    def test_released_devices_are_claimed_by_other_node(self):
+        self.node_a.claim("d1", 60)
+        self.node_a.release_all()
+        self.db.np.monitor.planner.update_one({"DeviceId": "d1"}, {"$set": {
+            "LastEnqueueTimestamp": datetime.utcnow() - timedelta(seconds=120)}})
+        self.assertTrue(self.node_b.claim("d1", 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from ctrdn.netpadd.rates import RateEngine
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class RateEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = RateEngine()
+
+    def compute(self, timestamp, uptime, rows, counters=None):
+        return self.engine.compute("d1", "ifTable", timestamp, uptime, counters or {"ifInOctets": 32}, rows)
+
+    def test_first_sample_has_no_rates(self):
+        self.assertEqual(self.compute(100, 1000, [("1", {"ifInOctets": "10"})]), [])
+
+    def test_rate_per_second(self):
+        self.compute(100, 1000, [("1", {"ifInOctets": "10"})])
+        self.assertEqual(self.compute(110, 2000, [("1", {"ifInOctets": "110"})]),
+                         [{"ifInOctets": 10.0, "RowIndex": "1"}])
+
+    def test_32_bit_counter_wraps(self):
+        self.compute(100, 1000, [("1", {"ifInOctets": str((1 << 32) - 10)})])
+        self.assertEqual(self.compute(110, 2000, [("1", {"ifInOctets": "90"})]),
+                         [{"ifInOctets": 10.0, "RowIndex": "1"}])
+
+    def test_64_bit_counter_discontinuity_is_skipped(self):
+        self.compute(100, 1000, [("1", {"ifHCInOctets": "100"})], {"ifHCInOctets": 64})
+        self.assertEqual(self.compute(110, 2000, [("1", {"ifHCInOctets": "50"})], {"ifHCInOctets": 64}), [])
+
+    def test_agent_restart_has_no_rates(self):
+        self.compute(100, 1000, [("1", {"ifInOctets": "10"})])
+        self.assertEqual(self.compute(110, 5, [("1", {"ifInOctets": "20"})]), [])
+
+    def test_new_rows_and_invalid_values_are_skipped(self):
+        self.compute(100, 1000, [("1", {"ifInOctets": "10"}), ("2", {"ifInOctets": "x"})])
+        self.assertEqual(self.compute(110, 2000, [("1", {"ifInOctets": "20"}), ("2", {"ifInOctets": "30"}),
+                                                  ("3", {"ifInOctets": "40"})]),
+                         [{"ifInOctets": 1.0, "RowIndex": "1"}])
+
+    def test_skip_drops_previous_sample(self):
+        self.compute(100, 1000, [("1", {"ifInOctets": "10"})])
+        self.assertTrue(self.engine.skip("d1", "ifTable"))
+        self.assertFalse(self.engine.skip("d1", "ifTable"))
+        self.assertEqual(self.compute(120, 3000, [("1", {"ifInOctets": "30"})]), [])
+
+    def test_forget_drops_device_samples(self):
+        self.compute(100, 1000, [("1", {"ifInOctets": "10"})])
+        self.engine.forget("d1")
+        self.assertEqual(self.compute(110, 2000, [("1", {"ifInOctets": "20"})]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from ctrdn.netpadd.scheduler import PollScheduler
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = PollScheduler()
+
+    def test_due_devices_are_popped_in_order(self):
+        self.scheduler.schedule("b", 60, 120)
+        self.scheduler.schedule("a", 60, 110)
+        self.scheduler.schedule("c", 60, 200)
+        self.assertEqual(self.scheduler.pop_due(150), [("a", 110), ("b", 120)])
+        self.assertEqual(self.scheduler.next_due_time(), 170)
+
+    def test_next_due_time_keeps_phase(self):
+        self.scheduler.schedule("a", 60, 100)
+        self.scheduler.pop_due(105)
+        self.assertEqual(self.scheduler.get_due_time("a"), 160)
+
+    def test_missed_slots_are_skipped(self):
+        self.scheduler.schedule("a", 60, 100)
+        self.assertEqual(self.scheduler.pop_due(400), [("a", 100)])
+        self.assertEqual(self.scheduler.get_due_time("a"), 460)
+        self.assertEqual(self.scheduler.pop_due(400), [])
+
+    def test_rescheduled_device_is_popped_once(self):
+        self.scheduler.schedule("a", 60, 100)
+        self.scheduler.schedule("a", 30, 130)
+        self.assertEqual(self.scheduler.pop_due(120), [])
+        self.assertEqual(self.scheduler.pop_due(130), [("a", 130)])
+        self.assertEqual(self.scheduler.get_interval("a"), 30)
+
+    def test_removed_device_is_not_popped(self):
+        self.scheduler.schedule("a", 60, 100)
+        self.scheduler.remove("a")
+        self.assertEqual(self.scheduler.pop_due(200), [])
+        self.assertIsNone(self.scheduler.next_due_time())
+
+    def test_statistics(self):
+        self.scheduler.schedule("a", 60, 100)
+        self.scheduler.schedule("b", 60, 104)
+        self.scheduler.pop_due(106)
+        statistics = self.scheduler.get_statistics(reset=True)
+        self.assertEqual((statistics["Devices"], statistics["Enqueued"], statistics["LagMax"]), (2, 2, 6))
+        self.assertEqual(statistics["LagAverage"], 4.0)
+        self.assertEqual(self.scheduler.get_statistics()["Enqueued"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+from pysnmp.proto import rfc1902
+from ctrdn.netpadd.probe.util.snmp import AddressRace, decode_value, TableWalk, ERROR_STATUS_TOO_BIG
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+TABLE_CONFIG = {"BaseOid": "1.3.6.1.2.1.2.2.1", "ColumnNameMode": "manual-multi-level",
+                "Columns": {"ifDescr": 2, "ifInOctets": 10}}
+
+
+def _var_bind(oid, value):
+    return rfc1902.ObjectName(oid), value
+
+
+class _ListSink(object):
+    def __init__(self):
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+
+    def flush(self):
+        return True
+
+    def close(self, complete):
+        return dict(Rows=len(self.rows), Complete=complete)
+
+
+class TableWalkTest(unittest.TestCase):
+    def test_columns_are_walked_side_by_side(self):
+        walk = TableWalk(TABLE_CONFIG)
+        self.assertEqual(walk.get_request_oids(), ["1.3.6.1.2.1.2.2.1.2", "1.3.6.1.2.1.2.2.1.10"])
+        walk.feed([[_var_bind("1.3.6.1.2.1.2.2.1.2.1", rfc1902.OctetString("lo")),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.1", rfc1902.Counter32(10))],
+                   [_var_bind("1.3.6.1.2.1.2.2.1.2.2", rfc1902.OctetString("eth0")),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.2", rfc1902.Counter32(20))]])
+        self.assertEqual(walk.get_request_oids(), ["1.3.6.1.2.1.2.2.1.2.2", "1.3.6.1.2.1.2.2.1.10.2"])
+        # ifDescr column ends, ifInOctets continues with its last row
+        walk.feed([[_var_bind("1.3.6.1.2.1.2.2.1.3.1", rfc1902.Integer(6)),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.3", rfc1902.Counter32(30))]])
+        self.assertEqual(walk.get_request_oids(), ["1.3.6.1.2.1.2.2.1.10.3"])
+        walk.feed([[_var_bind("1.3.6.1.2.1.2.2.1.11.1", rfc1902.Counter32(1))]])
+        self.assertTrue(walk.is_done())
+        self.assertEqual(walk.table_data, [{"RowIndex": "1", "ifDescr": "lo", "ifInOctets": "10"},
+                                           {"RowIndex": "2", "ifDescr": "eth0", "ifInOctets": "20"},
+                                           {"RowIndex": "3", "ifInOctets": "30"}])
+
+    def test_non_increasing_oid_finishes_column(self):
+        walk = TableWalk(TABLE_CONFIG)
+        walk.feed([[_var_bind("1.3.6.1.2.1.2.2.1.2.2", rfc1902.OctetString("eth0")),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.2", rfc1902.Counter32(20))]])
+        walk.feed([[_var_bind("1.3.6.1.2.1.2.2.1.2.1", rfc1902.OctetString("lo")),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.3", rfc1902.Counter32(30))]])
+        self.assertEqual(walk.get_request_oids(), ["1.3.6.1.2.1.2.2.1.10.3"])
+        self.assertEqual(len(walk.table_data), 2)
+
+    def test_empty_response_finishes_walk(self):
+        walk = TableWalk(TABLE_CONFIG)
+        walk.feed([])
+        self.assertTrue(walk.is_done())
+        self.assertEqual(walk.table_data, [])
+
+    def test_single_level_table(self):
+        walk = TableWalk({"BaseOid": "1.3.6.1.2.1.1", "ColumnNameMode": "auto-single-level",
+                          "ColumnNamePrefix": "sys", "SingleLevelTableStyle": "dict"})
+        walk.feed([[_var_bind("1.3.6.1.2.1.1.5", rfc1902.OctetString("router"))],
+                   [_var_bind("1.3.6.1.2.2.1", rfc1902.Integer(1))]])
+        self.assertTrue(walk.is_done())
+        self.assertEqual(walk.table_data, {"sys5": "router"})
+
+    def test_complete_rows_are_streamed(self):
+        sink = _ListSink()
+        walk = TableWalk(TABLE_CONFIG, sink, 1)
+        walk.feed([[_var_bind("1.3.6.1.2.1.2.2.1.2.1", rfc1902.OctetString("lo")),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.1", rfc1902.Counter32(10))],
+                   [_var_bind("1.3.6.1.2.1.2.2.1.2.2", rfc1902.OctetString("eth0")),
+                    _var_bind("1.3.6.1.2.1.2.2.1.10.2", rfc1902.Counter32(20))]])
+        self.assertTrue(walk.is_streamed())
+        self.assertEqual([row["RowIndex"] for row in sink.rows], ["1"])
+        self.assertEqual(walk.table_data, [{"RowIndex": "2", "ifDescr": "eth0", "ifInOctets": "20"}])
+        self.assertEqual(walk.close_stream(True), dict(Rows=2, Complete=True))
+        self.assertEqual(walk.table_data, [])
+
+
+class DecodeValueTest(unittest.TestCase):
+    def test_values_are_decoded_as_pretty_out(self):
+        for value in [rfc1902.Integer(-5), rfc1902.Counter32(10), rfc1902.Counter64(1 << 40), rfc1902.Gauge32(7),
+                      rfc1902.TimeTicks(100), rfc1902.OctetString("eth0"), rfc1902.OctetString("\x00\x1a\x2b"),
+                      rfc1902.IpAddress("10.0.0.1"), rfc1902.ObjectName("1.3.6.1.2.1")]:
+            self.assertEqual(decode_value(value), value.prettyOut(value))
+
+    def test_binary_octet_string_is_hexadecimal(self):
+        self.assertEqual(decode_value(rfc1902.OctetString("\x00\x1a\x2b")), "0x001a2b")
+
+
+class AddressRaceTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.timers = []
+        self.done = []
+        self.responses = []
+
+    def start_race(self, candidates, race_delay):
+        race = AddressRace(candidates, race_delay, lambda address, callback: self.sent.append((address, callback)),
+                           lambda delay, function: self.timers.append(function),
+                           lambda address, response: self.done.append((address, response)),
+                           lambda address, latency, successful, deciding:
+                           self.responses.append((address, successful, deciding)))
+        race.start()
+        return race
+
+    def respond(self, address, error_indication=None, error_status=0):
+        dict(self.sent)[address](error_indication, error_status, 0, [])
+
+    def test_next_candidate_starts_after_race_delay(self):
+        self.start_race(["a", "b"], 0.5)
+        self.assertEqual([address for address, callback in self.sent], ["a"])
+        self.timers.pop()()
+        self.assertEqual([address for address, callback in self.sent], ["a", "b"])
+        self.respond("b")
+        self.assertEqual(self.done, [("b", (None, 0, 0, []))])
+        self.assertEqual(self.responses, [("b", True, True)])
+
+    def test_negative_delay_waits_for_failure(self):
+        self.start_race(["a", "b"], -1)
+        self.assertEqual(self.timers, [])
+        self.respond("a", "timeout")
+        self.assertEqual([address for address, callback in self.sent], ["a", "b"])
+        self.respond("b", "timeout")
+        self.assertEqual(self.done, [(None, ("timeout", 0, 0, []))])
+        self.assertEqual(self.responses, [("a", False, False), ("b", False, True)])
+
+    def test_too_big_response_wins(self):
+        self.start_race(["a"], 0.5)
+        self.respond("a", error_status=ERROR_STATUS_TOO_BIG)
+        self.assertEqual(self.done, [("a", (None, ERROR_STATUS_TOO_BIG, 0, []))])
+        self.assertEqual(self.responses, [("a", True, True)])
+
+    def test_late_responses_are_discarded(self):
+        self.start_race(["a", "b"], 0)
+        self.timers.pop()()
+        self.respond("b")
+        self.respond("a")
+        self.assertEqual(len(self.done), 1)
+        self.assertEqual(self.responses, [("b", True, True)])
+
+    def test_no_candidates(self):
+        self.start_race([], 0.5)
+        self.assertEqual(self.done, [(None, ("no candidate addresses", None, None, []))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from ctrdn.netpadd.tuning import RepetitionTuner
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+class RepetitionTunerTest(unittest.TestCase):
+    def setUp(self):
+        self.tuner = RepetitionTuner("snmp_info")
+        self.tuner.configure(4, 100, 1.0)
+        self.device = {"_id": "d1"}
+
+    def test_starts_with_persisted_size(self):
+        self.assertEqual(self.tuner.get({"_id": "d2", "MonitorTuning": {"snmp_info": {"MaxRepetitions": 30}}}, 10),
+                         30)
+        self.assertEqual(self.tuner.get(self.device, 1000), 100)
+
+    def test_full_fast_response_adds_row(self):
+        self.tuner.get(self.device, 20)
+        self.tuner.report_response("d1", 20, 20, 4, 0.1, False)
+        self.assertEqual(self.tuner.get(self.device, 20), 24)
+        self.assertEqual(self.tuner.take_pending(), {"d1": 24})
+        self.assertEqual(self.tuner.take_pending(), {})
+
+    def test_last_response_of_walk_does_not_change_size(self):
+        self.tuner.get(self.device, 20)
+        self.tuner.report_response("d1", 20, 5, 4, 0.1, True)
+        self.assertEqual(self.tuner.get(self.device, 20), 20)
+
+    def test_truncated_response_sets_size(self):
+        self.tuner.get(self.device, 20)
+        self.tuner.report_response("d1", 20, 3, 4, 0.1, False)
+        self.assertEqual(self.tuner.get(self.device, 20), 12)
+
+    def test_slow_response_lowers_size(self):
+        self.tuner.get(self.device, 20)
+        self.tuner.report_response("d1", 20, 20, 4, 2.0, True)
+        self.assertEqual(self.tuner.get(self.device, 20), 15)
+
+    def test_failure_halves_size_within_limits(self):
+        self.tuner.get(self.device, 6)
+        self.tuner.report_failure("d1")
+        self.assertEqual(self.tuner.get(self.device, 6), 4)
+
+    def test_forget_drops_learned_size(self):
+        self.tuner.get(self.device, 20)
+        self.tuner.report_failure("d1")
+        self.tuner.forget("d1")
+        self.assertEqual(self.tuner.take_pending(), {})
+        self.assertEqual(self.tuner.get(self.device, 20), 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+from multiprocessing import RawArray
+import os
+import time
+import unittest
+from ctrdn.netpadd import workers
+from ctrdn.netpadd.workers import DevicePartition, get_partition, WorkerSupervisor
+
+__author__ = 'Lubomir Kaplan <castor@castor.sk>'
+
+
+def _run_worker(worker_index, partition):
+    # worker 1 crashes right after start, other workers run until terminated
+    if worker_index == 1:
+        os._exit(3)
+    time.sleep(60)
+
+
+class _Clock(object):
+    now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class PartitionTest(unittest.TestCase):
+    def test_partition_is_stable_and_in_range(self):
+        self.assertEqual(get_partition("device-1", 16), get_partition("device-1", 16))
+        self.assertEqual(get_partition(42, 16), get_partition("42", 16))
+        self.assertTrue(all(0 <= get_partition("device-%d" % i, 7) < 7 for i in range(0, 100)))
+
+    def test_devices_are_owned_by_assigned_worker(self):
+        assignment = RawArray("i", [0, 1, 1])
+        partition = DevicePartition(1, assignment)
+        for i in range(0, 50):
+            device_id = "device-%d" % i
+            self.assertEqual(partition.contains(device_id), get_partition(device_id, 3) != 0)
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        workers.time = self.clock
+        self.supervisor = WorkerSupervisor(_run_worker, 2, 4, 1, 60, 0)
+
+    def tearDown(self):
+        self.supervisor.stop_workers()
+        workers.time = time
+
+    def get_assignment(self):
+        return list(self.supervisor._assignment)
+
+    def wait_for_exit(self, worker_index):
+        self.supervisor._processes[worker_index].join(10)
+
+    def test_partitions_start_at_home_workers(self):
+        self.supervisor.start_workers()
+        self.assertEqual(self.get_assignment(), [0, 1, 0, 1])
+
+    def test_crashing_worker_is_restarted_then_suspended_for_restart_window(self):
+        self.supervisor.start_workers()
+        first_pid = self.supervisor._processes[1].pid
+        self.wait_for_exit(1)
+        self.supervisor.check_workers()
+        self.assertNotEqual(self.supervisor._processes[1].pid, first_pid)
+        self.assertEqual(self.get_assignment(), [0, 1, 0, 1])
+
+        # second exit within the restart window moves partitions of the worker to the other worker
+        self.clock.now += 10
+        self.wait_for_exit(1)
+        self.supervisor.check_workers()
+        self.assertIsNone(self.supervisor._processes[1])
+        self.assertEqual(self.get_assignment(), [0, 0, 0, 0])
+        self.assertTrue(self.supervisor._processes[0].is_alive())
+
+        # worker is started again after the restart window and gets its partitions back
+        self.clock.now += 59
+        self.supervisor.check_workers()
+        self.assertIsNone(self.supervisor._processes[1])
+        self.clock.now += 1
+        self.supervisor.check_workers()
+        self.assertIsNotNone(self.supervisor._processes[1])
+        self.assertEqual(self.get_assignment(), [0, 1, 0, 1])
+
+    def test_exits_outside_of_restart_window_are_forgotten(self):
+        self.supervisor.start_workers()
+        for i in range(0, 3):
+            self.wait_for_exit(1)
+            self.supervisor.check_workers()
+            self.assertIsNotNone(self.supervisor._processes[1])
+            self.clock.now += 61
+        self.assertEqual(self.get_assignment(), [0, 1, 0, 1])
+
+    def test_partitions_are_unassigned_without_active_workers(self):
+        self.supervisor._suspended.update([0, 1])
+        self.supervisor._rebalance()
+        self.assertEqual(self.get_assignment(), [-1, -1, -1, -1])
+
+
+if __name__ == "__main__":
+    unittest.main()